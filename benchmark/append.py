@@ -0,0 +1,57 @@
+'''
+Compare the cost of writing multichannel data to a FileMultiChannel in small
+blocks with and without write buffering (see cns.channel.AppendBuffer).
+
+Usage: python benchmark/append.py [--duration N] [--block N]
+'''
+
+import os
+import timeit
+import tempfile
+import numpy as np
+import tables
+
+from cns.channel import FileMultiChannel
+
+def benchmark(n_blocks, block_size, buffer_writes, compression_type):
+    filename = os.path.join(tempfile.mkdtemp(), 'append.h5')
+    fh = tables.open_file(filename, 'w')
+    level = 1 if compression_type else 0
+    channel = FileMultiChannel(node=fh.root, name='raw', channels=16,
+                               fs=25e3, dtype=np.float32,
+                               compression_type=compression_type,
+                               compression_level=level,
+                               buffer_writes=buffer_writes)
+    data = np.random.randn(16, block_size).astype(np.float32)
+    def write():
+        for i in range(n_blocks):
+            channel.send(data)
+        channel.flush()
+    t = timeit.timeit(write, number=1)
+    fh.close()
+    os.unlink(filename)
+    return t
+
+def main(duration, block_size):
+    n_blocks = int(duration*25e3/block_size)
+    print 'Writing {} s of 16 channel data in blocks of {} samples'\
+        .format(duration, block_size)
+    print '{:>12} {:>14} {:>14} {:>8}'.format('compression', 'unbuffered (s)',
+                                              'buffered (s)', 'speedup')
+    for compression_type in (None, 'zlib', 'blosc'):
+        t_unbuffered = benchmark(n_blocks, block_size, False, compression_type)
+        t_buffered = benchmark(n_blocks, block_size, True, compression_type)
+        speedup = t_unbuffered/t_buffered
+        print '{:>12} {:>14.3f} {:>14.3f} {:>8.1f}'.format(compression_type,
+                                                           t_unbuffered,
+                                                           t_buffered, speedup)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmark appends')
+    parser.add_argument('--duration', type=float, default=60,
+                        help='Duration of data to write (s)')
+    parser.add_argument('--block', type=int, default=100,
+                        help='Samples per channel in each write')
+    args = parser.parse_args()
+    main(args.duration, args.block)
@@ -0,0 +1,88 @@
+'''
+Compare the cost of gathering and writing spike waveforms one spike at a time
+(as cns.analysis.extract_spikes used to) with gathering all the waveforms in a
+chunk at once and writing them in a single append (see
+cns.arraytools.gather_windows).
+
+The recording is synthetic 16 channel data with a high firing rate so the
+per-spike overhead dominates.  Only the gather and write stage is timed (the
+detection is identical).
+
+Usage: python benchmark/extract_spikes.py [--duration N] [--rate N]
+'''
+
+import os
+import shutil
+import timeit
+import tempfile
+import numpy as np
+import tables
+
+from cns.arraytools import chunk_iter, gather_windows
+
+FS = 25e3
+WINDOW = 53
+BEFORE = 13
+
+def synthetic_recording(duration, rate, channels=16, seed=0):
+    state = np.random.RandomState(seed)
+    n = int(duration*FS)
+    x = state.normal(size=(channels, n)).astype(np.float32)
+    waveform = -np.exp(-np.arange(-16, 32)**2/40.0)*8
+    for i in range(channels):
+        for t in state.randint(16, n-32, int(rate*duration)):
+            x[i, t-16:t+32] += waveform
+    return x
+
+def detect(chunk):
+    c = chunk[..., BEFORE:-(WINDOW-BEFORE)]*-1
+    crossings = (c[..., :-1] <= 4) & (c[..., 1:] > 4)
+    return np.where(crossings)
+
+def benchmark(x, c_samples, batched):
+    tempdir = tempfile.mkdtemp()
+    fh = tables.open_file(os.path.join(tempdir, 'spikes.h5'), 'w')
+    waveforms = fh.create_earray(fh.root, 'waveforms', tables.Float32Atom(),
+                                 (0, x.shape[0], WINDOW))
+    indices = fh.create_earray(fh.root, 'timestamps_n', tables.Int32Atom(),
+                               (0,))
+    chunks = list(chunk_iter(x, c_samples, loverlap=BEFORE,
+                             roverlap=WINDOW-BEFORE))
+    found = [detect(chunk) for chunk in chunks]
+
+    def write():
+        for i, (chunk, (channel_index, sample_index)) in \
+                enumerate(zip(chunks, found)):
+            if batched:
+                waveforms.append(gather_windows(chunk, sample_index, WINDOW,
+                                                fill_value=None))
+            else:
+                for s in sample_index:
+                    waveforms.append(chunk[..., s:s+WINDOW][np.newaxis])
+            indices.append(sample_index+i*c_samples)
+        fh.flush()
+    t = timeit.timeit(write, number=1)
+    n = len(waveforms)
+    fh.close()
+    shutil.rmtree(tempdir)
+    return n, t
+
+def main(duration, rate):
+    x = synthetic_recording(duration, rate)
+    print 'Gathering and writing spikes from {} s of 16 channel data ' \
+        '({} spikes/s per channel)'.format(duration, rate)
+    print '{:>10} {:>10} {:>10} {:>14}'.format('mode', 'spikes', 'time (s)',
+                                               'spikes/s')
+    for mode in ('per-spike', 'batched'):
+        n, t = benchmark(x, int(FS*10), mode == 'batched')
+        print '{:>10} {:>10} {:>10.2f} {:>14.0f}'.format(mode, n, t, n/t)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmark spike writing')
+    parser.add_argument('--duration', type=float, default=60,
+                        help='Duration of data (s)')
+    parser.add_argument('--rate', type=float, default=100,
+                        help='Firing rate on each channel (spikes/s)')
+    args = parser.parse_args()
+    main(args.duration, args.rate)
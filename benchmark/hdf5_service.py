@@ -0,0 +1,151 @@
+'''
+Measure the latency of acquisition writes to a HDF5 file while plots are
+concurrently reading from it, with the PyTables methods protected by a single
+global lock vs. routed through the HDF5 service (see cns.hdf5_service).
+
+A simulated engine thread generates a block of 16 channel data every poll
+period and appends it to a FileMultiChannel (the same path the
+samples_acquired callbacks use during an experiment).  Several plot threads
+repeatedly read randomly-positioned windows of the data already written.  The
+write latency is the time from the start of the append until the data has been
+written to the EArray.
+
+Usage: python benchmark/hdf5_service.py [--duration N] [--plots N] [--window N]
+'''
+
+import os
+import time
+import shutil
+import tempfile
+import threading
+import numpy as np
+import tables as tb
+
+from cns import hdf5_service
+from cns.channel import FileMultiChannel
+
+class SimulatedEngine(threading.Thread):
+    '''
+    Calls callback with a new block of data every poll_period seconds
+    '''
+
+    def __init__(self, callback, channels=16, fs=25e3, poll_period=0.01,
+                 duration=10):
+        threading.Thread.__init__(self)
+        self.callback = callback
+        self.channels = channels
+        self.samples = int(fs*poll_period)
+        self.poll_period = poll_period
+        self.n_blocks = int(duration/poll_period)
+
+    def run(self):
+        data = np.random.randn(self.channels, self.samples).astype(np.float32)
+        start = time.time()
+        for i in range(self.n_blocks):
+            self.callback(data)
+            delay = start+(i+1)*self.poll_period-time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+def install_lock():
+    '''
+    Wrap the PyTables methods in a single global lock (the approach used before
+    the HDF5 service).  Returns a function that restores the methods.
+    '''
+    lock = threading.Lock()
+    def secure_lock(f):
+        def wrapper(*args, **kwargs):
+            with lock:
+                return f(*args, **kwargs)
+        return wrapper
+    patches = []
+    for methods in (hdf5_service.WRITE_METHODS, hdf5_service.READ_METHODS):
+        for cls, names in methods:
+            for name in names:
+                f = getattr(cls, name, None)
+                if f is not None:
+                    patches.append((cls, name, f))
+    originals = [(cls, name, cls.__dict__.get(name)) for cls, name, f in
+                 patches]
+    for cls, name, f in patches:
+        setattr(cls, name, secure_lock(f))
+    def uninstall():
+        for cls, name, original in reversed(originals):
+            if original is None:
+                delattr(cls, name)
+            else:
+                setattr(cls, name, original)
+    return uninstall
+
+def stress(duration, n_plots, window):
+    tempdir = tempfile.mkdtemp()
+    fh = tb.open_file(os.path.join(tempdir, 'stress.h5'), 'w')
+    # Write every block to the EArray as it arrives (the worst case)
+    channel = FileMultiChannel(node=fh.root, name='raw', channels=16,
+                               fs=25e3, dtype=np.float32, flush_samples=1,
+                               compression_type='zlib', compression_level=1)
+    # Create the EArray before the threads start
+    channel.get_size()
+    latencies = []
+    def samples_acquired(data):
+        t = time.time()
+        channel.send(data)
+        latencies.append(time.time()-t)
+
+    done = threading.Event()
+    reads = [0]
+    def plot():
+        n = int(window*channel.fs)
+        while not done.is_set():
+            ub = channel.get_size()
+            if ub > n:
+                lb = np.random.randint(0, ub-n)
+                channel[:, lb:lb+n]
+                reads[0] += 1
+            else:
+                time.sleep(0.01)
+
+    engine = SimulatedEngine(samples_acquired, duration=duration)
+    plots = [threading.Thread(target=plot) for i in range(n_plots)]
+    for p in plots:
+        p.start()
+    engine.start()
+    engine.join()
+    done.set()
+    for p in plots:
+        p.join()
+    fh.close()
+    shutil.rmtree(tempdir)
+    return np.array(latencies), reads[0]
+
+def main(duration, n_plots, window):
+    print 'Writing {} s of 16 channel data while {} plots read {} s windows'\
+        .format(duration, n_plots, window)
+    print '{:>8} {:>8} {:>10} {:>10} {:>10}'.format('mode', 'reads',
+                                                    'p50 (ms)', 'p99 (ms)',
+                                                    'max (ms)')
+    for mode in ('lock', 'service'):
+        if mode == 'lock':
+            uninstall = install_lock()
+        else:
+            hdf5_service.install()
+            uninstall = hdf5_service.uninstall
+        try:
+            latencies, reads = stress(duration, n_plots, window)
+        finally:
+            uninstall()
+        p50, p99 = np.percentile(latencies, [50, 99])*1e3
+        print '{:>8} {:>8} {:>10.2f} {:>10.2f} {:>10.2f}'\
+            .format(mode, reads, p50, p99, latencies.max()*1e3)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmark HDF5 service')
+    parser.add_argument('--duration', type=float, default=10,
+                        help='Duration of data to write (s)')
+    parser.add_argument('--plots', type=int, default=4,
+                        help='Number of plots reading concurrently')
+    parser.add_argument('--window', type=float, default=2,
+                        help='Duration of each window read (s)')
+    args = parser.parse_args()
+    main(args.duration, args.plots, args.window)
@@ -0,0 +1,118 @@
+'''
+Compare the analysis functions with and without reading chunks ahead on a
+background thread (the prefetch argument, CHUNK_PREFETCH in the settings).
+
+The recording is synthetic 16 channel data with spikes, stored the way the raw
+data is stored during an experiment (LZO level 1 with shuffling) so each chunk
+has to be decompressed.  running_rms, decimate_waveform and extract_spikes
+process the raw data and compute_spectrogram processes the LFP saved by
+decimate_waveform.  Each analysis is run with prefetch=0 and prefetch=2 and the
+best of several runs is reported.  The chunk size is fixed so every analysis
+processes the data in several chunks.
+
+Usage: python benchmark/prefetch.py [--duration N] [--repeat N]
+'''
+
+import os
+import shutil
+import timeit
+import tempfile
+import multiprocessing
+import numpy as np
+import tables
+
+from cns import analysis
+from cns.channel import FileMultiChannel
+
+FS = 25e3
+CHUNK_SIZE = 4e6
+PROCESSING = dict(filter_freq_lp=6000, filter_freq_hp=300,
+                  filter_btype='bandpass', filter_order=4, bad_channels=[],
+                  diff_mode='all good')
+
+def create_recording(filename, duration, channels=16, seed=0):
+    state = np.random.RandomState(seed)
+    fh = tables.open_file(filename, 'w')
+    node = fh.create_group('/', 'experiment')
+    node = fh.create_group(node, 'data')
+    node = fh.create_group(node, 'physiology')
+    raw = FileMultiChannel(node=node, name='raw', channels=channels, fs=FS,
+                           dtype=np.float32, compression_type='lzo',
+                           compression_level=1, use_shuffle=True)
+    waveform = -np.exp(-np.arange(-16, 32)**2/40.0)*8
+    for i in range(int(duration)):
+        x = state.normal(size=(channels, int(FS))).astype(np.float32)
+        for j in range(channels):
+            for t in state.randint(16, int(FS)-32, 20):
+                x[j, t-16:t+32] += waveform
+        raw.send(x)
+    raw.flush()
+    fh.close()
+
+def benchmark(tempdir, function, repeat):
+    filename = os.path.join(tempdir, 'output.h5')
+
+    def run():
+        fh_out = tables.open_file(filename, 'w')
+        try:
+            function(fh_out.root)
+        finally:
+            fh_out.close()
+    return min(timeit.repeat(run, number=1, repeat=repeat))
+
+def main(duration, repeat):
+    tempdir = tempfile.mkdtemp()
+    try:
+        raw_filename = os.path.join(tempdir, 'raw.h5')
+        lfp_filename = os.path.join(tempdir, 'lfp.h5')
+        create_recording(raw_filename, duration)
+        fh_in = tables.open_file(raw_filename, 'r')
+        node = fh_in.root.experiment
+        fh_lfp = tables.open_file(lfp_filename, 'w')
+        analysis.decimate_waveform(node, fh_lfp.root, filter_method='sos',
+                                   include_block_data=False)
+        lfp = fh_lfp.root.lfp
+        channels = range(16)
+
+        tests = [
+            ('running_rms', lambda root, prefetch: analysis.running_rms(
+                node, root, 1, 0.25, PROCESSING, algorithm='median',
+                chunk_size=CHUNK_SIZE, prefetch=prefetch)),
+            ('decimate_waveform', lambda root, prefetch:
+                analysis.decimate_waveform(
+                    node, root, filter_method='sos', chunk_size=CHUNK_SIZE,
+                    include_block_data=False, prefetch=prefetch)),
+            ('extract_spikes', lambda root, prefetch: analysis.extract_spikes(
+                node, root, channels, np.ones(16), -4*np.ones(16),
+                20*np.ones(16), PROCESSING, chunk_size=CHUNK_SIZE,
+                include_block_data=False, prefetch=prefetch)),
+            ('compute_spectrogram', lambda root, prefetch:
+                analysis.compute_spectrogram(
+                    lfp, root, [16, 32, 64, 128], chunk_size=CHUNK_SIZE/64,
+                    include_block_data=False, output='power',
+                    prefetch=prefetch)),
+        ]
+
+        print '{} s of 16 channel data, {} CPUs, best of {}'\
+            .format(duration, multiprocessing.cpu_count(), repeat)
+        print '{:>20} {:>14} {:>14} {:>8}'.format('analysis', 'prefetch=0 (s)',
+                                                  'prefetch=2 (s)', 'speedup')
+        for name, function in tests:
+            t = [benchmark(tempdir, lambda root: function(root, prefetch),
+                           repeat) for prefetch in (0, 2)]
+            print '{:>20} {:>14.2f} {:>14.2f} {:>8.2f}'\
+                .format(name, t[0], t[1], t[0]/t[1])
+        fh_lfp.close()
+        fh_in.close()
+    finally:
+        shutil.rmtree(tempdir)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmark chunk prefetch')
+    parser.add_argument('--duration', type=float, default=60,
+                        help='Duration of data (s)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Number of runs of each analysis')
+    args = parser.parse_args()
+    main(args.duration, args.repeat)
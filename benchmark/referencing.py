@@ -0,0 +1,50 @@
+'''
+Compare the cost of referencing multichannel data using the differential matrix
+(a channels x channels matrix product) against the mean subtraction used by
+ProcessedMultiChannel.
+
+Usage: python benchmark/referencing.py [--samples N] [--repeat N]
+'''
+
+import timeit
+import numpy as np
+
+from cns.channel import ProcessedMultiChannel
+
+def benchmark(n_channels, n_samples, repeat):
+    bad_channels = [0, n_channels//2]
+    channel = ProcessedMultiChannel(channels=n_channels,
+                                    bad_channels=bad_channels, fs=25e3)
+    data = np.random.randn(n_channels, n_samples).astype(np.float32)
+    matrix = channel.diff_matrix
+
+    # Make sure both approaches agree before timing them
+    expected = matrix.dot(data)
+    actual = channel._reference(data)
+    if not np.allclose(expected, actual):
+        raise ValueError('Referencing methods do not agree')
+
+    t_matrix = min(timeit.repeat(lambda: matrix.dot(data), number=1,
+                                 repeat=repeat))
+    t_mean = min(timeit.repeat(lambda: channel._reference(data), number=1,
+                               repeat=repeat))
+    return t_matrix, t_mean
+
+def main(n_samples, repeat):
+    print 'Referencing {} samples per channel'.format(n_samples)
+    print '{:>8} {:>12} {:>12} {:>8}'.format('channels', 'matrix (s)',
+                                             'mean (s)', 'speedup')
+    for n_channels in (16, 64, 256):
+        t_matrix, t_mean = benchmark(n_channels, n_samples, repeat)
+        print '{:>8} {:>12.4f} {:>12.4f} {:>8.1f}'.format(n_channels, t_matrix,
+                                                          t_mean,
+                                                          t_matrix/t_mean)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmark referencing')
+    parser.add_argument('--samples', type=int, default=250000,
+                        help='Samples per channel (default is 10 s at 25 kHz)')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    main(args.samples, args.repeat)
@@ -0,0 +1,75 @@
+'''
+Compare the exact running median estimate of the noise floor (the median of
+each overlapping window, as computed by cns.analysis.running_rms with
+tolerance=None) with the streaming estimate (cns.sigtools.running_median_std)
+at several tolerances.
+
+The signal is synthetic Gaussian noise whose amplitude drifts slowly, with a
+few large artifacts, sampled at 31250 Hz.  The windows are 1 s long and slide in
+0.25 s steps (the settings used by scripts/add_rms_to_extracted.py), so the
+window and step (31250 and 7812 samples) share no large common factor.
+Throughput is reported in channel-hours of data processed per second and the
+error is relative to the exact median.  The peak memory used by the process is
+reported at the end.
+
+Usage: python benchmark/running_rms.py [--duration N] [--channels N]
+'''
+
+import timeit
+import resource
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+from cns.sigtools import running_median_std
+
+FS = 31250.0
+
+def synthetic_recording(duration, channels, seed=0):
+    state = np.random.RandomState(seed)
+    n = int(duration*FS)
+    drift = 1+0.5*np.sin(np.linspace(0, 2*np.pi, n))
+    x = state.normal(scale=20e-6, size=(channels, n))*drift
+    for i in state.randint(0, n-int(FS), 5):
+        x[:, i:i+int(FS*0.1)] *= 100
+    return x
+
+def exact_median_std(x, window_samples, window_step):
+    n = (x.shape[-1]-window_samples)//window_step+1
+    ch_stride, s_stride = x.strides
+    windows = as_strided(x, (x.shape[0], n, window_samples),
+                         (ch_stride, window_step*s_stride, s_stride))
+    return np.median(np.abs(windows)/0.6745, axis=-1)
+
+def main(duration, channels):
+    x = synthetic_recording(duration, channels)
+    window_samples, window_step = int(FS), int(FS*0.25)
+    channel_hours = channels*duration/3600.0
+    print 'Running median of {} s of {} channel data (1 s window, 0.25 s step)'\
+        .format(duration, channels)
+    print '{:>10} {:>10} {:>16} {:>14}'.format('tolerance', 'time (s)',
+                                               'channel-hours/s', 'max error')
+    f = lambda: exact_median_std(x, window_samples, window_step)
+    t = min(timeit.repeat(f, number=1, repeat=3))
+    exact = f()
+    print '{:>10} {:>10.2f} {:>16.2f} {:>14}'.format('exact', t,
+                                                     channel_hours/t, '-')
+    for tolerance in (0.05, 0.01, 0.001):
+        f = lambda: running_median_std(x, window_samples, window_step,
+                                       tolerance=tolerance)
+        t = min(timeit.repeat(f, number=1, repeat=3))
+        error = np.max(np.abs(f()-exact)/exact)
+        print '{:>10} {:>10.2f} {:>16.2f} {:>14.2e}'.format(tolerance, t,
+                                                            channel_hours/t,
+                                                            error)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0
+    print 'Peak memory {:.0f} MB'.format(peak)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmark running median')
+    parser.add_argument('--duration', type=float, default=60,
+                        help='Duration of data (s)')
+    parser.add_argument('--channels', type=int, default=16,
+                        help='Number of channels')
+    args = parser.parse_args()
+    main(args.duration, args.channels)
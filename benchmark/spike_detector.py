@@ -0,0 +1,56 @@
+'''
+Measure the time cns.spike_detector.SpikeDetector takes to process each block
+of data as it is acquired, for several channel counts.
+
+The signal is synthetic Gaussian noise with a spike every 10 ms on each
+channel, sampled at 25 kHz.  Blocks of --block ms are sent to the detector as
+fast as possible (i.e. without waiting for acquisition) and the latency is
+reported as a fraction of the block duration (the default latency budget).
+
+Usage: python benchmark/spike_detector.py [--block N] [--duration N]
+'''
+
+import numpy as np
+
+from cns.spike_detector import SpikeDetector
+
+FS = 25e3
+
+class NullTarget(object):
+
+    def send(self, *args):
+        pass
+
+def synthetic_recording(duration, channels, seed=0):
+    state = np.random.RandomState(seed)
+    x = state.normal(scale=20e-6, size=(channels, int(duration*FS)))
+    x[:, ::int(FS*0.01)] -= 200e-6
+    return x.astype(np.float32)
+
+def main(block, duration):
+    block_samples = int(block*1e-3*FS)
+    print 'Latency processing {} ms blocks of 25 kHz data'.format(block)
+    print '{:>10} {:>12} {:>12} {:>12} {:>10}'.format('channels', 'median (ms)',
+                                                      '99% (ms)', 'max (ms)',
+                                                      'load')
+    for channels in (16, 32, 64, 128):
+        x = synthetic_recording(duration, channels)
+        targets = [NullTarget() for i in range(channels)]
+        detector = SpikeDetector(FS, -np.ones(channels)*100e-6,
+                                 targets=targets, processed=NullTarget())
+        for i in range(0, x.shape[-1]-block_samples+1, block_samples):
+            detector.send(x[:, i:i+block_samples])
+        latency = np.array(detector.latency)*1e3
+        print '{:>10} {:>12.2f} {:>12.2f} {:>12.2f} {:>10.1%}'.format(channels,
+            np.median(latency), np.percentile(latency, 99), latency.max(),
+            np.median(latency)/block)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmark spike detection')
+    parser.add_argument('--block', type=float, default=10,
+                        help='Duration of each block (ms)')
+    parser.add_argument('--duration', type=float, default=10,
+                        help='Duration of data (s)')
+    args = parser.parse_args()
+    main(args.block, args.duration)
@@ -1,20 +1,29 @@
 from __future__ import division
 
+import re
 import time
+import multiprocessing
 import tables
 import numpy as np
 from numpy.lib.stride_tricks import as_strided
-from scipy import signal
+from scipy import signal, fftpack
 from os import path
 import uuid
 
 from .channel import ProcessedFileMultiChannel
-from .arraytools import chunk_samples, chunk_iter
+from .arraytools import (chunk_samples, plan_chunk_samples, chunk_iter,
+                         slice_overlap, gather_windows, memory_budget)
+from .sigtools import (iirfilter_sos, sosfiltfilt, firfilter_decimate,
+                       polyphase_decimate, running_median_std, filter_padding)
 from . import get_config
+from . import hdf5_service
+from .checkpoint import Checkpoint, fingerprint, has_checkpoint
 from .io import copy_block_data
 from mne.time_frequency import tfr
 
 default_chunk_size = get_config('CHUNK_SIZE')
+default_prefetch = get_config('CHUNK_PREFETCH')
+default_memory_budget = get_config('MEMORY_BUDGET')
 
 import logging
 log = logging.getLogger(__name__)
@@ -108,6 +117,42 @@ def truncate_waveform(input_node, duration):
         if 'truncate:original_size' not in node._v_attrs:
             node._v_attrs['truncate:original_size'] = old_size
 
+def _prefetch_scope(iterable, prefetch):
+    # PyTables is not thread-safe.  When chunks are read ahead on a background
+    # thread, the writes made while processing each chunk must be serialized
+    # with the reads, so HDF5 access is routed through the HDF5 service while
+    # the chunks are read.  The service patches PyTables for the entire
+    # process and adds latency to every call, so it is removed once the
+    # iterable is exhausted or closed (installs are reference counted, so it
+    # stays installed if the experiment or another analysis is using it).
+    if not prefetch:
+        for item in iterable:
+            yield item
+        return
+    hdf5_service.install()
+    try:
+        for item in iterable:
+            yield item
+    finally:
+        # Stop the background thread before removing the service
+        iterable.close()
+        hdf5_service.uninstall()
+
+def _plan_chunk(x, chunk_size, chain, block_size=None, resident=1, **kwargs):
+    # If a chunk size (in bytes) is specified, it overrides the memory budget.
+    # Otherwise, the budget is shared by the chunks that are resident at the
+    # same time (e.g. one per worker process).  Either way, the chunk is never
+    # longer than needed to process the entire array in a single chunk.
+    if chunk_size is not None:
+        step = 1 if block_size is None else block_size
+        n = max(int(np.ceil(x.shape[-1]/step))*step, step)
+        return min(chunk_samples(x, chunk_size, block_size), n)
+    budget = default_memory_budget
+    if budget is None:
+        budget = memory_budget()
+    return plan_chunk_samples(x, chain, budget/resident,
+                              block_size=block_size, **kwargs)
+
 def median_std(x, axis=-1):
     '''
     Given a multichannel array, compute the standard deviation of the signal
@@ -119,9 +164,43 @@ def median_std(x, axis=-1):
     '''
     return np.median(np.abs(x)/0.6745, axis=axis)
 
+class RunningCovariance(object):
+    '''
+    Accumulates the covariance of the columns (variables) of batches of
+    observations (rows) without keeping the observations in memory.  Batches
+    are merged using the pairwise update described by Chan, Golub and LeVeque
+    (1979) which is numerically stable.  The result is equivalent to
+    np.cov(np.concatenate(batches).T).
+    '''
+
+    def __init__(self, n_variables):
+        self.n = 0
+        self.mean = np.zeros(n_variables)
+        self._m2 = np.zeros((n_variables, n_variables))
+
+    def update(self, x):
+        x = np.asarray(x, dtype=np.float64)
+        n = len(x)
+        if n == 0:
+            return
+        mean = x.mean(axis=0)
+        deviation = x-mean
+        delta = mean-self.mean
+        total = self.n+n
+        self._m2 += np.dot(deviation.T, deviation)
+        self._m2 += np.outer(delta, delta)*self.n*n/total
+        self.mean += delta*n/total
+        self.n = total
+
+    def covariance(self):
+        if self.n < 2:
+            return np.ones(self._m2.shape)*np.nan
+        return self._m2/(self.n-1)
+
 def running_rms(input_node, output_node, duration, step, processing,
                 algorithm='mean', channels=None, progress_callback=None,
-                chunk_size=default_chunk_size):
+                chunk_size=default_chunk_size, prefetch=default_prefetch,
+                tolerance=0.01, checkpoint_interval=None, sidecar=None):
     '''
     Compute the running RMS value of the noise floor using a sliding window
 
@@ -169,13 +248,36 @@ def running_rms(input_node, output_node, duration, step, processing,
         each chunk is processed, the function will be called with updates to the
         progress.  If the function returns a nonzero (True) value, the
         processing will terminate.
+    prefetch : int
+        Number of chunks to read ahead while the current chunk is processed
+        (see `cns.arraytools.chunk_iter`).  If nonzero, all HDF5 access is
+        routed through `cns.hdf5_service` while the chunks are read so the
+        reads are thread-safe.
+    tolerance : { None, float }
+        If the algorithm is 'median', estimate the median of each window from
+        histograms that are shared by the overlapping windows (see
+        `cns.sigtools.running_median_std`).  The estimate is within tolerance
+        (relative) of the exact value.  If None, the exact median of each
+        window is computed (much slower since each sample is sorted once for
+        every window it falls in).
+    checkpoint_interval : { None, float }
+        Save a checkpoint at most every checkpoint_interval seconds so the
+        analysis can be resumed if it is interrupted (see `cns.checkpoint`).
+        If output_node contains a checkpoint, the analysis is resumed from it
+        (the parameters must be the same).
+    sidecar : { None, instance of tables.Group }
+        Root of the sidecar file containing preprocessed copies of the data
+        (see `preprocess_waveform` and `open_sidecar`).  If it contains a copy
+        processed with the same settings, the data is read from the copy rather
+        than referenced and filtered again.
     '''
     # Make a dummy progress callback if none is requested
     if progress_callback is None:
         progress_callback = lambda x, y, z: False
     raw_node = input_node.data.physiology.raw
 
-    channel = ProcessedFileMultiChannel.from_node(raw_node, **processing)
+    channel = ProcessedFileMultiChannel.from_node(raw_node, sidecar=sidecar,
+                                                  **processing)
 
     if channels is None:
         n_channels = raw_node.shape[0]
@@ -214,7 +316,26 @@ def running_rms(input_node, output_node, duration, step, processing,
     # The above diagram illustrates a schematic of how the sliding window will
     # work.  The first row is our data chunk.  The rows below indicate the
     # windows (the number indicates the order the windows are pulled out).
-    c_samples = chunk_samples(raw_node, chunk_size)
+    # Each chunk is filtered (float64) and then squared or rectified (float64)
+    # to compute the RMS.  The streaming median instead holds a float32 copy of
+    # the chunk along with the bit pattern and histogram bin of each sample
+    # (int32).  The histograms themselves are computed a batch of windows at a
+    # time and take a fixed amount of memory (see MEDIAN_STD_MAX_BINS).
+    if algorithm == 'median' and tolerance is not None:
+        chain = [np.float64, np.float32, np.int32, np.int32]
+    else:
+        chain = [np.float64, np.float64]
+    c_samples = _plan_chunk(raw_node, chunk_size, chain, prefetch=prefetch)
+
+    # A resumed analysis must use the same chunks as the interrupted one
+    source = (path.basename(input_node._v_file.filename),
+              raw_node._v_pathname, raw_node.shape)
+    parameters = dict(source=source, duration=duration, step=step,
+                      processing=processing, algorithm=algorithm,
+                      channels=channels, tolerance=tolerance,
+                      preprocessed=channel._sidecar_array is not None)
+    checkpoint = Checkpoint(output_node, parameters, checkpoint_interval)
+    c_samples = checkpoint.state.get('c_samples', c_samples)
     window_n = np.floor((c_samples-window_samples)/window_step) + 1
     c_samples = window_n*window_step + (window_samples-window_step)
     c_samples = int(c_samples)
@@ -240,9 +361,9 @@ def running_rms(input_node, output_node, duration, step, processing,
     # Create the output data node
     fh_out = output_node._v_file
     filters = tables.Filters(complevel=1, complib='zlib', fletcher32=True)
-    rms = fh_out.createEArray(output_node, 'rms', raw_node.atom,
-                              (n_channels, 0), filters=filters,
-                              title='Running RMS of signal')
+    rms = checkpoint.create(fh_out.createEArray, output_node, 'rms',
+                            raw_node.atom, (n_channels, 0), filters=filters,
+                            title='Running RMS of signal')
 
     # Save some data about how the RMS was computed
     if channels is None:
@@ -259,11 +380,14 @@ def running_rms(input_node, output_node, duration, step, processing,
     rms._v_attrs['chunk_loverlap'] = c_loverlap
     rms._v_attrs['new_shape'] = new_shape
     rms._v_attrs['algorithm'] = algorithm
+    if algorithm == 'median' and tolerance is not None:
+        rms._v_attrs['tolerance'] = tolerance
 
     rms._v_attrs['fc_lowpass'] = channel.filter_freq_lp
     rms._v_attrs['fc_highpass'] = channel.filter_freq_hp
     rms._v_attrs['filter_order'] = channel.filter_order
     rms._v_attrs['filter_btype'] = channel.filter_btype
+    rms._v_attrs['filter_method'] = channel.filter_method
     rms._v_attrs['filter_padding'] = channel._padding
 
     rms._v_attrs['diff_mode'] = channel.diff_mode
@@ -279,8 +403,11 @@ def running_rms(input_node, output_node, duration, step, processing,
     rms._v_attrs['channels'] = n_channels
     rms._v_attrs['t0'] = 0
 
+    streaming = False
     if algorithm == 'mean':
         compute_rms = lambda x: np.mean(x**2, axis=-1)**0.5
+    elif algorithm == 'median' and tolerance is not None:
+        streaming = True
     elif algorithm == 'median':
         compute_rms = median_std
     else:
@@ -302,12 +429,15 @@ def running_rms(input_node, output_node, duration, step, processing,
         # adding an extra dimension to the data.
         iterable = chunk_iter(channel, c_samples,
                               step_samples=c_samples-c_loverlap,
-                              ndslice=np.s_[channels, :])
+                              ndslice=np.s_[channels, :], prefetch=prefetch,
+                              skip=checkpoint.chunk)
     else:
         iterable = chunk_iter(channel, c_samples,
-                              step_samples=c_samples-c_loverlap)
+                              step_samples=c_samples-c_loverlap,
+                              prefetch=prefetch, skip=checkpoint.chunk)
     aborted = False
-    for i_chunk, chunk in enumerate(iterable):
+    iterable = _prefetch_scope(iterable, prefetch)
+    for i_chunk, chunk in enumerate(iterable, checkpoint.chunk):
         if chunk.shape[-1] != c_samples:
             # We need to update the shape to handle the very last chunk
             n_samples = chunk.shape[-1]
@@ -318,32 +448,46 @@ def running_rms(input_node, output_node, duration, step, processing,
             rms._v_attrs['samples_discarded'] = discarded
             print 'Discarding last {} samples from last chunk'.format(discarded)
 
-        # We need to load the stride information from the chunk.  Although we
-        # could guess the information in advance based on our knowledge of the
-        # underlying dtype, I find that there are sometimes edge cases that I am
-        # not aware of.  It's better to just ask the chunk what it's memory
-        # layout is and use that information.
-        ch_stride, s_stride = chunk.strides
-        strides = ch_stride, window_step*s_stride, s_stride
-
-        chunk = as_strided(chunk, new_shape, strides) # <- the optimization
-        rms.append(compute_rms(chunk))
-
+        if streaming:
+            rms.append(running_median_std(chunk, window_samples, window_step,
+                                          int(new_shape[1]), tolerance))
+        else:
+            # We need to load the stride information from the chunk.  Although
+            # we could guess the information in advance based on our knowledge
+            # of the underlying dtype, I find that there are sometimes edge
+            # cases that I am not aware of.  It's better to just ask the chunk
+            # what it's memory layout is and use that information.
+            ch_stride, s_stride = chunk.strides
+            strides = ch_stride, window_step*s_stride, s_stride
+
+            chunk = as_strided(chunk, new_shape, strides) # <- the optimization
+            rms.append(compute_rms(chunk))
+
+        checkpoint.update(i_chunk+1, c_samples=c_samples)
         if progress_callback(i_chunk*c_samples, total_samples, ''):
             aborted = True
             break
 
+    # Save the progress so the remaining chunks can be processed later
+    if aborted and checkpoint.enabled:
+        checkpoint.save(i_chunk+1, c_samples=c_samples)
+    elif not aborted:
+        checkpoint.complete()
     rms._v_attrs['aborted'] = aborted
 
 def decimate_waveform(input_node, output_node, q=None, dec_fs=600.0, N=4,
                       progress_callback=None, chunk_size=default_chunk_size,
-                      include_block_data=True):
+                      include_block_data=True, filter_method='ba',
+                      prefetch=default_prefetch, taps_per_phase=10,
+                      zero_phase=True, checkpoint_interval=None):
     '''
     Decimates the waveform data to a lower sampling frequency using a lowpass
     filter cutoff.
 
-    A 4th order lowpass butterworth filter is used in conjunction with filtfilt
-    to apply a zero phase-delay to the waveform.
+    By default, a 4th order lowpass butterworth filter is used in conjunction
+    with filtfilt to apply a zero phase-delay to the waveform.  Alternatively, a
+    linear-phase FIR filter can be applied using a polyphase decimator, which
+    only computes the samples that are retained.
 
     This code is carefully designed to handle boundary issues when processing
     large datasets in chunks (e.g. stabilizing the edges of each chunk when
@@ -375,14 +519,49 @@ def decimate_waveform(input_node, output_node, q=None, dec_fs=600.0, N=4,
         each chunk is processed, the function will be called with updates to the
         progress.  If the function returns a nonzero (True) value, the
         processing will terminate.
-    chunk_size : float
-        Maximum memory size (in bytes) each chunk should occupy
+    chunk_size : { None, float }
+        Maximum memory size (in bytes) each chunk should occupy.  If None, the
+        chunk size is planned from the MEMORY_BUDGET setting (see
+        `cns.arraytools.plan_chunk_samples`).
     include_block_data : boolean
         Copy the information regarding blocks occuring in the experiment (e.g.
         trial timestamps, poke timestamps, trial log, etc.) decimated node file
         as well.  This is useful for creating a smaller, more compact datafile
         that you can carry around with you rather than the raw multi-gigabyte
         physiology data.
+    filter_method : {'ba', 'sos', 'fir'}
+        Apply the lowpass filter using the transfer function coefficients
+        ('ba') or second-order sections ('sos').  Second-order sections are
+        numerically stable at higher filter orders.  With 'ba', chunks overlap
+        by 3*(N+1) samples (as they always have, so existing results are
+        reproduced).  With 'sos', chunks overlap by the length of the impulse
+        response of the filter (see `cns.sigtools.filter_padding`) so the
+        output does not depend on the chunk size.  If 'fir', a windowed linear-phase FIR filter (see
+        `cns.sigtools.firfilter_decimate`) is applied by a polyphase decimator
+        instead (N is ignored).  The IIR filters are applied at the full
+        sampling rate and then subsampled, so most of the filtered samples are
+        discarded.  The polyphase decimator only computes the samples that are
+        retained.  Chunks overlap by exactly the length of the filter, so the
+        output is identical to decimating the entire signal at once.
+    prefetch : int
+        Number of chunks to read ahead while the current chunk is processed
+        (see `cns.arraytools.chunk_iter`).  If nonzero, all HDF5 access is
+        routed through `cns.hdf5_service` while the chunks are read so the
+        reads are thread-safe.
+    taps_per_phase : int
+        Length of the FIR filter (2*taps_per_phase*q+1 taps) when filter_method
+        is 'fir'.  Longer filters have a sharper cutoff.
+    zero_phase : boolean
+        If True, compensate for the group delay of the FIR filter so the output
+        is aligned with the input (i.e. zero phase-delay, as with filtfilt).  If
+        False, the FIR filter is causal and the output is delayed by
+        taps_per_phase samples of the decimated signal (this is what an online
+        filter would produce).  The IIR filters are always zero-phase.
+    checkpoint_interval : { None, float }
+        Save a checkpoint at most every checkpoint_interval seconds so the
+        analysis can be resumed if it is interrupted (see `cns.checkpoint`).
+        If output_node contains a checkpoint, the analysis is resumed from it
+        (the parameters must be the same).
     '''
     # Make a dummy progress callback if none is requested
     if progress_callback is None:
@@ -393,16 +572,22 @@ def decimate_waveform(input_node, output_node, q=None, dec_fs=600.0, N=4,
     raw = input_node.data.physiology.raw
     source_fs = raw._v_attrs['fs']
     if q is None:
-        q = np.floor(source_fs/dec_fs)
+        q = int(np.floor(source_fs/dec_fs))
     target_fs = source_fs/q
 
     n_channels, n_samples = raw.shape
 
+    source = (path.basename(input_node._v_file.filename), raw._v_pathname,
+              raw.shape)
+    parameters = dict(source=source, q=q, N=N, filter_method=filter_method,
+                      taps_per_phase=taps_per_phase, zero_phase=zero_phase)
+    checkpoint = Checkpoint(output_node, parameters, checkpoint_interval)
+
     fh_out = output_node._v_file
     filters = tables.Filters(complevel=1, complib='zlib', fletcher32=True)
-    lfp = fh_out.createEArray(output_node, 'lfp', raw.atom,
-                              (n_channels, 0), filters=filters,
-                              title="Lowpass filtered signal for LFP analysis")
+    lfp = checkpoint.create(fh_out.createEArray, output_node, 'lfp', raw.atom,
+                            (n_channels, 0), filters=filters,
+                            title="Lowpass filtered signal for LFP analysis")
 
     # Critical frequency of the lowpass filter (ensure that the filter cutoff is
     # half the target sampling frequency to avoid aliasing).
@@ -413,29 +598,84 @@ def decimate_waveform(input_node, output_node, q=None, dec_fs=600.0, N=4,
     b = b.astype(raw.dtype)
     a = a.astype(raw.dtype)
 
+    if filter_method == 'sos':
+        # The lowpass cutoff is a small fraction of the sampling rate, so the
+        # impulse response is much longer than the filter order.
+        sos, zi = iirfilter_sos(N, Wn, btype='lowpass')
+        overlap = max(3*len(b), filter_padding(sos))
+        filt = lambda x: sosfiltfilt(sos, x, zi)
+    elif filter_method == 'ba':
+        overlap = 3*len(b)
+        filt = lambda x: signal.filtfilt(b, a, x, padlen=0)
+    elif filter_method == 'fir':
+        b = firfilter_decimate(q, taps_per_phase)
+        a = np.ones(1)
+        # Output sample k of each chunk is centered on (or, if causal, ends
+        # with) sample k*q of the chunk.  The left overlap provides the filter
+        # history and the right overlap the samples after the center.
+        delay = taps_per_phase*q if zero_phase else 0
+        loverlap = len(b)-1-delay
+        roverlap = delay
+    else:
+        raise ValueError, 'Unknown filter method "{}"'.format(filter_method)
+
+    if filter_method != 'fir':
+        loverlap = roverlap = overlap
+
     # The number of samples in each chunk *must* be a multiple of the decimation
     # factor so that we can extract the *correct* samples from each chunk.
-    c_samples = chunk_samples(raw, chunk_size, q)
-    overlap = 3*len(b)
-    iterable = chunk_iter(raw, chunk_samples=c_samples, loverlap=overlap,
-                          roverlap=overlap)
-
-    for i, chunk in enumerate(iterable):
-        chunk = signal.filtfilt(b, a, chunk, padlen=0).astype(raw.dtype)
-        chunk = chunk[:, overlap:-overlap:q]
+    # filtfilt holds the padded input, forward and backward passes (float64)
+    # while the polyphase decimator only holds the input.
+    if filter_method == 'fir':
+        chain = [np.float64]
+    else:
+        chain = [np.float64]*3
+    c_samples = _plan_chunk(raw, chunk_size, chain, q,
+                            overlap=loverlap+roverlap, prefetch=prefetch)
+    c_samples = checkpoint.state.get('c_samples', c_samples)
+    iterable = chunk_iter(raw, chunk_samples=c_samples, loverlap=loverlap,
+                          roverlap=roverlap, prefetch=prefetch,
+                          skip=checkpoint.chunk)
+
+    aborted = False
+    iterable = _prefetch_scope(iterable, prefetch)
+    for i, chunk in enumerate(iterable, checkpoint.chunk):
+        if filter_method == 'fir':
+            # The final chunk may be shorter than c_samples
+            n = chunk.shape[-1]-loverlap-roverlap
+            chunk = polyphase_decimate(b, chunk, q, start=len(b)-1)
+            chunk = chunk[:, :int(np.ceil(n/q))].astype(raw.dtype)
+        else:
+            chunk = filt(chunk).astype(raw.dtype)
+            chunk = chunk[:, overlap:-overlap:q]
         lfp.append(chunk)
+        checkpoint.update(i+1, c_samples=c_samples)
         if progress_callback(i*c_samples, n_samples, ''):
+            aborted = True
             break
 
+    # Save the progress so the remaining chunks can be processed later
+    if aborted and checkpoint.enabled:
+        checkpoint.save(i+1, c_samples=c_samples)
+
     # Save some data about how the lfp data was generated
     lfp._v_attrs['q'] = q
     lfp._v_attrs['fs'] = target_fs
     lfp._v_attrs['b'] = b
     lfp._v_attrs['a'] = a
-    lfp._v_attrs['chunk_overlap'] = overlap
-    lfp._v_attrs['ftype'] = 'butter'
+    lfp._v_attrs['filter_method'] = filter_method
+    if filter_method == 'sos':
+        lfp._v_attrs['sos'] = sos
+    if filter_method == 'fir':
+        lfp._v_attrs['chunk_overlap'] = (loverlap, roverlap)
+        lfp._v_attrs['ftype'] = 'fir'
+        lfp._v_attrs['order'] = len(b)-1
+        lfp._v_attrs['zero_phase'] = zero_phase
+    else:
+        lfp._v_attrs['chunk_overlap'] = overlap
+        lfp._v_attrs['ftype'] = 'butter'
+        lfp._v_attrs['order'] = N
     lfp._v_attrs['btype'] = 'lowpass'
-    lfp._v_attrs['order'] = N
     lfp._v_attrs['freq_lowpass'] = target_fs*0.5
 
     # Save some information about where we obtained the raw data from
@@ -447,10 +687,336 @@ def decimate_waveform(input_node, output_node, q=None, dec_fs=600.0, N=4,
         block_node = output_node._v_file.createGroup(output_node, 'block_data')
         copy_block_data(input_node, block_node)
 
+    if not aborted:
+        checkpoint.complete()
+
+# The int16 sidecar spans +/- PREPROCESS_HEADROOM times the noise floor of each
+# channel.  With 16 bits, the quantization step is 0.03 times the noise floor
+# (an RMS error of less than 1% of the noise floor) and only artifacts larger
+# than ~1000 times the noise floor are clipped.
+PREPROCESS_HEADROOM = 1000
+
+def sidecar_filename(filename):
+    '''
+    Return the name of the sidecar file holding the preprocessed data for the
+    raw data file
+
+    >>> sidecar_filename('data/ferret_raw.hd5')
+    'data/ferret_preprocessed.hd5'
+    >>> sidecar_filename('data/ferret.h5')
+    'data/ferret_preprocessed.h5'
+    '''
+    return re.sub(r'(.*?)(_raw)?\.(h5|hd5|hdf5)$', r'\1_preprocessed.\3',
+                  filename)
+
+def _source_fingerprint(input_node):
+    # Identifies the raw data the sidecar was generated from (the sidecar is
+    # found using the name of the raw data file, so the fingerprint does not
+    # depend on the name).  Truncating the raw data changes the shape and
+    # zeroing it out records the number of samples zeroed, so the sidecar is
+    # not used once the raw data has been modified by either of these.
+    raw = input_node.data.physiology.raw
+    zeroed = raw._v_attrs['zero:samples'] if 'zero:samples' in raw._v_attrs \
+        else 0
+    return fingerprint(dict(source_pathname=raw._v_pathname, shape=raw.shape,
+                            zeroed=zeroed))
+
+def open_sidecar(input_node):
+    '''
+    Open the sidecar file containing the data preprocessed by
+    `preprocess_waveform` for the experiment (input_node) and return the root
+    node (pass this to the analysis functions as the sidecar argument).  The
+    file is opened read-only.
+
+    Returns None if there is no sidecar file or the raw data has been modified
+    (e.g. truncated) since the sidecar was generated.
+    '''
+    filename = sidecar_filename(input_node._v_file.filename)
+    if not path.exists(filename):
+        return None
+    fh = tables.openFile(filename, 'r')
+    attrs = fh.root._v_attrs
+    if 'source_fingerprint' not in attrs or \
+            attrs['source_fingerprint'] != _source_fingerprint(input_node):
+        log.warn('Ignoring %s since it was generated from different data',
+                 filename)
+        fh.close()
+        return None
+    return fh.root
+
+def _noise_floor(channel, blocks=10, duration=1.0):
+    # Estimate the noise floor of each channel from evenly-spaced blocks of the
+    # processed data
+    n = min(int(duration*channel.fs), channel.n_samples)
+    starts = np.linspace(0, channel.n_samples-n, blocks).astype(np.int)
+    return np.median([median_std(channel[..., s:s+n]) for s in starts],
+                     axis=0)
+
+def preprocess_waveform(input_node, output_node, processing, dtype='int16',
+                        scale=None, hdf5_chunk_samples=2**14,
+                        hdf5_chunk_channels=4, progress_callback=None,
+                        chunk_size=default_chunk_size,
+                        prefetch=default_prefetch, checkpoint_interval=None):
+    '''
+    Saves a copy of the referenced and filtered data so it does not have to be
+    processed again each time it is analyzed
+
+    The data is saved to output_node (the root of the sidecar file, see
+    `sidecar_filename`) in a group named after a fingerprint of the processing
+    settings.  Several copies processed with different settings can be saved
+    to the same sidecar.  When the sidecar is passed to `running_rms`,
+    `extract_spikes` or `sweep_thresholds` (or set as the sidecar of a
+    ProcessedFileMultiChannel), the data is read from the copy processed with
+    the requested settings.  If there is no such copy, the data is processed
+    as usual.
+
+    Parameters
+    ----------
+    input_node : instance of tables.Group
+        The PyTables group pointing to the root of the experiment node.  The
+        physiology data will be found under input_node/data/physiology/raw.
+    output_node : instance of tables.Group
+        Root of the sidecar file
+    processing : dict
+        Referencing and filtering settings (see `running_rms`)
+    dtype : {'int16', 'float16', 'float32'}
+        Type to store the data as.  Each channel is divided by a scaling
+        factor (saved in the scale attribute) before it is converted.  For
+        int16, the scaling factor maps PREPROCESS_HEADROOM times the noise
+        floor of the channel to the largest integer (larger values are
+        clipped).  For float16, the data is stored in units of the noise floor.
+        For float32, the data is not scaled.
+    scale : { None, array-like }
+        Scaling factor for each channel.  If None, the scaling factor is
+        computed from the noise floor (estimated from blocks of data spread
+        across the recording) as described above.
+    hdf5_chunk_samples : int
+        Number of samples in each HDF5 chunk.  Reading a window of time only
+        needs to read and decompress the chunks that overlap the window.
+    hdf5_chunk_channels : int
+        Number of channels in each HDF5 chunk.  Reading a subset of the
+        channels (e.g. for plotting) only needs to read and decompress the
+        chunks containing those channels, while reading all channels gets
+        slightly slower as the number of chunks grows.  With 16 channels,
+        groups of 4 channels read 2 channels about 3x faster and all channels
+        about 1.3x slower than chunks spanning all channels.
+    progress_callback, chunk_size, prefetch, checkpoint_interval
+        See `decimate_waveform`
+
+    Returns the array the data was saved to.  If the data has already been
+    preprocessed with the same settings, it is not processed again.
+    '''
+    if progress_callback is None:
+        progress_callback = lambda x, y, z: False
+
+    raw = input_node.data.physiology.raw
+    channel = ProcessedFileMultiChannel.from_node(raw, **processing)
+    n_channels, n_samples = raw.shape
+
+    dtype = np.dtype(dtype)
+    if dtype not in (np.int16, np.float16, np.float32):
+        raise ValueError, 'Unsupported dtype "{}"'.format(dtype)
+
+    source = _source_fingerprint(input_node)
+    fh_out = output_node._v_file
+    if 'source_fingerprint' not in output_node._v_attrs:
+        filename = path.basename(input_node._v_file.filename)
+        fh_out.setNodeAttr(output_node, 'source_file', filename)
+        fh_out.setNodeAttr(output_node, 'source_pathname', raw._v_pathname)
+        fh_out.setNodeAttr(output_node, 'source_fingerprint', source)
+    elif output_node._v_attrs['source_fingerprint'] != source:
+        mesg = 'Sidecar was generated from different data'
+        raise ValueError, mesg
+
+    # A complete copy is returned as is.  Discard a copy that was interrupted
+    # without saving a checkpoint.
+    name = channel._sidecar_name
+    if name in output_node:
+        group = output_node._f_getChild(name)
+        if not has_checkpoint(group):
+            if 'data' in group and group.data.shape[-1] == n_samples:
+                log.info('%s has already been preprocessed',
+                         group._v_pathname)
+                return group.data
+            group._f_remove(recursive=True)
+    if name not in output_node:
+        group = fh_out.createGroup(output_node, name)
+
+    c_samples = _plan_chunk(raw, chunk_size, [np.float64]*3,
+                            hdf5_chunk_samples, overlap=2*channel._padding,
+                            prefetch=prefetch)
+    parameters = dict(source=source, settings=channel._settings,
+                      dtype=dtype.str, scale=scale,
+                      hdf5_chunk_samples=hdf5_chunk_samples,
+                      hdf5_chunk_channels=hdf5_chunk_channels)
+    checkpoint = Checkpoint(group, parameters, checkpoint_interval)
+    c_samples = checkpoint.state.get('c_samples', c_samples)
+
+    if scale is None:
+        scale = checkpoint.state.get('scale', None)
+    if scale is None and dtype == np.float32:
+        scale = np.ones(n_channels)
+    elif scale is None:
+        scale = _noise_floor(channel)
+        # Bad channels are zeroed out
+        scale[scale == 0] = 1
+        if dtype == np.int16:
+            scale = scale*PREPROCESS_HEADROOM/np.iinfo(np.int16).max
+    scale = np.asarray(scale, dtype=np.float64)
+
+    filters = tables.Filters(complevel=1, complib='zlib', fletcher32=True)
+    data = checkpoint.create(fh_out.createEArray, group, 'data',
+                             tables.Atom.from_dtype(dtype), (n_channels, 0),
+                             filters=filters, expectedrows=n_samples,
+                             chunkshape=(min(hdf5_chunk_channels, n_channels),
+                                         hdf5_chunk_samples),
+                             title='Referenced and filtered data')
+
+    # Save the settings with the data so we know how it was processed
+    data._v_attrs['scale'] = scale
+    data._v_attrs['fs'] = channel.fs
+    data._v_attrs['channels'] = n_channels
+    data._v_attrs['t0'] = 0
+    data._v_attrs['fc_lowpass'] = channel.filter_freq_lp
+    data._v_attrs['fc_highpass'] = channel.filter_freq_hp
+    data._v_attrs['filter_order'] = channel.filter_order
+    data._v_attrs['filter_btype'] = channel.filter_btype
+    data._v_attrs['filter_type'] = channel.filter_type
+    data._v_attrs['filter_method'] = channel.filter_method
+    data._v_attrs['filter_padding'] = channel._padding
+    data._v_attrs['bad_channels'] = np.unique(channel.bad_channels)
+    data._v_attrs['diff_mode'] = channel.diff_mode
+    data._v_attrs['differential'] = channel.diff_matrix
+
+    clipped = checkpoint.state.get('clipped', 0)
+    info = np.iinfo(dtype) if dtype.kind == 'i' else None
+    iterable = chunk_iter(channel, c_samples, prefetch=prefetch,
+                          skip=checkpoint.chunk)
+    aborted = False
+    iterable = _prefetch_scope(iterable, prefetch)
+    for i, chunk in enumerate(iterable, checkpoint.chunk):
+        chunk = chunk/scale[:, np.newaxis]
+        if info is not None:
+            chunk = np.round(chunk, out=chunk)
+            clipped += np.sum((chunk < info.min) | (chunk > info.max))
+            chunk = np.clip(chunk, info.min, info.max, out=chunk)
+        data.append(chunk.astype(dtype))
+        state = dict(c_samples=c_samples, scale=scale, clipped=clipped)
+        checkpoint.update(i+1, **state)
+        if progress_callback(i*c_samples, n_samples, ''):
+            aborted = True
+            break
+
+    # Save the progress so the remaining chunks can be processed later
+    if aborted and checkpoint.enabled:
+        checkpoint.save(i+1, **state)
+    elif not aborted:
+        checkpoint.complete()
+
+    data._v_attrs['clipped'] = clipped
+    if clipped:
+        log.warn('%d samples were clipped', clipped)
+    return data
+
+# Maximum number of waveforms gathered and written at once.  This bounds the
+# memory required when a chunk contains a large number of crossings (e.g. due to
+# artifacts).
+SPIKE_BATCH = 10000
+
+def _find_crossings(chunk, signs, thresholds, samples_before, samples_after):
+    '''
+    Find the threshold crossings in a chunk returned by chunk_iter (with
+    loverlap=samples_before and roverlap=samples_after).  Returns the channel
+    index and sample index (relative to the start of the chunk proper) of each
+    crossing.
+    '''
+    # Truncate the chunk so we don't look for threshold crossings in the
+    # portion of the chunk that overlaps with the following chunk.  This
+    # prevents us from attempting to extract partial spikes.  Finally, flip
+    # the waveforms on the pertinent channels (where we had a negative
+    # threshold requested) so that we can perform the thresholding on all
+    # channels at the same time using broadcasting.
+    c = chunk[..., samples_before:-samples_after] * signs
+    crossings = (c[..., :-1] <= thresholds) & (c[..., 1:] > thresholds)
+
+    # Get the channel number and index for each crossing.
+    return np.where(crossings)
+
+def _detect_spikes(chunk, signs, thresholds, samples_before, samples_after,
+                   window_samples):
+    '''
+    Find the threshold crossings in a chunk (see `_find_crossings`).  Returns
+    the channel index and sample index of each crossing along with a list of
+    waveform arrays (spike, channel, sample), each containing up to
+    SPIKE_BATCH spikes.
+    '''
+    channel_index, sample_index = _find_crossings(chunk, signs, thresholds,
+                                                  samples_before, samples_after)
+
+    # The window of each crossing begins samples_before samples before the
+    # crossing.  Since the chunk is padded by samples_before, this is the
+    # sample index of the crossing.  The windows are always within the chunk.
+    waveforms = [gather_windows(chunk, sample_index[i:i+SPIKE_BATCH],
+                                window_samples, fill_value=None)
+                 for i in range(0, len(sample_index), SPIKE_BATCH)]
+    return channel_index, sample_index, waveforms
+
+# State of each worker process used by extract_spikes when n_jobs > 1.  This is
+# set up once per process by _init_spike_worker so the input file is not
+# reopened for each chunk.
+_spike_worker = {}
+
+def _init_spike_worker(filename, pathname, processing, settings,
+                       sidecar_filename=None):
+    # On POSIX systems, the worker is forked from the parent process and
+    # inherits its HDF5 file handles.  If the worker opened the input file
+    # again, HDF5 would reuse the inherited file descriptor (shared with the
+    # parent and the other workers) and the concurrent reads would interfere
+    # with each other.  Close the inherited handles (which is safe since the
+    # input file is read-only) so the worker gets its own file descriptor.
+    for name in (filename, sidecar_filename):
+        for fh in list(tables.file._open_files.get_handlers_by_name(name)):
+            fh.close()
+    fh = tables.open_file(filename, 'r')
+    node = fh.get_node(pathname)
+    sidecar = None
+    if sidecar_filename is not None:
+        sidecar = tables.open_file(sidecar_filename, 'r').root
+    # The data saved by sweep_thresholds is already filtered
+    if processing is not None:
+        node = ProcessedFileMultiChannel.from_node(node, sidecar=sidecar,
+                                                   **processing)
+    _spike_worker['node'] = node
+    _spike_worker.update(settings)
+
+def _extract_spikes_chunk(args):
+    '''
+    Process a single chunk in a worker process.  This reads the same data that
+    chunk_iter yields in the serial implementation so the results are
+    identical.
+    '''
+    i_chunk, cov_indices = args
+    w = _spike_worker
+    c_samples = w['c_samples']
+    lb = i_chunk*c_samples
+    chunk = slice_overlap(w['node'], slice(lb, lb+c_samples),
+                          start_overlap=w['loverlap'],
+                          stop_overlap=w['roverlap'],
+                          ndslice=w['ndslice'])
+    channel_index, sample_index, waveforms = \
+        _detect_spikes(chunk, w['signs'], w['thresholds'], w['loverlap'],
+                       w['roverlap'], w['window_samples'])
+    cov_waves = gather_windows(chunk, cov_indices-lb, w['window_samples'],
+                               fill_value=None)
+    return channel_index, sample_index, waveforms, cov_waves, chunk.shape[-1]
+
 def extract_spikes(input_node, output_node, channels, noise_std, threshold_stds,
                    rej_threshold_stds, processing, window_size=2.1,
                    cross_time=0.5, cov_samples=10000, progress_callback=None,
-                   chunk_size=default_chunk_size, include_block_data=True):
+                   chunk_size=default_chunk_size, include_block_data=True,
+                   prefetch=default_prefetch, n_jobs=1, single_pass=True,
+                   checkpoint_interval=None, filtered_node=None,
+                   sidecar=None):
     '''
     Extracts spikes.  Lots of options.
 
@@ -509,15 +1075,65 @@ def extract_spikes(input_node, output_node, channels, noise_std, threshold_stds,
         each chunk is processed, the function will be called with updates to the
         progress.  If the function returns a nonzero (True) value, the
         processing will terminate.
-    chunk_size : float
-        Maximum memory size (in bytes) each chunk should occupy
+    chunk_size : { None, float }
+        Maximum memory size (in bytes) each chunk should occupy.  If None, the
+        chunk size is planned from the MEMORY_BUDGET setting (see
+        `cns.arraytools.plan_chunk_samples`).
     include_block_data : boolean
         Copy the information regarding blocks occuring in the experiment (e.g.
         trial timestamps, poke timestamps, trial log, etc.) decimated node file
         as well.  This is useful for creating a smaller, more compact datafile
         that you can carry around with you rather than the raw multi-gigabyte
         physiology data.
+    prefetch : int
+        Number of chunks to read ahead while the current chunk is processed
+        (see `cns.arraytools.chunk_iter`).  If nonzero, all HDF5 access is
+        routed through `cns.hdf5_service` while the chunks are read so the
+        reads are thread-safe.
+    n_jobs : { int, None }
+        Number of worker processes.  If greater than 1, the recording is split
+        into chunk-aligned time shards that are processed in parallel by
+        worker processes (each opens the input file read-only).  The results
+        are merged in order, so the output is identical to the serial run
+        with the same chunk size.  The memory budget is shared by the chunk
+        held by each worker and the results waiting to be saved, so unless
+        chunk_size is set, the chunks are smaller than in the serial run.  If
+        None, uses one worker per CPU.
+    single_pass : boolean
+        Classify artifacts and accumulate the covariance matrix as each chunk
+        is processed.  The covariance waveforms are written to the output file
+        as they are drawn rather than held in memory.  If False, the artifacts
+        are found in a second pass over the saved waveforms and the covariance
+        is computed from all the waveforms once extraction is complete.
+    checkpoint_interval : { None, float }
+        Save a checkpoint at most every checkpoint_interval seconds so the
+        analysis can be resumed if it is interrupted (see `cns.checkpoint`).
+        If output_node contains a checkpoint, the analysis is resumed from it
+        (the parameters must be the same).
+        Requires single_pass.
+    filtered_node : { None, instance of tables.EArray }
+        Filtered data saved by `sweep_thresholds` (using the same channels,
+        processing, window_size and cross_time).  If provided, the data is read
+        from this node rather than filtered again.  The data is read in the
+        same chunks as the sweep, so the events extracted are the crossings
+        found by the sweep.
+    sidecar : { None, instance of tables.Group }
+        See `running_rms`
     '''
+    if checkpoint_interval is not None and not single_pass:
+        raise ValueError, 'Checkpoints require single_pass'
+    if n_jobs is None:
+        n_jobs = multiprocessing.cpu_count()
+    if n_jobs > 1 and input_node._v_file.mode != 'r':
+        mesg = 'Input file must be opened read-only when n_jobs > 1'
+        raise ValueError, mesg
+    if n_jobs > 1 and filtered_node is not None and \
+            filtered_node._v_file.mode != 'r':
+        mesg = 'Filtered file must be opened read-only when n_jobs > 1'
+        raise ValueError, mesg
+    if n_jobs > 1 and sidecar is not None and sidecar._v_file.mode != 'r':
+        mesg = 'Sidecar file must be opened read-only when n_jobs > 1'
+        raise ValueError, mesg
 
     # Make sure data is in the format we want
     channels = np.asarray(channels)
@@ -537,7 +1153,7 @@ def extract_spikes(input_node, output_node, channels, noise_std, threshold_stds,
     # the referencing and filtering logic into this function rather than adding
     # a layer of abstraction.
     node = ProcessedFileMultiChannel.from_node(input_node.data.physiology.raw,
-                                               **processing)
+                                               sidecar=sidecar, **processing)
     fs = node.fs
 
     n_channels = len(channels)
@@ -551,7 +1167,30 @@ def extract_spikes(input_node, output_node, channels, noise_std, threshold_stds,
     # Compute chunk settings
     loverlap = samples_before
     roverlap = samples_after
-    c_samples = chunk_samples(node, chunk_size)
+    # Each chunk is filtered (float64), flipped by the threshold signs
+    # (float64) and compared against the thresholds (three boolean arrays).
+    # When the work is divided, each worker holds a chunk and up to two results
+    # per worker wait to be saved, so the budget is divided among them.
+    resident = 3*n_jobs if n_jobs > 1 else 1
+    c_samples = _plan_chunk(node, chunk_size,
+                            [np.float64, np.float64, (np.bool_, 3)],
+                            resident=resident, overlap=loverlap+roverlap,
+                            prefetch=prefetch,
+                            chunkshape=input_node.data.physiology.raw.chunkshape)
+
+    # Read the data that has already been filtered by sweep_thresholds if
+    # available.  This contains only the extracted channels.
+    if filtered_node is None:
+        data, ndslice = node, np.s_[channels, :]
+    else:
+        attrs = filtered_node._v_attrs
+        if attrs['fingerprint'] != _sweep_fingerprint(input_node, channels,
+                                                      processing, window_size,
+                                                      cross_time):
+            mesg = 'Filtered data was not generated with the same settings'
+            raise ValueError, mesg
+        data, ndslice = filtered_node, None
+        c_samples = attrs['chunk_samples']
 
     fh_out = output_node._v_file
 
@@ -560,19 +1199,35 @@ def extract_spikes(input_node, output_node, channels, noise_std, threshold_stds,
     fh_out.setNodeAttr(output_node, 'source_file', filename)
     fh_out.setNodeAttr(output_node, 'source_pathname', input_node._v_pathname)
 
+    # A resumed extraction must use the same chunks as the interrupted one
+    source = filename, input_node._v_pathname, node.shape
+    parameters = dict(source=source, channels=channels, noise_std=noise_std,
+                      threshold_stds=threshold_stds,
+                      rej_threshold_stds=rej_threshold_stds,
+                      processing=processing, window_size=window_size,
+                      cross_time=cross_time, cov_samples=cov_samples,
+                      single_pass=single_pass,
+                      filtered=filtered_node is not None,
+                      preprocessed=node._sidecar_array is not None)
+    checkpoint = Checkpoint(output_node, parameters, checkpoint_interval)
+    c_samples = checkpoint.state.get('c_samples', c_samples)
+
     # Create some UUID information that we can reference from other files that
     # are derived from this one.  If I re-extract spikes, but do not change the
     # filename, the UUID will change.  This means we can check to see whether
     # sorted spike data (obtained from the extracted spiketimes file) is from
-    # the current version of the extracted times file.
-    fh_out.setNodeAttr(output_node, 'extract_uuid', str(uuid.uuid1()))
-    fh_out.setNodeAttr(output_node, 'last_extracted', time.time())
+    # the current version of the extracted times file.  A resumed extraction
+    # keeps the UUID of the interrupted one.
+    if not checkpoint.resuming:
+        fh_out.setNodeAttr(output_node, 'extract_uuid', str(uuid.uuid1()))
+        fh_out.setNodeAttr(output_node, 'last_extracted', time.time())
 
     ########################################################################
     # BEGIN EVENT NODE
     ########################################################################
 
-    event_node = fh_out.createGroup(output_node, 'event_data')
+    event_node = checkpoint.create(fh_out.createGroup, output_node,
+                                   'event_data')
 
     # Ensure that underlying datatype of HDF5 array containing waveforms is
     # identical to the datatype of the source waveform (e.g. 32-bit float).
@@ -581,25 +1236,25 @@ def extract_spikes(input_node, output_node, channels, noise_std, threshold_stds,
     size = (0, n_channels, window_samples)
     atom = tables.Atom.from_dtype(node.dtype)
     title = 'Event waveforms (event, channel, sample)'
-    fh_waveforms = fh_out.createEArray(event_node, 'waveforms', atom, size,
-                                       title=title)
+    fh_waveforms = checkpoint.create(fh_out.createEArray, event_node,
+                                     'waveforms', atom, size, title=title)
     fh_waveforms._v_attrs['fs'] = fs
 
     # If we have a sampling rate of 12.5 kHz, storing indices as a 32-bit
     # integer allows us to locate samples in a continuous waveform of up to 49.7
     # hours in duration.  This is more than sufficient for our purpose (we will
     # likely run into file size issues well before this point anyway).
-    fh_indices = fh_out.createEArray(event_node, 'timestamps_n',
-                                     tables.Int32Atom(), (0,),
-                                     title='Event time (cycles)')
+    fh_indices = checkpoint.create(fh_out.createEArray, event_node,
+                                   'timestamps_n', tables.Int32Atom(), (0,),
+                                   title='Event time (cycles)')
     fh_indices._v_attrs['fs'] = fs
 
     # The actual channel the event was detected on.  We can represent up
     # to 32,767 channels with a 16 bit integer.  This should be
     # sufficient for at least the next year.
-    fh_channels = fh_out.createEArray(event_node, 'channels',
-                                      tables.Int16Atom(), (0,),
-                                      title='Event channel (1-based)')
+    fh_channels = checkpoint.create(fh_out.createEArray, event_node,
+                                    'channels', tables.Int16Atom(), (0,),
+                                    title='Event channel (1-based)')
 
     # This is another way of determining which channel the event was detected
     # on.  Specifically, if we are saving waveforms from channels 4, 5, 9, and
@@ -615,8 +1270,9 @@ def extract_spikes(input_node, output_node, channels, noise_std, threshold_stds,
     # waveforms and assumes they are numbered consecutively starting at 1.  By
     # adding 1 to the values stored in this array, this can be used for the
     # event_channel data provided to UMS2000.
-    fh_channel_indices = fh_out.createEArray(event_node, 'channel_indices',
-                                             tables.Int16Atom(), (0,))
+    fh_channel_indices = checkpoint.create(fh_out.createEArray, event_node,
+                                           'channel_indices',
+                                           tables.Int16Atom(), (0,))
 
     # We can represent up to 256 values with an 8 bit integer.  That's overkill
     # for a boolean datatype; however Matlab doesn't support pure boolean
@@ -624,9 +1280,9 @@ def extract_spikes(input_node, output_node, channels, noise_std, threshold_stds,
     # channel] indicating, for each event, which channels exceeded the artifact
     # reject threshold.
     size = (0, n_channels)
-    fh_artifacts = fh_out.createEArray(event_node, 'artifacts',
-                                       tables.Int8Atom(), size,
-                                       title='Artifact (event, channel)')
+    fh_artifacts = checkpoint.create(fh_out.createEArray, event_node,
+                                     'artifacts', tables.Int8Atom(), size,
+                                     title='Artifact (event, channel)')
 
     # Since we conventionally count channels from 1, convert our 0-based index
     # to a 1-based index.  It's OK to set these as node attributes becasue they
@@ -654,21 +1310,23 @@ def extract_spikes(input_node, output_node, channels, noise_std, threshold_stds,
     ########################################################################
     # BEGIN FILTER NODE
     ########################################################################
-    filter_node = fh_out.createGroup(output_node, 'filter')
+    filter_node = checkpoint.create(fh_out.createGroup, output_node, 'filter')
 
     # This needs to be an EArray rather than an attribute or typical Array
     # because setNodeAttr() and createArray complain if you attempt to pass an
     # empty array to it (I think this is actually an implementation issue with
     # the underlying HDF5 library).  By doing this workaround, we can ensure
     # that empty arrays (i.e. no bad channels) can also be saved.
-    fh_bad_channels = fh_out.createEArray(filter_node, 'bad_channels',
-                                          tables.Int8Atom(), (0,))
-    fh_bad_channels.append(np.array(node.bad_channels)+1)
+    if not checkpoint.resuming:
+        fh_bad_channels = fh_out.createEArray(filter_node, 'bad_channels',
+                                              tables.Int8Atom(), (0,))
+        fh_bad_channels.append(np.array(node.bad_channels)+1)
 
     # Currently we only support one referencing mode (i.e. reference against the
     # average of the good channels) so I've hardcoded this attribute for now.
     fh_out.setNodeAttr(filter_node, 'diff_mode', node.diff_mode)
-    fh_out.createArray(filter_node, 'differential', node.diff_matrix)
+    checkpoint.create(fh_out.createArray, filter_node, 'differential',
+                      node.diff_matrix)
 
     # Be sure to save the filter coefficients used (not sure if this is
     # meaningful).  The ZPK may be more useful in general.  Unfortunately, HDF5
@@ -678,21 +1336,30 @@ def extract_spikes(input_node, output_node, channels, noise_std, threshold_stds,
     fh_out.setNodeAttr(filter_node, 'fc_highpass', node.filter_freq_hp)
     fh_out.setNodeAttr(filter_node, 'filter_order', node.filter_order)
     fh_out.setNodeAttr(filter_node, 'filter_btype', node.filter_btype)
+    fh_out.setNodeAttr(filter_node, 'filter_method', node.filter_method)
     fh_out.setNodeAttr(filter_node, 'filter_padding', node._padding)
 
     b, a = node.filter_coefficients
-    fh_out.createArray(filter_node, 'b_coefficients', b)
-    fh_out.createArray(filter_node, 'a_coefficients', a)
+    checkpoint.create(fh_out.createArray, filter_node, 'b_coefficients', b)
+    checkpoint.create(fh_out.createArray, filter_node, 'a_coefficients', a)
 
     ########################################################################
     # END FILTER NODE
     ########################################################################
 
-    # Allocate a temporary array, cov_waves, for storing the data used for
-    # computing the covariance matrix required by UltraMegaSort2000.  Ensure
-    # that the datatype matches the datatype of the source waveform.
-    cov_waves = np.empty((cov_samples, n_channels, window_samples),
-                         dtype=node.dtype)
+    # Storage for the data used for computing the covariance matrix required
+    # by UltraMegaSort2000.  Ensure that the datatype matches the datatype of
+    # the source waveform.  In single pass mode, the waveforms are written to
+    # the file and the covariance is updated as they are drawn.  Otherwise, we
+    # allocate a temporary array, cov_waves.
+    if single_pass:
+        size = (0, n_channels*window_samples)
+        fh_cov_data = checkpoint.create(fh_out.createEArray, event_node,
+                                        'covariance_data', atom, size)
+        running_cov = RunningCovariance(n_channels*window_samples)
+    else:
+        cov_waves = np.empty((cov_samples, n_channels, window_samples),
+                             dtype=node.dtype)
 
     # Start indices of the random waveform segments to extract for the
     # covariance matrix.  Ensure that the randomly selected start indices are
@@ -709,40 +1376,54 @@ def extract_spikes(input_node, output_node, channels, noise_std, threshold_stds,
     cov_indices = np.sort(cov_indices)
     cov_i = 0
 
+    # The start indices are saved so a resumed extraction uses the same
+    # segments.  This needs to be an EArray so cov_samples can be 0 (see the
+    # note about bad_channels above).
+    fh_cov_indices = checkpoint.create(fh_out.createEArray, event_node,
+                                       'covariance_indices',
+                                       tables.Int64Atom(), (0,),
+                                       title='Covariance segment start (cycles)')
+    if checkpoint.resuming:
+        cov_indices = fh_cov_indices[:]
+    else:
+        fh_cov_indices.append(cov_indices)
+
     thresholds = thresholds[:, np.newaxis]
     signs = np.ones(thresholds.shape)
     signs[thresholds < 0] = -1
     thresholds *= signs
 
+    # Reject threshold for each channel (broadcast against the waveforms)
+    rej_thresholds = rej_thresholds[:, np.newaxis]
+
     # Keep the user updated as to how many candidate spikes they're getting
     tot_features = 0
 
-    iterable = chunk_iter(node, chunk_samples=c_samples, loverlap=loverlap,
-                          roverlap=roverlap, ndslice=np.s_[channels, :])
-
     aborted = False
     samples_processed = 0
 
-    t_chunk_start = time.time()
-    for i_chunk, chunk in enumerate(iterable):
-        # Truncate the chunk so we don't look for threshold crossings in the
-        # portion of the chunk that overlaps with the following chunk.  This
-        # prevents us from attempting to extract partial spikes.  Finally, flip
-        # the waveforms on the pertinent channels (where we had a negative
-        # threshold requested) so that we can perform the thresholding on all
-        # channels at the same time using broadcasting.
-        c = chunk[..., samples_before:-samples_after] * signs
-        crossings = (c[..., :-1] <= thresholds) & (c[..., 1:] > thresholds)
-
-        # Get the channel number and index for each crossing.
-        channel_index, sample_index = np.where(crossings)
-
-        n_features = len(sample_index)
-        tot_features += n_features
-
-        # This may not be the most efficient approach, but it suffices.
-        for s in sample_index:
-            fh_waveforms.append(chunk[..., s:s+window_samples][np.newaxis])
+    if checkpoint.resuming:
+        # Restore the state of the interrupted extraction.  The running
+        # covariance is rebuilt from the saved segments in the same batches (one
+        # per chunk) as the segments were originally drawn so the result is
+        # identical.
+        tot_features = fh_indices.nrows
+        samples_processed = checkpoint.state['samples_processed']
+        bounds = np.searchsorted(cov_indices,
+                                 np.arange(checkpoint.chunk+1)*c_samples)
+        for lb, ub in zip(bounds[:-1], bounds[1:]):
+            running_cov.update(fh_cov_data[lb:ub])
+        cov_i = bounds[-1]
+
+    def save_chunk(i_chunk, channel_index, sample_index, waveforms):
+        for batch in waveforms:
+            fh_waveforms.append(batch)
+            if single_pass:
+                # For each event, check which channels exceed the artifact
+                # reject threshold on any sample.
+                artifacts = (batch >= rej_thresholds) | \
+                            (batch < -rej_thresholds)
+                fh_artifacts.append(np.any(artifacts, axis=-1))
 
         # The indices saved to the file must be referenced to t0.  Since we're
         # processing in chunks and the indices are referenced to the start of
@@ -754,35 +1435,115 @@ def extract_spikes(input_node, output_node, channels, noise_std, threshold_stds,
         fh_channels.append(channels[channel_index]+1)
         fh_channel_indices.append(channel_index)
 
-        # Check to see if any of the samples requested for the covariance matrix
-        # lie in this chunk.  If so, pull them out.
-        chunk_lb = i_chunk*c_samples
-        chunk_ub = chunk_lb+c_samples
-        while True:
-            if cov_i == cov_samples:
-                break
-            index = cov_indices[cov_i]
-            if index >= chunk_ub:
+    def save_cov(waves):
+        # Returns the number of covariance waveforms saved
+        if single_pass:
+            # Use the saved precision so the covariance can be rebuilt from the
+            # file when resuming
+            waves = waves.reshape((len(waves), -1)).astype(atom.dtype)
+            fh_cov_data.append(waves)
+            running_cov.update(waves)
+        else:
+            cov_waves[cov_i:cov_i+len(waves)] = waves
+        return len(waves)
+
+    t_chunk_start = time.time()
+    if n_jobs > 1:
+        # Each chunk is a shard that is processed independently by a worker.
+        # The covariance samples are drawn above (in the parent process) so the
+        # same samples are used regardless of how the work is divided.
+        n_chunks = int(np.ceil(total_samples/c_samples))
+        bounds = np.searchsorted(cov_indices,
+                                 np.arange(n_chunks+1)*c_samples)
+        tasks = [(i, cov_indices[bounds[i]:bounds[i+1]])
+                 for i in range(checkpoint.chunk, n_chunks)]
+        settings = dict(signs=signs, thresholds=thresholds,
+                        c_samples=c_samples, loverlap=loverlap,
+                        roverlap=roverlap, window_samples=window_samples,
+                        ndslice=ndslice)
+        if filtered_node is None:
+            initargs = (input_node._v_file.filename,
+                        input_node.data.physiology.raw._v_pathname, processing,
+                        settings)
+            if node._sidecar_array is not None:
+                initargs += (sidecar._v_file.filename,)
+        else:
+            initargs = (filtered_node._v_file.filename,
+                        filtered_node._v_pathname, None, settings)
+        pool = multiprocessing.Pool(n_jobs, _init_spike_worker, initargs)
+        # Only keep a few chunks per worker in flight so the results do not
+        # pile up in memory if saving them is slower than processing them.
+        # The results are collected in chunk order.
+        submit = lambda task: pool.apply_async(_extract_spikes_chunk, (task,))
+        pending = [submit(task) for task in tasks[:2*n_jobs]]
+        tasks = tasks[2*n_jobs:]
+        try:
+            for i_chunk in range(checkpoint.chunk, n_chunks):
+                result = pending.pop(0).get()
+                if tasks:
+                    pending.append(submit(tasks.pop(0)))
+                channel_index, sample_index, waveforms, chunk_cov, n = result
+                tot_features += len(sample_index)
+                save_chunk(i_chunk, channel_index, sample_index, waveforms)
+                cov_i += save_cov(chunk_cov)
+                samples_processed += n
+                checkpoint.update(i_chunk+1, c_samples=c_samples,
+                                  samples_processed=samples_processed)
+                mesg = 'Found {} features'.format(tot_features)
+                if progress_callback(i_chunk*c_samples, total_samples, mesg):
+                    aborted = True
+                    break
+        finally:
+            # Pool.terminate deadlocks if a worker is blocked sending a result
+            # that is never read, so wait for the chunks in flight first.
+            for r in pending:
+                r.wait()
+            pool.terminate()
+            pool.join()
+    else:
+        iterable = chunk_iter(data, chunk_samples=c_samples, loverlap=loverlap,
+                              roverlap=roverlap, ndslice=ndslice,
+                              prefetch=prefetch, skip=checkpoint.chunk)
+
+        iterable = _prefetch_scope(iterable, prefetch)
+        for i_chunk, chunk in enumerate(iterable, checkpoint.chunk):
+            channel_index, sample_index, waveforms = \
+                _detect_spikes(chunk, signs, thresholds, samples_before,
+                               samples_after, window_samples)
+            tot_features += len(sample_index)
+            save_chunk(i_chunk, channel_index, sample_index, waveforms)
+
+            # Check to see if any of the samples requested for the covariance
+            # matrix lie in this chunk.  If so, pull them out.
+            chunk_lb = i_chunk*c_samples
+            chunk_ub = chunk_lb+c_samples
+            cov_ub = np.searchsorted(cov_indices, chunk_ub)
+            cov_i += save_cov(gather_windows(chunk,
+                                             cov_indices[cov_i:cov_ub]-chunk_lb,
+                                             window_samples, fill_value=None))
+
+            # Track the total number of samples processed.  For the first n-1
+            # blocks, this will be equivalent to i_chunk*c_samples.  However,
+            # the size of the last chunk will be variable since it's highly
+            # unlikely that the total number of samples will be an integer
+            # multiple of c_samples.
+            samples_processed += chunk.shape[-1]
+            checkpoint.update(i_chunk+1, c_samples=c_samples,
+                              samples_processed=samples_processed)
+
+            # Update the progress callback each time we finish processing a
+            # chunk.  If the progress callback returns True, end the processing
+            # immediately.  Be sure to add a note to the output node indicating
+            # that acquisition was aborted.
+            mesg = 'Found {} features'.format(tot_features)
+            if progress_callback(i_chunk*c_samples, total_samples, mesg):
+                aborted = True
                 break
-            index = index-chunk_lb
-            cov_waves[cov_i] = chunk[..., index:index+window_samples]
-            cov_i += 1
-
-        # Track the total number of samples processed.  For the first n-1
-        # blocks, this will be equivalent to i_chunk*c_samples.  However, the
-        # size of the last chunk will be variable since it's highly unlikely
-        # that the total number of samples will be an integer multiple of
-        # c_samples.
-        samples_processed += chunk.shape[-1]
-
-        # Update the progress callback each time we finish processing a chunk.
-        # If the progress callback returns True, end the processing immediately.
-        # Be sure to add a note to the output node indicating that acquisition
-        # was aborted.
-        mesg = 'Found {} features'.format(tot_features)
-        if progress_callback(i_chunk*c_samples, total_samples, mesg):
-            aborted = True
-            break
+
+    # Save the progress so the remaining chunks can be processed later
+    if aborted and checkpoint.enabled:
+        checkpoint.save(i_chunk+1, c_samples=c_samples,
+                        samples_processed=samples_processed)
 
     # Save some informationa bout whet
     output_node._v_attrs['aborted'] = aborted
@@ -792,33 +1553,36 @@ def extract_spikes(input_node, output_node, channels, noise_std, threshold_stds,
     t_chunk = t_chunk_end-t_chunk_start
     log.debug('Extracting spikes took {} seconds'.format(t_chunk))
 
-    # Find all the artifacts.  First, check the entire waveform array to see if
-    # the signal exceeds the artifact threshold defined on any given sample.
-    # Note that the specified reject threshold for each channel will be honored
-    # via broadcasting of the array.  This uses tables.Expr to avoid creating
-    # large Numpy temporary arrays in memory (and should be much faster).
-    rej_thresholds = rej_thresholds[np.newaxis].T
-    exp = tables.Expr("(fh_waveforms >= rej_thresholds) |"
-                      "(fh_waveforms < -rej_thresholds)")
-
-    # Now, evaluate and reduce the expression so that we end up with a 2d array
-    # [event, channel] indicating whether the waveform for any given event
-    # exceed the reject threshold specified for that channel.
-    artifacts = np.any(exp.eval(), axis=-1)
-    fh_artifacts.append(artifacts)
-
-    # If the user explicitly requested a cancel, compute the covariance matrix
-    # only on the samples we were able to draw from the data.
-    cov_waves = cov_waves[:cov_i]
-
-    # Compute the covariance matrix in the format required by UltraMegaSort2000
-    # (note by Brad -- I don't fully understand how the covariance matrix is
-    # used by UMS2000; however, I spoke with the author and he indicated this is
-    # the correct format for the matrix).
-    cov_waves.shape = cov_i, -1
-    cov_matrix = np.cov(cov_waves.T)
+    if single_pass:
+        cov_matrix = running_cov.covariance()
+    else:
+        # Find all the artifacts.  First, check the entire waveform array to
+        # see if the signal exceeds the artifact threshold defined on any given
+        # sample.  Note that the specified reject threshold for each channel
+        # will be honored via broadcasting of the array.  This uses tables.Expr
+        # to avoid creating large Numpy temporary arrays in memory (and should
+        # be much faster).
+        exp = tables.Expr("(fh_waveforms >= rej_thresholds) |"
+                          "(fh_waveforms < -rej_thresholds)")
+
+        # Now, evaluate and reduce the expression so that we end up with a 2d
+        # array [event, channel] indicating whether the waveform for any given
+        # event exceed the reject threshold specified for that channel.
+        artifacts = np.any(exp.eval(), axis=-1)
+        fh_artifacts.append(artifacts)
+
+        # If the user explicitly requested a cancel, compute the covariance
+        # matrix only on the samples we were able to draw from the data.
+        cov_waves = cov_waves[:cov_i]
+
+        # Compute the covariance matrix in the format required by
+        # UltraMegaSort2000 (note by Brad -- I don't fully understand how the
+        # covariance matrix is used by UMS2000; however, I spoke with the author
+        # and he indicated this is the correct format for the matrix).
+        cov_waves.shape = cov_i, -1
+        cov_matrix = np.cov(cov_waves.T)
+        fh_out.createArray(event_node, 'covariance_data', cov_waves)
     fh_out.createArray(event_node, 'covariance_matrix', cov_matrix)
-    fh_out.createArray(event_node, 'covariance_data', cov_waves)
 
     # Convert the timestamp indices to seconds and save in an array called
     # timestamps
@@ -830,13 +1594,216 @@ def extract_spikes(input_node, output_node, channels, noise_std, threshold_stds,
         block_node = output_node._v_file.createGroup(output_node, 'block_data')
         copy_block_data(input_node, block_node)
 
+    if not aborted:
+        checkpoint.complete()
+
     # Notify the progress dialog that we're done
     progress_callback(total_samples, total_samples, 'Complete')
 
+def _sweep_fingerprint(input_node, channels, processing, window_size,
+                       cross_time):
+    # Identifies the data and settings used to generate the filtered data saved
+    # by sweep_thresholds
+    filename = path.basename(input_node._v_file.filename)
+    return fingerprint(dict(source=(filename, input_node._v_pathname),
+                            channels=np.asarray(channels),
+                            processing=processing, window_size=window_size,
+                            cross_time=cross_time))
+
+def sweep_thresholds(input_node, output_node, channels, noise_std,
+                     threshold_stds, processing, window_size=2.1,
+                     cross_time=0.5, progress_callback=None,
+                     chunk_size=default_chunk_size, prefetch=default_prefetch,
+                     save_filtered=True, sidecar=None):
+    '''
+    Finds the threshold crossings for several thresholds in a single pass
+
+    Choosing a threshold by running extract_spikes repeatedly reads and filters
+    the data each time.  This reads and filters the data once and records the
+    crossings of each threshold.  The crossings are found the same way as in
+    extract_spikes, so the crossings of a threshold are the events that
+    extract_spikes would extract.  Once a threshold has been chosen, pass the
+    filtered data saved by this function to extract_spikes (as filtered_node)
+    to extract the waveforms without filtering the data again.
+
+    Parameters
+    ----------
+    input_node, channels, noise_std, processing, window_size, cross_time,
+    progress_callback, chunk_size, prefetch, sidecar
+        See `extract_spikes`
+    output_node : instance of tables.Group
+        The target node to save the data to.  The following arrays are saved
+        under the target node:
+            thresholds : (threshold, channel)
+                Thresholds swept
+            counts : (threshold, channel)
+                Number of crossings of each threshold on each channel
+            timestamps_n, channels, threshold_indices : (event, )
+                Sample, channel (1-based) and threshold (0-based index into
+                thresholds) of each crossing
+            filtered : (channel, sample)
+                Referenced and filtered data for the extracted channels (only
+                if save_filtered is True)
+    threshold_stds : array-like (float)
+        Thresholds to sweep (in standard deviations from the noise floor).
+        Either a 2D array (threshold, channel) or a 1D array of thresholds to
+        use for all channels.
+    save_filtered : boolean
+        Save the filtered data.  This requires as much space as the raw data
+        for the extracted channels.
+    '''
+    channels = np.asarray(channels)
+    noise_std = np.asarray(noise_std)
+    threshold_stds = np.asarray(threshold_stds, dtype=np.float64)
+    if threshold_stds.ndim == 1:
+        threshold_stds = threshold_stds[:, np.newaxis]*np.ones(len(channels))
+    thresholds = noise_std * threshold_stds
+    n_thresholds = len(thresholds)
+
+    if progress_callback is None:
+        progress_callback = lambda x, y, z: False
+
+    node = ProcessedFileMultiChannel.from_node(input_node.data.physiology.raw,
+                                               sidecar=sidecar, **processing)
+    fs = node.fs
+    n_channels = len(channels)
+    total_samples = node.shape[-1]
+
+    # Use the same windows (and therefore the same chunk overlap) as
+    # extract_spikes so the same crossings are found
+    window_samples = int(np.ceil(window_size*fs*1e-3))
+    samples_before = int(np.ceil(cross_time*fs*1e-3))
+    samples_after = window_samples-samples_before
+    loverlap = samples_before
+    roverlap = samples_after
+    c_samples = _plan_chunk(node, chunk_size,
+                            [np.float64, np.float64, (np.bool_, 3)],
+                            overlap=loverlap+roverlap, prefetch=prefetch,
+                            chunkshape=input_node.data.physiology.raw.chunkshape)
+
+    fh_out = output_node._v_file
+    filename = str(path.basename(input_node._v_file.filename))
+    fh_out.setNodeAttr(output_node, 'source_file', filename)
+    fh_out.setNodeAttr(output_node, 'source_pathname', input_node._v_pathname)
+    fh_out.setNodeAttr(output_node, 'extracted_channels', channels+1)
+    fh_out.setNodeAttr(output_node, 'noise_std', noise_std)
+    fh_out.setNodeAttr(output_node, 'threshold_std', threshold_stds)
+    fh_out.setNodeAttr(output_node, 'window_size', window_size)
+    fh_out.setNodeAttr(output_node, 'cross_time', cross_time)
+
+    fh_out.createArray(output_node, 'thresholds', thresholds,
+                       title='Threshold (threshold, channel)')
+    fh_indices = fh_out.createEArray(output_node, 'timestamps_n',
+                                     tables.Int32Atom(), (0,),
+                                     title='Event time (cycles)')
+    fh_indices._v_attrs['fs'] = fs
+    fh_channels = fh_out.createEArray(output_node, 'channels',
+                                      tables.Int16Atom(), (0,),
+                                      title='Event channel (1-based)')
+    fh_threshold_indices = fh_out.createEArray(output_node,
+                                               'threshold_indices',
+                                               tables.Int16Atom(), (0,),
+                                               title='Event threshold')
+    if save_filtered:
+        filters = tables.Filters(complevel=1, complib='zlib', fletcher32=True)
+        atom = tables.Atom.from_dtype(node.dtype)
+        fh_filtered = fh_out.createEArray(output_node, 'filtered', atom,
+                                          (n_channels, 0), filters=filters,
+                                          title='Referenced and filtered data')
+        # extract_spikes must use the same chunks to find the same crossings
+        fh_filtered._v_attrs['fs'] = fs
+        fh_filtered._v_attrs['chunk_samples'] = c_samples
+        fh_filtered._v_attrs['fingerprint'] = _sweep_fingerprint(
+            input_node, channels, processing, window_size, cross_time)
+
+    signs = np.ones(thresholds.shape)
+    signs[thresholds < 0] = -1
+    thresholds = (thresholds*signs)[..., np.newaxis]
+    signs = signs[..., np.newaxis]
+    counts = np.zeros((n_thresholds, n_channels), dtype=np.int64)
+
+    iterable = chunk_iter(node, chunk_samples=c_samples, loverlap=loverlap,
+                          roverlap=roverlap, ndslice=np.s_[channels, :],
+                          prefetch=prefetch)
+    aborted = False
+    iterable = _prefetch_scope(iterable, prefetch)
+    for i_chunk, chunk in enumerate(iterable):
+        for i in range(n_thresholds):
+            channel_index, sample_index = \
+                _find_crossings(chunk, signs[i], thresholds[i], samples_before,
+                                samples_after)
+            fh_indices.append(sample_index+i_chunk*c_samples)
+            fh_channels.append(channels[channel_index]+1)
+            fh_threshold_indices.append(np.repeat(i, len(sample_index)))
+            counts[i] += np.bincount(channel_index, minlength=n_channels)
+        if save_filtered:
+            fh_filtered.append(chunk[..., loverlap:chunk.shape[-1]-roverlap])
+        mesg = 'Found {} crossings'.format(counts.sum())
+        if progress_callback(i_chunk*c_samples, total_samples, mesg):
+            aborted = True
+            break
+
+    fh_out.createArray(output_node, 'counts', counts,
+                       title='Crossings (threshold, channel)')
+    output_node._v_attrs['aborted'] = aborted
+    progress_callback(total_samples, total_samples, 'Complete')
+
+def _wavelet_bank(wavelets, n_fft):
+    '''
+    Return the FFT (of length n_fft) of each wavelet.  Each wavelet is
+    circularly shifted so that it is centered on the first sample.  Multiplying
+    the FFT of a signal by the bank and taking the inverse FFT is then equivalent
+    to np.convolve(x, wavelet, 'same') for each wavelet (away from the edges of
+    the signal, where the circular convolution wraps around).
+    '''
+    bank = np.zeros((len(wavelets), n_fft), dtype=np.complex128)
+    for j, w in enumerate(wavelets):
+        bank[j, :len(w)] = w
+        bank[j] = np.roll(bank[j], -((len(w)-1)//2))
+    return fftpack.fft(bank, axis=-1)
+
+# Target size (in bytes) of each HDF5 chunk of the spectrogram array when a
+# chunk layout is requested
+SPECTROGRAM_CHUNK_BYTES = 2**17
+
+def _spectrogram_chunkshape(layout, shape, itemsize):
+    '''
+    Return the HDF5 chunk shape for the requested spectrogram layout (see
+    compute_spectrogram)
+    '''
+    n_channels, n_frequencies, n_samples = shape
+    if layout is None:
+        return None
+    elif layout == 'band':
+        n_frequencies = 1
+    elif layout != 'window':
+        raise ValueError, 'Unknown chunk layout "{}"'.format(layout)
+    samples = SPECTROGRAM_CHUNK_BYTES//(n_frequencies*itemsize)
+    return 1, n_frequencies, int(max(1, min(samples, n_samples)))
+
+def _spectrogram_output(y, output, bin_samples):
+    '''
+    Convert the complex wavelet coefficients (last axis is time) to the
+    requested output (see compute_spectrogram)
+    '''
+    if output == 'complex':
+        return y
+    power = y.real**2+y.imag**2
+    if bin_samples > 1:
+        n = power.shape[-1]
+        edges = np.arange(0, n, bin_samples)
+        counts = np.diff(np.r_[edges, n])
+        power = np.add.reduceat(power, edges, axis=-1)/counts
+    if output == 'log_power':
+        power = 10*np.log10(power)
+    return power
+
 def compute_spectrogram(lfp, output_node, frequencies, cycles=3,
                         progress_callback=None,
                         chunk_size=default_chunk_size,
-                        include_block_data=True):
+                        include_block_data=True, prefetch=default_prefetch,
+                        method='fft', output='complex', bin_samples=1,
+                        chunk_layout=None, checkpoint_interval=None):
     '''
     Computes the running spectrogram using Morlet wavelets
 
@@ -859,6 +1826,40 @@ def compute_spectrogram(lfp, output_node, frequencies, cycles=3,
         Frequencies to use in computing spectrogram
     cycles : integer
         Number of cycles in Morlet wavelet
+    prefetch : int
+        Number of chunks to read ahead while the current chunk is processed
+        (see `cns.arraytools.chunk_iter`).  If nonzero, all HDF5 access is
+        routed through `cns.hdf5_service` while the chunks are read so the
+        reads are thread-safe.
+    method : {'fft', 'direct'}
+        If 'fft', each channel of a chunk is transformed once and the entire
+        wavelet bank is applied in the frequency domain (the chunk overlap
+        discards the samples corrupted by circular convolution, i.e.
+        overlap-save).  If 'direct', each wavelet is convolved with each channel
+        in the time domain (much slower for long, low-frequency wavelets).  The
+        results are equivalent up to rounding.
+    output : {'complex', 'power', 'log_power'}
+        Store the complex wavelet coefficients (complex64), the power
+        (float32) or the power in dB (float32).  The power modes are half the
+        size of the complex output.
+    bin_samples : int
+        Average the power over consecutive bins of bin_samples samples
+        (the final bin may be shorter).  The spectrogram is reduced in size
+        (and sampling rate) by this factor.  Only supported for the power
+        modes.  For log_power, the log is taken after averaging.
+    chunk_layout : {None, 'band', 'window'}
+        Layout of the HDF5 chunks of the spectrogram array.  If 'band', each
+        chunk holds a long stretch of time for a single channel and frequency
+        (efficient for reading a few frequency bands over the entire
+        recording).  If 'window', each chunk holds all frequencies for a
+        short stretch of time (efficient for reading a time window, e.g. the
+        spectrogram around each trial).  If None, PyTables chooses the chunk
+        shape.
+    checkpoint_interval : { None, float }
+        Save a checkpoint at most every checkpoint_interval seconds so the
+        analysis can be resumed if it is interrupted (see `cns.checkpoint`).
+        If output_node contains a checkpoint, the analysis is resumed from it
+        (the parameters must be the same).
 
     Notes
     -----
@@ -875,46 +1876,112 @@ def compute_spectrogram(lfp, output_node, frequencies, cycles=3,
     n_channels, n_samples = lfp.shape
     n_frequencies = len(frequencies)
 
+    if output == 'complex':
+        if bin_samples != 1:
+            raise ValueError, 'Binning requires a power output'
+        atom = tables.atom.ComplexAtom(itemsize=8)
+    elif output in ('power', 'log_power'):
+        atom = tables.Float32Atom()
+    else:
+        raise ValueError, 'Unknown output "{}"'.format(output)
+    n_bins = int(np.ceil(n_samples/bin_samples))
+    shape = n_channels, n_frequencies, n_bins
+
+    source = path.basename(lfp._v_file.filename), lfp._v_pathname, lfp.shape
+    parameters = dict(source=source, frequencies=frequencies, cycles=cycles,
+                      method=method, output=output, bin_samples=bin_samples,
+                      chunk_layout=chunk_layout)
+    checkpoint = Checkpoint(output_node, parameters, checkpoint_interval)
+
     fh_out = output_node._v_file
     filters = tables.Filters(complevel=1, complib='zlib', fletcher32=True)
 
-    spectrogram = fh_out.createCArray(output_node, 'spectrogram',
-                                      tables.atom.ComplexAtom(itemsize=8),
-                                      (n_channels, n_frequencies, n_samples),
-                                      filters=filters,
-                                      title="Spectrogram of LFP signal")
+    chunkshape = _spectrogram_chunkshape(chunk_layout, shape, atom.itemsize)
+    spectrogram = checkpoint.create(fh_out.createCArray, output_node,
+                                    'spectrogram', atom, shape,
+                                    filters=filters, chunkshape=chunkshape,
+                                    title="Spectrogram of LFP signal")
 
     # Get the Morlet wavelets used for the transform
     wavelets = tfr.morlet(fs, frequencies, n_cycles=cycles)
 
     # Overlap by number of samples in the largest wavelet
     overlap = max(map(len, wavelets))
-    c_samples = chunk_samples(lfp, chunk_size)
+    if method == 'fft':
+        # The wavelet bank and the transform of one channel are held at the
+        # padded chunk length and the wavelet bank is applied to one channel at
+        # a time (complex128).  The result for the chunk is then assembled
+        # before it is written.
+        chain = [(np.complex128, (2.0*n_frequencies+1)/n_channels),
+                 (atom.dtype, n_frequencies/bin_samples)]
+    elif method == 'direct':
+        # Each channel is convolved with one wavelet at a time (complex128)
+        chain = [(np.complex128, 2.0/n_channels)]
+    else:
+        raise ValueError, 'Unknown method "{}"'.format(method)
+    # Each chunk must contain a whole number of bins
+    c_samples = _plan_chunk(lfp, chunk_size, chain, bin_samples,
+                            overlap=2*overlap, prefetch=prefetch)
+    c_samples = checkpoint.state.get('c_samples', c_samples)
     iterable = chunk_iter(lfp, chunk_samples=c_samples, loverlap=overlap,
-                          roverlap=overlap)
+                          roverlap=overlap, prefetch=prefetch,
+                          skip=checkpoint.chunk)
+
+    if method == 'fft':
+        # No chunk is longer than the first one (the final one may be
+        # shorter), so the wavelet bank only needs to be transformed once.
+        n_fft = fftpack.next_fast_len(min(c_samples, n_samples)+2*overlap)
+        bank = _wavelet_bank(wavelets, n_fft)
 
-    for i, chunk in enumerate(iterable):
-        for j, Wn in enumerate(wavelets):
+    aborted = False
+    iterable = _prefetch_scope(iterable, prefetch)
+    for i, chunk in enumerate(iterable, checkpoint.chunk):
+        n = chunk.shape[-1]-2*overlap
+        lb = i*c_samples//bin_samples
+        ub = lb+int(np.ceil(n/bin_samples))
+        if method == 'fft':
+            c_spect = np.empty((n_channels, n_frequencies, ub-lb),
+                               dtype=atom.dtype)
             for k in range(n_channels):
-                lb = i*c_samples
-                ub = lb+c_samples
-                c_spect = np.convolve(chunk[k], Wn, 'same')
-                spectrogram[k,j,lb:ub] = c_spect[overlap:-overlap]
+                x = fftpack.fft(chunk[k], n_fft)
+                y = fftpack.ifft(bank*x, axis=-1)[:, overlap:overlap+n]
+                c_spect[k] = _spectrogram_output(y, output, bin_samples)
+            spectrogram[:, :, lb:ub] = c_spect
+        else:
+            for j, Wn in enumerate(wavelets):
+                for k in range(n_channels):
+                    c_spect = np.convolve(chunk[k], Wn, 'same')
+                    c_spect = c_spect[overlap:-overlap]
+                    spectrogram[k,j,lb:ub] = \
+                        _spectrogram_output(c_spect, output, bin_samples)
+        checkpoint.update(i+1, c_samples=c_samples)
         if progress_callback(i*c_samples, n_samples, ''):
+            aborted = True
             break
 
+    # Save the progress so the remaining chunks can be processed later
+    if aborted and checkpoint.enabled:
+        checkpoint.save(i+1, c_samples=c_samples)
+
     # Save some data about how the lfp data was generated
+    spectrogram._v_attrs['output'] = output
+    spectrogram._v_attrs['bin_samples'] = bin_samples
+    spectrogram._v_attrs['fs'] = fs/bin_samples
     spectrogram._v_attrs['chunk_overlap'] = overlap
     spectrogram._v_attrs['frequencies'] = frequencies
     spectrogram._v_attrs['wavelets'] = wavelets
     spectrogram._v_attrs['wavelet_cycles'] = cycles
 
-    # Save some information about where we obtained the raw data from
-    filename = path.basename(input_node._v_file.filename)
+    # Save some information about where we obtained the LFP data from
+    filename = path.basename(lfp._v_file.filename)
     output_node._v_attrs['source_file'] = filename
-    output_node._v_attrs['source_pathname'] = input_node._v_pathname
+    output_node._v_attrs['source_pathname'] = lfp._v_pathname
 
-    if include_block_data:
-        block_node = output_node._v_file.createGroup(output_node, 'block_data')
-        copy_block_data(input_node, block_node)
+    # The block data is copied from the decimated file (see decimate_waveform)
+    lfp_node = lfp._v_parent
+    if include_block_data and 'block_data' in lfp_node:
+        lfp_node.block_data._f_copy(output_node, recursive=True)
+
+    if not aborted:
+        checkpoint.complete()
 
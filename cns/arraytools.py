@@ -20,13 +20,19 @@ properly.  You can run these doctests by typing 'python -m cns.arraytools' at
 the command prompt.
 '''
 
+import os
+import sys
+import threading
+import Queue
 import numpy as np
 
 __author__ = "Brad N. Buran"
 __contact__ = "bburan@alum.mit.edu"
 __license__ = "GPL"
 
-__all__ = ['chunk_samples', 'chunk_iter', 'slice_overlap']
+__all__ = ['chunk_samples', 'plan_chunk_samples', 'memory_budget',
+           'physical_memory', 'chunk_iter', 'prefetch_iter', 'slice_overlap',
+           'coalesce_rows', 'RowSubset', 'gather_windows']
 
 def chunk_samples(x, max_bytes=10e6, block_size=None, axis=-1):
     '''
@@ -95,9 +101,149 @@ def chunk_samples(x, max_bytes=10e6, block_size=None, axis=-1):
         raise ValueError, "cannot achieve requested chunk size"
     return int(samples)
 
+def physical_memory():
+    '''
+    Return the amount of physical memory (in bytes) or None if it cannot be
+    determined
+    '''
+    try:
+        return os.sysconf('SC_PAGE_SIZE')*os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        pass
+    try:
+        import ctypes
+        class MEMORYSTATUSEX(ctypes.Structure):
+            _fields_ = [('dwLength', ctypes.c_ulong),
+                        ('dwMemoryLoad', ctypes.c_ulong),
+                        ('ullTotalPhys', ctypes.c_ulonglong),
+                        ('ullAvailPhys', ctypes.c_ulonglong),
+                        ('ullTotalPageFile', ctypes.c_ulonglong),
+                        ('ullAvailPageFile', ctypes.c_ulonglong),
+                        ('ullTotalVirtual', ctypes.c_ulonglong),
+                        ('ullAvailVirtual', ctypes.c_ulonglong),
+                        ('sullAvailExtendedVirtual', ctypes.c_ulonglong)]
+        status = MEMORYSTATUSEX()
+        status.dwLength = ctypes.sizeof(MEMORYSTATUSEX)
+        ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status))
+        return status.ullTotalPhys
+    except Exception:
+        return None
+
+def memory_budget(fraction=0.125, default=256e6):
+    '''
+    Return the memory budget (in bytes) for processing a chunk as a fraction of
+    the physical memory.  If the physical memory cannot be determined, the
+    default is returned.
+    '''
+    memory = physical_memory()
+    if memory is None:
+        return default
+    return memory*fraction
+
+def plan_chunk_samples(x, chain=(), budget=None, axis=-1, block_size=None,
+                       overlap=0, prefetch=0, chunkshape=None):
+    '''
+    Compute the number of samples per chunk so that processing a chunk fits
+    within the memory budget.  Unlike `chunk_samples`, which only accounts for
+    the chunk itself, this accounts for the intermediate arrays created while
+    processing the chunk (e.g. int16 raw data filtered to float64 and then
+    transformed to a complex spectrogram) as well as the chunks that are read
+    ahead.
+
+    Parameters
+    ----------
+    x : ndarray
+        The array that will be chunked
+    chain : sequence
+        The arrays created while processing each chunk.  Each item is either a
+        dtype (for an array the same shape as the chunk) or a tuple of (dtype,
+        factor) where factor is the size of the array relative to the chunk
+        (e.g. the number of frequencies in a spectrogram).
+    budget : { None, float }
+        Memory budget in bytes.  If None, uses `memory_budget`.
+    axis : int
+        Axis over which the data is chunked
+    block_size : { None, int }
+        Ensure that the number of samples is a multiple of block_size
+    overlap : int
+        Number of samples each chunk is extended by (i.e. loverlap+roverlap).
+    prefetch : int
+        Number of chunks read ahead (see `chunk_iter`)
+    chunkshape : { None, tuple }
+        Chunk layout of the HDF5 array backing x.  Defaults to x.chunkshape if
+        present.  The number of samples is rounded to a multiple of the chunk
+        length so that chunks are not decompressed twice.
+
+    Examples
+    --------
+    >>> x = np.zeros((4, 1000), dtype=np.int16)
+    >>> plan_chunk_samples(x, budget=800)
+    100
+    >>> plan_chunk_samples(x, [np.float64], budget=800)
+    20
+    >>> plan_chunk_samples(x, [np.float64, (np.complex128, 0.5)], budget=900)
+    12
+    >>> plan_chunk_samples(x, budget=800, prefetch=1)
+    50
+    >>> plan_chunk_samples(x, budget=800, overlap=10)
+    90
+    >>> plan_chunk_samples(x, budget=800, chunkshape=(4, 32))
+    96
+    >>> plan_chunk_samples(x, budget=800, chunkshape=(4, 32), block_size=3)
+    96
+    >>> plan_chunk_samples(x, budget=800, chunkshape=(4, 256), block_size=3)
+    99
+
+    The number of samples is never larger than needed to process the entire
+    array in a single chunk:
+
+    >>> plan_chunk_samples(x, budget=1e9)
+    1000
+    >>> plan_chunk_samples(x, budget=1e9, chunkshape=(4, 256))
+    1024
+    >>> plan_chunk_samples(x, budget=4)
+    Traceback (most recent call last):
+        ...
+    ValueError: cannot achieve requested chunk size
+    '''
+    if budget is None:
+        budget = memory_budget()
+    shape = list(x.shape)
+    n = shape.pop(axis)
+    elements = np.prod(shape)
+
+    # Bytes required per element of the chunk.  The chunk being processed and
+    # each chunk read ahead are in memory at the same time.
+    itemsize = np.dtype(x.dtype).itemsize*(1+prefetch)
+    for item in chain:
+        dtype, factor = item if isinstance(item, tuple) else (item, 1)
+        itemsize += np.dtype(dtype).itemsize*factor
+    samples = int(np.floor(budget/elements/itemsize))-overlap
+
+    if block_size is None:
+        block_size = 1
+    if chunkshape is None:
+        chunkshape = getattr(x, 'chunkshape', None)
+    step = block_size
+    if chunkshape is not None:
+        c = chunkshape[axis]
+        # Least common multiple of the chunk length and block size
+        aligned = c*block_size//_gcd(c, block_size)
+        if samples >= aligned:
+            step = aligned
+    if samples < step:
+        raise ValueError, "cannot achieve requested chunk size"
+    n = max(int(np.ceil(float(n)/step))*step, step)
+    return int(min(samples//step*step, n))
+
+def _gcd(a, b):
+    while b:
+        a, b = b, a % b
+    return a
+
 def chunk_iter(x, chunk_samples=None, step_samples=None, loverlap=0, roverlap=0,
                padding='const', axis=-1, ndslice=None, initial_padding=0,
-               final_padding=0):
+               final_padding=0, prefetch=0, skip=0):
     '''
     Return an iterable that yields the data in chunks along the specified axis.
 
@@ -105,8 +251,8 @@ def chunk_iter(x, chunk_samples=None, step_samples=None, loverlap=0, roverlap=0,
         The array that will be chunked
     chunk_samples : { None, int }
         Number of samples per chunk along the specified axis.  If None, will
-        automatically choose the number of samples based on a fixed memory size
-        per chunk (~10 MB).
+        automatically choose the number of samples based on the memory budget
+        (see `plan_chunk_samples`).
     step_samples : int or None
         Number of samples between the first sample of each chunk
     loverlap : int
@@ -133,6 +279,17 @@ def chunk_iter(x, chunk_samples=None, step_samples=None, loverlap=0, roverlap=0,
         as requested by `padding`.  This is in addition to `right_overlap` (e.g.
         the total number of samples added will be
         `initial_padding`+`right_overlap`).
+    prefetch : int
+        Number of chunks to read ahead on a background thread while the caller
+        processes the current chunk (0 reads each chunk when it is requested).
+        When the array is a HDF5 node, reading ahead lets decompression overlap
+        with processing.  The chunks yielded are identical.  Note that PyTables
+        is not thread-safe.  If the caller accesses HDF5 files while iterating,
+        the calls must be serialized (see `cns.hdf5_service.install`).
+    skip : int
+        Number of chunks to skip (e.g. when resuming an analysis that was
+        interrupted).  The chunks that follow are identical to the ones
+        yielded when no chunks are skipped.
 
     >>> x = np.arange(1000).reshape((4, 250))
     >>> iterable = chunk_iter(x, 5)
@@ -303,12 +460,42 @@ def chunk_iter(x, chunk_samples=None, step_samples=None, loverlap=0, roverlap=0,
     Now, if you are performing filtering *and* computing a running metric, you
     would likely use all three keywords to achieve the optimal chunking
     behavior.
+
+    Reading ahead does not change the chunks:
+
+    >>> expected = list(chunk_iter(x, 10, step_samples=5, roverlap=2))
+    >>> actual = list(chunk_iter(x, 10, step_samples=5, roverlap=2, prefetch=2))
+    >>> all(np.array_equal(e, a) for e, a in zip(expected, actual))
+    True
+    >>> len(expected) == len(actual)
+    True
+
+    Skipping chunks:
+
+    >>> actual = list(chunk_iter(x, 10, step_samples=5, roverlap=2, skip=3))
+    >>> all(np.array_equal(e, a) for e, a in zip(expected[3:], actual))
+    True
+    >>> len(expected[3:]) == len(actual)
+    True
     '''
+    if chunk_samples is None:
+        chunk_samples = plan_chunk_samples(x, axis=axis,
+                                           overlap=loverlap+roverlap,
+                                           prefetch=prefetch)
+    iterable = _chunk_iter(x, chunk_samples, step_samples, loverlap, roverlap,
+                           padding, axis, ndslice, initial_padding,
+                           final_padding, skip)
+    if prefetch:
+        iterable = prefetch_iter(iterable, prefetch)
+    return iterable
+
+def _chunk_iter(x, chunk_samples, step_samples, loverlap, roverlap, padding,
+                axis, ndslice, initial_padding, final_padding, skip):
     samples = x.shape[axis]
-    i = 0
 
     if step_samples is None:
         step_samples = chunk_samples
+    i = skip*step_samples
 
     while i < samples:
         s = slice(i, i+chunk_samples)
@@ -318,6 +505,64 @@ def chunk_iter(x, chunk_samples=None, step_samples=None, loverlap=0, roverlap=0,
                             final_padding=final_padding)
         i += step_samples
 
+def prefetch_iter(iterable, depth=1):
+    '''
+    Consume iterable on a background thread, keeping up to depth items ready for
+    the caller.  Items are yielded in order and exceptions raised by the
+    iterable are reraised in the caller.  If the caller stops iterating early
+    (i.e. the generator is closed), the background thread stops once it has
+    finished the item it is preparing and the close waits for it.
+
+    >>> list(prefetch_iter(iter(range(5)), 2))
+    [0, 1, 2, 3, 4]
+    >>> def fail():
+    ...     yield 1
+    ...     raise ValueError, 'failed'
+    >>> list(prefetch_iter(fail()))
+    Traceback (most recent call last):
+        ...
+    ValueError: failed
+    '''
+    queue = Queue.Queue(depth)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        # Check periodically whether the caller has stopped iterating so the
+        # thread does not block forever on a full queue.
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def worker():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+        except:
+            put((done, sys.exc_info()))
+        else:
+            put((done, None))
+
+    thread = threading.Thread(target=worker, name='prefetch_iter')
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            item, exc_info = queue.get()
+            if item is done:
+                if exc_info is not None:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                break
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
 def axis_slice(a, start=None, stop=None, step=None, axis=-1, ndslice=None):
     """
     Take a slice along axis 'axis' from 'a'.
@@ -419,6 +664,226 @@ def slice_overlap(a, s, start_overlap=0, stop_overlap=0, axis=-1, ndslice=None,
             raise(ValueError('Arrays with more than 2 dimensions not supported'))
     return b
 
+def coalesce_rows(rows, block_size=1):
+    '''
+    Group a sorted list of row indices into a minimal set of contiguous (start,
+    stop) ranges
+
+    Rows that fall in the same block of `block_size` rows are merged into a
+    single range even if they are not adjacent.  When reading from a chunked
+    HDF5 array, set block_size to the number of rows per chunk.  Since the
+    entire chunk must be read and decompressed to extract any row from it,
+    it's cheaper to read the rows between the requested ones than to read the
+    same chunk more than once.
+
+    >>> coalesce_rows([0, 1, 2, 5, 6, 9])
+    [(0, 3), (5, 7), (9, 10)]
+    >>> coalesce_rows([0, 1, 2, 5, 6, 9], block_size=4)
+    [(0, 3), (5, 7), (9, 10)]
+    >>> coalesce_rows([0, 2, 5, 7, 9], block_size=4)
+    [(0, 3), (5, 8), (9, 10)]
+    >>> coalesce_rows([])
+    []
+    '''
+    ranges = []
+    for row in rows:
+        if ranges:
+            start, stop = ranges[-1]
+            if row == stop or row//block_size == (stop-1)//block_size:
+                ranges[-1] = start, row+1
+                continue
+        ranges.append((row, row+1))
+    return ranges
+
+class RowSubset(object):
+    '''
+    Wrapper around a 2D array (e.g. a tables.Array) that reads only the
+    requested rows
+
+    The requested rows may be in any order and can include duplicates.  On each
+    read, the rows are fetched using the minimal set of contiguous slices
+    (aligned to the chunk layout of the array if available, see
+    `coalesce_rows`) and returned in the requested order.  The wrapper can be
+    passed to `slice_overlap` and `chunk_iter` in lieu of the array.
+
+    Note that HDF5 reads and decompresses whole chunks.  By default, the
+    EArrays created by FileMixin use chunks that span all channels (e.g. all
+    channels by 8192 samples), so reading a subset of the rows still
+    decompresses every chunk in the requested range and the savings are limited
+    to the memory and processing of the rows that are not requested.  The I/O
+    is only reduced if the chunks span fewer rows (see the chunk_channels
+    setting of FileMixin and the data saved by `preprocess_waveform`).
+
+    >>> x = np.arange(20).reshape((5, 4))
+    >>> subset = RowSubset(x, [3, 0, 1])
+    >>> subset.shape
+    (3, 4)
+    >>> print subset[1]
+    [0 1 2 3]
+    >>> print subset[0:2]
+    [[12 13 14 15]
+     [ 0  1  2  3]]
+    >>> print subset[..., 1:3]
+    [[13 14]
+     [ 1  2]
+     [ 5  6]]
+    >>> print slice_overlap(subset, np.s_[0:2], 1, 1)
+    [[12 12 13 14]
+     [ 0  0  1  2]
+     [ 4  4  5  6]]
+    '''
+
+    def __init__(self, array, rows):
+        self.array = array
+        rows = np.asarray(rows, dtype=np.int).ravel() % array.shape[0]
+        unique_rows = np.unique(rows)
+        chunkshape = getattr(array, 'chunkshape', None)
+        block_size = chunkshape[0] if chunkshape else 1
+        self.ranges = coalesce_rows(unique_rows, block_size)
+
+        # Compute the location of each requested row in the array obtained by
+        # concatenating the ranges.
+        offsets = np.cumsum([0] + [stop-start for start, stop in self.ranges])
+        starts = np.array([start for start, stop in self.ranges], dtype=np.int)
+        i = np.searchsorted(starts, rows, side='right')-1
+        self.index = offsets[i] + rows - starts[i]
+        self.shape = (len(rows), array.shape[-1])
+        self.dtype = array.dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if len(key) == 1:
+            # A single index selects rows (as with a numpy array)
+            row_key, col_key = key, slice(None)
+        else:
+            row_key, col_key = key[:-1], key[-1]
+        if not self.ranges:
+            n = len(np.empty(self.shape[-1])[col_key])
+            return np.empty((0, n), dtype=self.dtype)[row_key]
+        blocks = [self.array[start:stop, col_key] for start, stop in
+                  self.ranges]
+        data = np.concatenate(blocks, axis=0)[self.index]
+        return data[row_key]
+
+def gather_windows(a, starts, n, fill_value=np.nan, key=(Ellipsis,), size=None,
+                   max_gap=0, max_samples=2**20):
+    '''
+    Extract a window of n samples beginning at each of the indices in starts
+    (along the last axis of a) and return them as a single array of shape
+    (len(starts),) + a[key].shape[:-1] + (n,)
+
+    Rather than reading each window individually, the windows are sorted and
+    overlapping (or adjacent) windows are merged so that each range of samples
+    is read from the array only once.  This is important when a is a HDF5 array
+    since each read has a fixed overhead.
+
+    Parameters
+    ----------
+    a : array-like
+        Array to extract the windows from.  This can be any object that supports
+        slicing (e.g. tables.Array or a channel).
+    starts : array-like of int
+        Index of the first sample in each window.  Windows can be in any order.
+    n : int
+        Number of samples in each window
+    fill_value : scalar or None
+        Value to use for the portion of a window that falls outside the bounds
+        of the array.  If None, a ValueError is raised if any window is out of
+        bounds.  If the array dtype cannot represent fill_value (e.g. NaN with
+        integer data), the result is upcast.
+    key : tuple
+        Index to apply to the leading dimensions of the array (e.g.
+        ([0, 5],) to extract only the first and sixth rows).
+    size : int
+        Number of samples in the array.  Defaults to a.shape[-1].
+    max_gap : int
+        Windows separated by no more than max_gap samples are read as a single
+        range.  Increasing this reduces the number of reads at the cost of
+        reading data that is discarded.
+    max_samples : int
+        A range will not be extended past max_samples by merging windows.  This
+        bounds the amount of memory required when a large number of windows
+        overlap.
+
+    >>> x = np.arange(20).reshape((2, 10))
+    >>> print gather_windows(x, [6, 1, 2], 3)
+    [[[ 6  7  8]
+      [16 17 18]]
+    <BLANKLINE>
+     [[ 1  2  3]
+      [11 12 13]]
+    <BLANKLINE>
+     [[ 2  3  4]
+      [12 13 14]]]
+    >>> print gather_windows(x, [-1, 8], 3, fill_value=-1, key=(1,))
+    [[-1 10 11]
+     [18 19 -1]]
+    >>> print gather_windows(x[0], [-1, 8], 3)
+    [[nan  0.  1.]
+     [ 8.  9. nan]]
+    '''
+    starts = np.asarray(starts, dtype=np.int).ravel()
+    n = int(n)
+    if size is None:
+        size = a.shape[-1]
+    if not isinstance(key, tuple):
+        key = (key,)
+
+    lbs = np.clip(starts, 0, size)
+    ubs = np.clip(starts+n, 0, size)
+    inside = (starts >= 0) & (starts+n <= size)
+    if fill_value is None and not inside.all():
+        raise ValueError, 'Window extends beyond the bounds of the array'
+
+    # Sort the windows and merge them into the minimal set of ranges to read
+    order = np.argsort(lbs, kind='mergesort')
+    order = order[(ubs > lbs)[order]]
+    ranges = []
+    for i in order:
+        lb, ub = lbs[i], ubs[i]
+        if ranges and lb <= ranges[-1][1]+max_gap and \
+                max(ub, ranges[-1][1])-ranges[-1][0] <= max_samples:
+            ranges[-1][1] = max(ub, ranges[-1][1])
+            ranges[-1][2].append(i)
+        else:
+            ranges.append([lb, ub, [i]])
+
+    def allocate(shape, dtype):
+        if fill_value is None or inside.all():
+            return np.empty(shape, dtype=dtype)
+        if not np.can_cast(np.min_scalar_type(fill_value), dtype):
+            dtype = np.result_type(dtype, fill_value)
+        out = np.empty(shape, dtype=dtype)
+        out.fill(fill_value)
+        return out
+
+    out = None
+    for lb, ub, indices in ranges:
+        data = np.asarray(a[key + (slice(lb, ub),)])
+        if out is None:
+            out = allocate((len(starts),) + data.shape[:-1] + (n,), data.dtype)
+        indices = np.array(indices)
+        # Windows that lie entirely within the array can be extracted with a
+        # single fancy-indexing operation.
+        full = indices[inside[indices]]
+        if len(full):
+            offsets = (starts[full]-lb)[:, np.newaxis] + np.arange(n)
+            windows = data[..., offsets]
+            out[full] = np.rollaxis(windows, -2)
+        for i in indices[~inside[indices]]:
+            o = lbs[i]-starts[i]
+            out[i, ..., o:o+ubs[i]-lbs[i]] = data[..., lbs[i]-lb:ubs[i]-lb]
+
+    if out is None:
+        # None of the windows overlap the data
+        data = np.asarray(a[key + (slice(0, 0),)])
+        out = allocate((len(starts),) + data.shape[:-1] + (n,), data.dtype)
+    return out
+
 def _get_padding(x, n, where='start', padding='const', axis=-1):
     '''
     Return the padding required for the array
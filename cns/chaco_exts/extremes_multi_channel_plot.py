@@ -5,7 +5,7 @@ from traits.api import Instance, on_trait_change
 import numpy as np
 from .extremes_channel_plot import ExtremesChannelPlot
 
-from traits.api import List, Float, Property, cached_property
+from traits.api import List, Float, Property, cached_property, Any
 
 class ExtremesMultiChannelPlot(ExtremesChannelPlot):
 
@@ -21,21 +21,51 @@ class ExtremesMultiChannelPlot(ExtremesChannelPlot):
     offsets = Property(depends_on='channel_+, value_mapper.updated')
     screen_offsets = Property(depends_on='offsets')
 
+    # If the source maintains an overview pyramid (see
+    # cns.channel.FileMultiChannel), the extremes are read directly from the
+    # pyramid when zoomed out.  This holds the (time, mins, maxes) tuple
+    # returned by the source.
+    _cached_overview = Any
+
     @on_trait_change('channel_spacing, channel_visible')
     def _update_value_mapper(self):
         high_setting = len(self.channel_visible) * self.channel_spacing
         self.value_mapper.range.high_setting = high_setting
         self.value_mapper.range.low_setting = 0
 
+    def _use_overview(self):
+        levels = getattr(self.source, 'overview_levels', 0)
+        return levels and self.draw_mode == 'ptp' and \
+            self.dec_factor >= self.source.overview_factor
+
     def _gather_points(self):
         if not self._data_cache_valid:
             range = self.index_mapper.range
-            data = self.source.get_range(range.low, range.high,
-                                         channels=self.channel_visible)
-            self._cached_data = data
+            if self._use_overview():
+                overview = self.source.get_range_extremes(range.low,
+                        range.high, self.dec_factor,
+                        channels=self.channel_visible)
+                self._cached_overview = overview
+                self._cached_data = overview[1]
+            else:
+                data = self.source.get_range(range.low, range.high,
+                                             channels=self.channel_visible)
+                self._cached_overview = None
+                self._cached_data = data
             self._data_cache_valid = True
             self._screen_cache_valid = False
 
+    def _get_screen_points(self):
+        if self._cached_overview is None:
+            return super(ExtremesMultiChannelPlot, self)._get_screen_points()
+        if not self._screen_cache_valid:
+            t, mins, maxes = self._cached_overview
+            self._cached_screen_index = self.index_mapper.map_screen(t)
+            self._cached_screen_data = self._map_screen(mins), \
+                self._map_screen(maxes)
+            self._screen_cache_valid = True
+        return self._cached_screen_index, self._cached_screen_data
+
     def _channel_offset_changed(self):
         self._invalidate_screen()
 
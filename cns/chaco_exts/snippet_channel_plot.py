@@ -29,9 +29,16 @@ class SnippetChannelPlot(BaseChannelPlot):
     def _get_index_screen(self):
         return self.index_mapper.map_screen(self.index_data)
 
+    def _snippet_bounds(self):
+        # Only read the snippets that will be plotted
+        ub = len(self.source._buffer)
+        lb = max(self.last_reset, ub-self.history)
+        return lb, ub
+
     @cached_property
     def _get_value_data(self):
-        return self.source[self.last_reset:][-self.history:]
+        lb, ub = self._snippet_bounds()
+        return self.source[lb:ub]
 
     @cached_property
     def _get_value_screen(self):
@@ -39,7 +46,8 @@ class SnippetChannelPlot(BaseChannelPlot):
 
     @cached_property
     def _get_classifier_masks(self):
-        classifiers = self.source.classifiers[self.last_reset:][-self.history:]
+        lb, ub = self._snippet_bounds()
+        classifiers = self.source.classifiers[lb:ub]
         return [c==classifiers for c in np.unique(classifiers)]
 
     def _configure_gc(self, gc):
@@ -8,10 +8,10 @@
 .. moduleauthor:: Brad Buran <bburan@alum.mit.edu>
 
 The majority of these containers are backed by a HDF5 datastore (e.g. an EArray)
-for acquiring and caching data.  If you just want a temporary dataset, create a
-temporary array.  However, if you wish to have an in-memory datastore, you can
-define a MemoryMixin class (see :class:`FileMixin`) that implements a
-__getitem__ method.
+for acquiring and caching data.  If you just want a temporary dataset (e.g. data
+derived from the raw data for display during an experiment), use the RAM-backed
+containers (see :class:`RAMMixin`).  These hold only the most recent data in a
+fixed-size ring buffer.
 '''
 
 from traits.api import HasTraits, Property, Array, Int, Event, \
@@ -20,11 +20,381 @@ from traits.api import HasTraits, Property, Array, Int, Event, \
 import numpy as np
 import tables
 from scipy import signal
-from .arraytools import slice_overlap
+from collections import OrderedDict, deque
+from itertools import islice
+from array import array
+import weakref
+import atexit
+import time
+import threading
+from .arraytools import slice_overlap, RowSubset, gather_windows
+from .sigtools import (sosfiltfilt, processing_filter_sos,
+                       processing_padding)
+from .checkpoint import fingerprint
 
 import logging
 log = logging.getLogger(__name__)
 
+def _requested_channels(key):
+    '''
+    Return the channels requested by the leading (non-time) elements of an
+    index into a multichannel array as a 1D array, or None if all channels are
+    requested (or the index is too complex to interpret).
+
+    >>> print _requested_channels((2,))
+    [2]
+    >>> print _requested_channels(([3, 1],))
+    [3 1]
+    >>> print _requested_channels((np.array([True, False, True]),))
+    [0 2]
+    >>> print _requested_channels((slice(None),))
+    None
+    '''
+    if len(key) != 1:
+        return None
+    key = key[0]
+    if isinstance(key, (int, long, np.integer)):
+        return np.array([key])
+    if np.iterable(key):
+        key = np.asarray(key)
+        # A boolean mask selects the channels where it is True
+        if key.dtype == np.bool:
+            return np.flatnonzero(key)
+        return key.astype(np.int)
+    return None
+
+class BlockCache(object):
+    '''
+    Least-recently-used cache of arrays bounded by total memory size
+
+    Parameters
+    ----------
+    max_bytes : int
+        Maximum number of bytes held by the cache.  When adding a new array
+        would exceed this, the least-recently-used arrays are discarded.  Arrays
+        larger than max_bytes are never cached.
+
+    >>> cache = BlockCache(max_bytes=160)
+    >>> cache[0] = np.zeros(10)
+    >>> cache[1] = np.ones(10)
+    >>> 0 in cache
+    True
+    >>> cache[2] = np.ones(10)
+    >>> 0 in cache, 1 in cache, 2 in cache
+    (False, True, True)
+    >>> cache.nbytes
+    160
+    '''
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._data = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def __getitem__(self, key):
+        # Move the item to the end of the ordered dictionary to mark it as
+        # recently used.
+        value = self._data.pop(key)
+        self._data[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        if key in self._data:
+            self.nbytes -= self._data.pop(key).nbytes
+        if value.nbytes > self.max_bytes:
+            return
+        self._data[key] = value
+        self.nbytes += value.nbytes
+        self.trim()
+
+    def trim(self):
+        '''
+        Discard least-recently-used arrays until the cache fits in max_bytes
+        '''
+        while self.nbytes > self.max_bytes:
+            key, value = self._data.popitem(last=False)
+            self.nbytes -= value.nbytes
+
+    def clear(self):
+        self._data.clear()
+        self.nbytes = 0
+
+class RingBuffer(object):
+    '''
+    Fixed-capacity in-memory buffer that discards the oldest samples once full
+
+    Provides the subset of the tables.EArray interface used by the channels
+    (shape, dtype, append and __getitem__).  The buffer grows along the axis
+    whose length is 0 in the initial shape (e.g. (channels, 0) for
+    multichannel data and (0, snippet_size) for snippets).  Indexing is
+    relative to the oldest sample still in the buffer.  Discarded counts the
+    total number of samples that have been dropped so owners can track the
+    time of the first sample.
+
+    To ensure the retained data is always contiguous in memory, storage for
+    twice the capacity is allocated.  When the end of the storage is reached,
+    the retained samples are moved back to the start.  This costs one copy of
+    the retained samples per capacity samples appended.
+
+    Reads return a copy of the requested samples since later appends overwrite
+    the storage.  Appends and reads are serialized by a lock so the buffer can
+    be filled by the acquisition thread while it is read by the plots.
+
+    >>> buffer = RingBuffer((2, 0), 4, np.int)
+    >>> buffer.append(np.arange(6).reshape((2, 3)))
+    >>> buffer.append(np.arange(6, 10).reshape((2, 2)))
+    >>> data = buffer[:]
+    >>> print data
+    [[1 2 6 7]
+     [4 5 8 9]]
+    >>> buffer.shape, buffer.discarded
+    ((2, 4), 1)
+    >>> buffer.append(np.arange(10, 14).reshape((2, 2)))
+    >>> buffer.append(np.arange(14, 18).reshape((2, 2)))
+    >>> print data
+    [[1 2 6 7]
+     [4 5 8 9]]
+    '''
+
+    def __init__(self, shape, capacity, dtype):
+        self.axis = list(shape).index(0)
+        self.capacity = int(capacity)
+        self.dtype = np.dtype(dtype)
+        storage = list(shape)
+        storage[self.axis] = 2*self.capacity
+        self._data = np.empty(storage, dtype=self.dtype)
+        self._lb = 0
+        self._ub = 0
+        self._lock = threading.Lock()
+        self.discarded = 0
+
+    def _slice(self, lb, ub):
+        s = [slice(None)]*self._data.ndim
+        s[self.axis] = slice(lb, ub)
+        return tuple(s)
+
+    def _view(self):
+        return self._data[self._slice(self._lb, self._ub)]
+
+    @property
+    def shape(self):
+        with self._lock:
+            return self._view().shape
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None):
+        with self._lock:
+            return np.array(self._view(), dtype=dtype)
+
+    def __getitem__(self, key):
+        with self._lock:
+            data = self._view()[key]
+            if isinstance(data, np.ndarray):
+                data = data.copy()
+            return data
+
+    def append(self, data):
+        data = np.asarray(data)
+        with self._lock:
+            self._append(data)
+
+    def _append(self, data):
+        n = data.shape[self.axis]
+        if n > self.capacity:
+            self.discarded += n-self.capacity
+            data = data[self._slice(n-self.capacity, n)]
+            n = self.capacity
+        if self._ub+n > self._data.shape[self.axis]:
+            # Move the samples that will be retained to the start of the
+            # storage.
+            keep = min(self._ub-self._lb, self.capacity-n)
+            self.discarded += self._ub-self._lb-keep
+            self._data[self._slice(0, keep)] = \
+                self._data[self._slice(self._ub-keep, self._ub)]
+            self._lb, self._ub = 0, keep
+        self._data[self._slice(self._ub, self._ub+n)] = data
+        self._ub += n
+        overflow = self._ub-self._lb-self.capacity
+        if overflow > 0:
+            self.discarded += overflow
+            self._lb += overflow
+
+# Buffers that have data waiting to be written to disk (see `flush_buffers`)
+_pending_buffers = weakref.WeakSet()
+
+def flush_buffers():
+    '''
+    Write any data held by an AppendBuffer to the underlying array.  This is
+    called automatically on exit; however, it should be called before closing
+    a file that channels have been writing to.
+    '''
+    for buffer in list(_pending_buffers):
+        if buffer.array._v_isopen:
+            buffer.flush()
+        else:
+            log.warn('%r was closed before pending data was written', buffer)
+            _pending_buffers.discard(buffer)
+
+atexit.register(flush_buffers)
+
+class AppendBuffer(object):
+    '''
+    Write-combining wrapper around an extendable array (i.e. tables.EArray)
+
+    Each call to EArray.append has a fixed overhead and may require reading,
+    modifying and rewriting a partially-filled chunk, so appending small blocks
+    of data at a high rate is expensive.  Appends are accumulated in memory and
+    written as a single block once max_samples (along the extendable
+    dimension) are pending or the oldest pending block is older than max_age
+    seconds.  The age is only checked when data is appended.  Call flush to
+    force pending data to be written.
+
+    Reads (via __getitem__, read, shape and len) include the pending data.
+    All other attributes are delegated to the array.  Appends, flushes and
+    reads share a lock, so data can be appended by the acquisition thread while
+    it is read by another thread (e.g. the plots).
+
+    max_samples
+        Number of samples to accumulate before writing.  Defaults to the
+        number of samples along the extendable dimension of a single chunk.
+    max_age
+        Maximum time (in seconds) data is held before writing
+    '''
+
+    def __init__(self, array, max_samples=None, max_age=1.0):
+        self.array = array
+        self.axis = array.maindim
+        if max_samples is None:
+            max_samples = array.chunkshape[self.axis]
+        self.max_samples = max_samples
+        self.max_age = max_age
+        self._pending = []
+        self._n_pending = 0
+        self._pending_time = None
+        self._lock = threading.RLock()
+
+    def __getattr__(self, name):
+        return getattr(self.array, name)
+
+    def __repr__(self):
+        return '<AppendBuffer {!r}>'.format(self.array)
+
+    @property
+    def shape(self):
+        with self._lock:
+            shape = list(self.array.shape)
+            shape[self.axis] += self._n_pending
+        return tuple(shape)
+
+    @property
+    def nrows(self):
+        return self.shape[self.axis]
+
+    def __len__(self):
+        return self.shape[0]
+
+    def append(self, data):
+        data = np.asarray(data, dtype=self.array.dtype)
+        expected = list(self.array.shape)
+        expected[self.axis] = data.shape[self.axis] if data.ndim else 0
+        if list(data.shape) != expected:
+            mesg = 'Shape of data {} does not match array {}'
+            raise ValueError, mesg.format(data.shape, self.array.shape)
+        with self._lock:
+            if not self._pending:
+                self._pending_time = time.time()
+                _pending_buffers.add(self)
+            self._pending.append(data)
+            self._n_pending += data.shape[self.axis]
+            if self._n_pending >= self.max_samples or \
+                    time.time()-self._pending_time >= self.max_age:
+                self.flush()
+
+    def flush(self):
+        with self._lock:
+            if self._pending:
+                self.array.append(self._pending_data())
+                self._pending = []
+                self._n_pending = 0
+                _pending_buffers.discard(self)
+
+    def _pending_data(self):
+        if len(self._pending) > 1:
+            self._pending = [np.concatenate(self._pending, axis=self.axis)]
+        return self._pending[0]
+
+    def _expand_key(self, key):
+        # Convert the key to a tuple with one entry per dimension (returns None
+        # if the key cannot be handled)
+        if not isinstance(key, tuple):
+            key = (key,)
+        ellipsis = [i for i, k in enumerate(key) if k is Ellipsis]
+        if len(ellipsis) > 1:
+            return None
+        if ellipsis:
+            i = ellipsis[0]
+            fill = (slice(None),)*(self.array.ndim-len(key)+1)
+            key = key[:i] + fill + key[i+1:]
+        if len(key) > self.array.ndim:
+            return None
+        return key + (slice(None),)*(self.array.ndim-len(key))
+
+    def __getitem__(self, key):
+        with self._lock:
+            return self._getitem(key)
+
+    def _getitem(self, key):
+        if not self._pending:
+            return self.array[key]
+        expanded = self._expand_key(key)
+        if expanded is None:
+            self.flush()
+            return self.array[key]
+
+        k = expanded[self.axis]
+        n_flushed = self.array.shape[self.axis]
+        n = n_flushed+self._n_pending
+
+        def with_index(index):
+            return expanded[:self.axis] + (index,) + expanded[self.axis+1:]
+
+        if isinstance(k, (int, long, np.integer)):
+            if k < 0:
+                k += n
+            if k < n_flushed:
+                return self.array[with_index(k)]
+            return self._pending_data()[with_index(k-n_flushed)]
+        elif isinstance(k, slice) and k.step in (None, 1):
+            lb, ub, _ = k.indices(n)
+            ub = max(lb, ub)
+            if ub <= n_flushed:
+                return self.array[with_index(slice(lb, ub))]
+            pending = self._pending_data()
+            pending_key = with_index(slice(max(0, lb-n_flushed), ub-n_flushed))
+            if lb >= n_flushed:
+                return pending[pending_key]
+            # The requested range straddles the flushed and pending data.
+            # Dimensions indexed by an integer are dropped from the result, so
+            # find where the extendable dimension ends up.
+            axis = len([i for i in expanded[:self.axis] if not
+                        isinstance(i, (int, long, np.integer))])
+            flushed = self.array[with_index(slice(lb, n_flushed))]
+            return np.concatenate((flushed, pending[pending_key]), axis=axis)
+        self.flush()
+        return self.array[key]
+
+    def read(self, start=None, stop=None, step=None):
+        return self[self._expand_key(Ellipsis)[:self.axis] + \
+                    (slice(start, stop, step),)]
+
 class FileMixin(HasTraits):
     '''
     Mixin class that uses a HDF5_ EArray as the backend for the buffer.  If the
@@ -72,6 +442,42 @@ class FileMixin(HasTraits):
 
     Note that if compression_level is > 0 and compression_type is None,
     tables.Filter will raise an exception.
+
+    chunk_samples
+        Length of each chunk along the extendable dimension of the array.  If
+        0, PyTables chooses the chunkshape based on expected_duration.
+    chunk_channels
+        Number of channels in each chunk of a multichannel array.  If 0, each
+        chunk spans all channels.  HDF5 reads and decompresses whole chunks, so
+        reading a subset of the channels only reduces the I/O if the chunks
+        span fewer channels (at the cost of slower reads of all channels).
+        Note that referencing to the average of the good channels reads all of
+        them anyway.  If chunk_samples is 0, chunks of 8192 samples are used.
+
+    The storage settings best suited to a given signal can be determined using
+    :func:`cns.storage.tune_storage`, which returns a profile (a dictionary of
+    the settings above) that can be passed to the constructor as keyword
+    arguments.
+
+    Write buffering properties
+    --------------------------
+    buffer_writes
+        Accumulate appended data in memory and write it to the array in larger
+        blocks (see :class:`AppendBuffer`).  Off by default, so data is written
+        to the array as soon as it is appended.  Turn it on for channels that
+        receive many small blocks (e.g. acquisition channels).
+    flush_samples
+        Number of samples to accumulate in memory before appending them to the
+        array.  If 0, defaults to the number of samples in a single chunk.
+    flush_age
+        Maximum time (in seconds) that data is held in memory before appending
+        it to the array.
+
+    Data that has not been written yet is only visible to reads through this
+    channel (not through the array or another channel opened on the same
+    node).  Call `flush` (or :func:`flush_buffers`) to force the data to be
+    written.  This must be done before closing the file, otherwise the pending
+    data is lost.
     '''
 
     # According to http://www.pytables.org/docs/manual-1.4/ch05.html the best
@@ -82,6 +488,8 @@ class FileMixin(HasTraits):
                                transient=True)
     use_checksum        = Bool(False, transient=True)
     use_shuffle         = Bool(False, transient=True)
+    chunk_samples       = Int(0, transient=True)
+    chunk_channels      = Int(0, transient=True)
 
     # It is important to implement dtype appropriately, otherwise it defaults to
     # float64 (double-precision float).
@@ -97,7 +505,12 @@ class FileMixin(HasTraits):
     # the EArray is stored under while name is the name of the EArray.
     node                = Instance(tables.group.Group, transient=True)
     name                = String('FileChannel', transient=True)
-    _buffer             = Instance(tables.array.Array, transient=True)
+    _array              = Instance(tables.array.Array, transient=True)
+    _buffer             = Instance(AppendBuffer, transient=True)
+
+    buffer_writes       = Bool(False, transient=True)
+    flush_samples       = Int(0, transient=True)
+    flush_age           = Float(1, transient=True)
 
     @classmethod
     def from_node(cls, node, **kwargs):
@@ -121,23 +534,44 @@ class FileMixin(HasTraits):
 
         kwargs['node'] = node._v_parent
         kwargs['name'] = node._v_name
-        kwargs['_buffer'] = node
+        kwargs['_array'] = node
         kwargs['dtype'] = node.dtype
         return cls(**kwargs)
 
     def _get_shape(self):
         return (0,)
 
+    def _append_buffer(self, array):
+        if not self.buffer_writes:
+            max_samples = 1
+        elif self.flush_samples:
+            max_samples = self.flush_samples
+        else:
+            max_samples = None
+        return AppendBuffer(array, max_samples, self.flush_age)
+
     def __buffer_default(self):
+        return self._append_buffer(self._array)
+
+    def __array_default(self):
         log.debug('%s: creating buffer with shape %r', self, self._get_shape())
         atom = tables.Atom.from_dtype(np.dtype(self.dtype))
         log.debug('%s: creating buffer with type %r', self, self.dtype)
         filters = tables.Filters(complevel=self.compression_level,
                 complib=self.compression_type, fletcher32=self.use_checksum,
                 shuffle=self.use_shuffle)
+        shape = self._get_shape()
+        if self.chunk_samples or self.chunk_channels:
+            chunk_samples = self.chunk_samples or 8192
+            chunkshape = [chunk_samples if n == 0 else n for n in shape]
+            if self.chunk_channels and len(shape) == 2 and shape[0]:
+                chunkshape[0] = min(self.chunk_channels, shape[0])
+        else:
+            chunkshape = None
         earray = self.node._v_file.create_earray(self.node._v_pathname,
-                self.name, atom, self._get_shape(), filters=filters,
-                expectedrows=int(self.fs*self.expected_duration))
+                self.name, atom, shape, filters=filters,
+                expectedrows=int(self.fs*self.expected_duration),
+                chunkshape=chunkshape)
         for k, v in self.trait_get(attr=True).items():
             earray._v_attrs[k] = v
         return earray
@@ -147,7 +581,7 @@ class FileMixin(HasTraits):
     @on_trait_change('+attr', post_init=True)
     def update_attrs(self, name, new):
         log.debug('%s: updating %s to %r', self, name, new)
-        self._buffer.setAttr(name, new)
+        self._array.setAttr(name, new)
 
     def _write(self, data):
         self._buffer.append(data)
@@ -155,9 +589,126 @@ class FileMixin(HasTraits):
     def append(self, data):
         self._buffer.append(data)
 
+    def flush(self):
+        '''
+        Write any data held in memory to the array
+        '''
+        self._buffer.flush()
+
     def __repr__(self):
         return '<HDF5Store {}>'.format(self.name)
 
+class RAMMixin(HasTraits):
+    '''
+    Mixin class that uses a fixed-capacity in-memory ring buffer (see
+    :class:`RingBuffer`) as the backend for the buffer.  This is meant for
+    temporary data that only needs to be available while the experiment is
+    running (e.g. filtered data or spike snippets for display) and avoids the
+    overhead of writing this data to a temporary HDF5 file.
+
+    Once the buffer is full, the oldest data is discarded and t0 is updated
+    accordingly.
+
+    Properties
+    ----------
+    dtype
+        Default is float64.
+    retention
+        Duration of data (in seconds) to retain.  Memory usage is bounded by
+        twice the number of bytes required to hold this duration of data.
+
+    Note that the buffer is sized when it is first accessed.  If fs or
+    retention are changed later, the buffer is resized (retaining the most
+    recent data that fits).
+    '''
+
+    dtype               = Any(transient=True)
+    retention           = Float(60, transient=True)
+    _buffer             = Instance(RingBuffer, transient=True)
+
+    def _get_shape(self):
+        return (0,)
+
+    def _get_capacity(self):
+        return int(np.ceil(self.retention*self.fs))
+
+    def __buffer_default(self):
+        return RingBuffer(self._get_shape(), self._get_capacity(), self.dtype)
+
+    @on_trait_change('fs, retention', post_init=True)
+    def _resize_buffer(self):
+        if self.traits_inited() and '_buffer' in self.__dict__:
+            old_buffer = self._buffer
+            self._buffer = RingBuffer(self._get_shape(), self._get_capacity(),
+                                      self.dtype)
+            self._append(old_buffer[:])
+
+    def _append(self, data):
+        discarded = self._buffer.discarded
+        self._buffer.append(data)
+        discarded = self._buffer.discarded-discarded
+        if discarded and self.fs:
+            # Compute in samples to avoid accumulating rounding error
+            self.t0 = (round(self.t0*self.fs)+discarded)/self.fs
+
+    def _write(self, data):
+        self._append(data)
+
+    def append(self, data):
+        self._append(data)
+
+    def __repr__(self):
+        return '<RAMStore {}>'.format(self.__class__.__name__)
+
+class EventCache(object):
+    '''
+    In-memory copy of an append-only array of events (e.g. timestamps or
+    epoch boundaries) that is extended incrementally
+
+    Each call to `update` reads only the rows that have been appended to the
+    array since the last call.  The cache also tracks whether the events (each
+    column if the array is 2D) are still in ascending order so range queries can
+    use a binary search rather than scanning every event.
+
+    >>> cache = EventCache(np.array([1, 4, 9]))
+    >>> cache.update(), cache.sorted
+    (array([1, 4, 9]), True)
+    >>> cache.array = np.array([1, 4, 9, 7])
+    >>> cache.update(), cache.sorted
+    (array([1, 4, 9, 7]), False)
+    '''
+
+    def __init__(self, array):
+        self.array = array
+        self.n = 0
+        self.sorted = True
+        self._data = None
+
+    def update(self):
+        n = len(self.array)
+        if n < self.n:
+            # The array has been truncated (or replaced), start over.
+            self.n = 0
+            self.sorted = True
+        if n > self.n:
+            new = np.asarray(self.array[self.n:n])
+            if self._data is None or len(self._data) < n:
+                # Grow the cache geometrically so the cost of copying the
+                # existing events is amortized over many updates.
+                data = np.empty((max(n, 2*self.n),)+new.shape[1:],
+                                dtype=new.dtype)
+                if self._data is not None:
+                    data[:self.n] = self._data[:self.n]
+                self._data = data
+            self._data[self.n:n] = new
+            if self.sorted:
+                lb = max(0, self.n-1)
+                self.sorted = bool((np.diff(self._data[lb:n], axis=0) >= 0).all())
+            self.n = n
+        if self._data is None:
+            return np.asarray(self.array[:0])
+        return self._data[:self.n]
+
 class Timeseries(HasTraits):
 
     updated = Event
@@ -165,15 +716,25 @@ class Timeseries(HasTraits):
     fs      = Float(attr=True)
     t0      = Float(0, attr=True)
 
+    _events = Any(transient=True)
+
     def send(self, timestamps):
         if len(timestamps):
             self.append(timestamps)
             self.added = np.array(timestamps)/self.fs
 
+    def _get_events(self):
+        if self._events is None:
+            self._events = EventCache(self._buffer)
+        return self._events.update()
+
     def get_range(self, lb, ub):
-        ts = self._buffer.read()
+        ts = self._get_events()
         ilb = int(lb*self.fs)
         iub = int(ub*self.fs)
+        if self._events.sorted:
+            i, j = np.searchsorted(ts, [ilb, iub])
+            return ts[i:j]/self.fs
         mask = (ts>=ilb) & (ts<iub)
         return ts[mask]/self.fs
 
@@ -203,12 +764,28 @@ class Epoch(HasTraits):
     fs = Float(attr=True)
     t0 = Float(0, attr=True)
 
+    _events = Any(transient=True)
+
+    def _get_events(self):
+        if self._events is None:
+            self._events = EventCache(self._buffer)
+        return self._events.update()
+
     def get_range(self, lb, ub):
-        timestamps = self._buffer[:]
+        timestamps = self._get_events()
         starts = timestamps[:,0]
         ends = timestamps[:,1]
         ilb = int(lb*self.fs)
         iub = int(ub*self.fs)
+        if self._events.sorted:
+            # Find the epochs that start within the range and the epochs that
+            # end within the range.  Epochs that span the entire range are not
+            # included (this matches the masks below), so the two sets of
+            # epochs are not necessarily contiguous.
+            s_lb, s_ub = np.searchsorted(starts, [ilb, iub])
+            e_lb, e_ub = np.searchsorted(ends, [ilb, iub])
+            i = np.union1d(np.arange(s_lb, s_ub), np.arange(e_lb, e_ub))
+            return timestamps[i.astype(np.int)].reshape((-1, 2))/self.fs
         start_mask = (starts >= ilb) & (starts < iub)
         end_mask = (ends >= ilb) & (ends < iub)
         mask = start_mask | end_mask
@@ -340,6 +917,43 @@ class Channel(HasTraits):
         else:
             return self[..., lb:ub]
 
+    def gather_index(self, start, end, references, fill_value=np.nan):
+        '''
+        Returns the segment [start, end) relative to each reference as a single
+        array of shape (references, samples).  All values are in samples
+        relative to the start of data acquisition (see `get_range_index`).
+
+        This is much faster than calling get_range_index for each reference
+        since overlapping segments are read from the buffer only once (see
+        `cns.arraytools.gather_windows`).  The portion of a segment that falls
+        outside the acquired data is set to fill_value.  If fill_value is None,
+        a ValueError is raised instead.
+        '''
+        return self._gather_index(start, end, references, fill_value,
+                                  (Ellipsis,))
+
+    def gather(self, start, end, references, fill_value=np.nan):
+        '''
+        Returns the segment [start, end) relative to each reference time as a
+        single array of shape (references, samples).  Start and end are in
+        seconds relative to the reference times (e.g. -0.1 and 0.5 to get the
+        100 ms preceding and the 500 ms following each trial).  See
+        `gather_index`.
+        '''
+        return self._gather(start, end, references, fill_value, (Ellipsis,))
+
+    def _gather(self, start, end, references, fill_value, key):
+        references = np.asarray(references, dtype=np.float64)
+        starts = np.floor((references+start)*self.fs).astype(np.int)
+        n = int(round((end-start)*self.fs))
+        return self._gather_index(0, n, starts, fill_value, key)
+
+    def _gather_index(self, start, end, references, fill_value, key):
+        t0_index = int(self.t0*self.fs)
+        starts = np.asarray(references, dtype=np.int)+start-t0_index
+        return gather_windows(self, starts, end-start, fill_value, key,
+                              size=self.get_size())
+
     def get_index(self, index, reference=0):
         t0_index = int(self.t0*self.fs)
         index = max(0, index-t0_index+reference)
@@ -400,14 +1014,14 @@ class Channel(HasTraits):
         '''
         Write data to buffer.
         '''
-        lb = self.get_size()
+        lb = self.get_bounds()[1]
         self._write(data)
-        ub = self.get_size()
+        ub = self.get_bounds()[1]
 
         # Updated has the upper and lower bound of the data that was added.
         # Some plots will use this to determine whether the updated region of
         # the data is within the visible region.  If not, no update is made.
-        self.added = lb/self.fs, ub/self.fs
+        self.added = lb, ub
 
     def summarize(self, timestamps, offset, duration, fun):
         if len(timestamps) == 0:
@@ -432,7 +1046,13 @@ class Channel(HasTraits):
         # (the timestamp) is already in the correct units, we don't need to
         # convert it.
         if np.iterable(timestamps):
-            range = self.get_range_index(lb_index, ub_index, timestamps)
+            try:
+                range = self.gather_index(lb_index, ub_index, timestamps,
+                                          fill_value=None)
+            except ValueError:
+                # At least one of the segments extends past the bounds of the
+                # data.  Fall back to extracting the segments one at a time.
+                range = self.get_range_index(lb_index, ub_index, timestamps)
             return np.array([fun(r) for r in range])
         else:
             range = self.get_range_index(lb_index, ub_index, timestamps)
@@ -450,6 +1070,13 @@ class FileChannel(FileMixin, Channel):
     name  = 'FileChannel'
     dtype = Any(np.float32)
 
+class RAMChannel(RAMMixin, Channel):
+    '''
+    Uses an in-memory ring buffer for the buffer
+    '''
+
+    dtype = Any(np.float32)
+
 class ProcessedChannel(Channel):
     '''
     References and filters the data when requested
@@ -463,10 +1090,21 @@ class ProcessedChannel(Channel):
     filter_type         = Enum('butter', 'ellip', 'cheby1', 'cheby2', 'bessel',
                                filter=True)
 
+    # Filter implementation.  'ba' applies the transfer function coefficients
+    # using filtfilt and pads each chunk by 3*filter_order samples (as it
+    # always has).  'sos' applies the filter as second-order sections
+    # initialized to the steady-state response at the chunk edges, which is
+    # numerically stable at higher orders, and pads each chunk by the length
+    # of the impulse response so the edges are stable (see
+    # `cns.sigtools.processing_padding`).
+    filter_method       = Enum('ba', 'sos', filter=True)
+
     filter_instable     = Property(depends_on='filter_coefficients')
     filter_coefficients = Property(depends_on='+filter, fs')
+    filter_sos          = Property(depends_on='+filter, fs')
 
-    _padding            = Property(depends_on='filter_order')
+    _padding            = Property(depends_on='filter_order, filter_method, '
+                                   'filter_sos')
 
     @cached_property
     def _get_filter_instable(self):
@@ -500,9 +1138,16 @@ class ProcessedChannel(Channel):
                                 btype=self.filter_btype,
                                 output='ba')
 
+    @cached_property
+    def _get_filter_sos(self):
+        return processing_filter_sos(self.fs, self.filter_btype,
+                                     self.filter_freq_hp, self.filter_freq_lp,
+                                     self.filter_order, self.filter_type)
+
     @cached_property
     def _get__padding(self):
-        return 3*self.filter_order
+        sos = self.filter_sos[0] if self.filter_method == 'sos' else None
+        return processing_padding(self.filter_order, self.filter_method, sos)
 
     def __getitem__(self, slice):
         # We need to stabilize the edges of the chunk with extra data from
@@ -515,7 +1160,10 @@ class ProcessedChannel(Channel):
         # For the filtering, we do not need all the channels, so we can throw
         # out the extra channels by slicing along the second axis
         # data = data[slice[:-1]]
-        if self.filter_btype is not None:
+        if self.filter_btype is not None and self.filter_method == 'sos':
+            sos, zi = self.filter_sos
+            data = sosfiltfilt(sos, data, zi)
+        elif self.filter_btype is not None:
             b, a = self.filter_coefficients
             # Since we have already padded the data at both ends padlen can be
             # set to 0.  The "unstable" edges of the filtered waveform will be
@@ -539,11 +1187,24 @@ class MultiChannel(Channel):
         if len(data):
             self.write(data)
 
+    def __getitem__(self, slice):
+        '''
+        Delegates to the __getitem__ method on the underlying buffer.  If a
+        subset of the channels is requested, only those rows are read from the
+        buffer (see `RowSubset`).
+        '''
+        if not isinstance(slice, tuple):
+            return self._buffer[slice]
+        channels = _requested_channels(slice[:-1])
+        if channels is None or np.ndim(slice[0]) == 0:
+            return self._buffer[slice]
+        return RowSubset(self._buffer, channels)[..., slice[-1]]
+
     def get_range(self, start, end, reference=None, channels=None):
         lb, ub = self._to_bounds(start, end, reference)
         if channels is None:
             channels = Ellipsis
-        return self[..., lb:ub][channels]
+        return self[channels, lb:ub]
 
     def get_range_index(self, start, end, reference=0, check_bounds=False,
                         channels=None):
@@ -582,6 +1243,27 @@ class MultiChannel(Channel):
             return self[channels, lb:ub]
 
 
+    def gather_index(self, start, end, references, fill_value=np.nan,
+                     channels=None):
+        '''
+        Returns the segment [start, end) relative to each reference as a single
+        array of shape (references, channels, samples).  See
+        `Channel.gather_index`.  If channels is provided, only those channels
+        are read.
+        '''
+        key = (Ellipsis,) if channels is None else (channels,)
+        return self._gather_index(start, end, references, fill_value, key)
+
+    def gather(self, start, end, references, fill_value=np.nan, channels=None):
+        '''
+        Returns the segment [start, end) relative to each reference time as a
+        single array of shape (references, channels, samples).  See
+        `Channel.gather`.  If channels is provided, only those channels are
+        read.
+        '''
+        key = (Ellipsis,) if channels is None else (channels,)
+        return self._gather(start, end, references, fill_value, key)
+
     def summarize(self, timestamps, offset, duration, fun, channels=None):
         if len(timestamps) == 0:
             return np.array([])
@@ -605,8 +1287,12 @@ class MultiChannel(Channel):
         # (the timestamp) is already in the correct units, we don't need to
         # convert it.
         if np.iterable(timestamps):
-            range = self.get_range_index(lb_index, ub_index, timestamps,
-                                         channels=channels)
+            try:
+                range = self.gather_index(lb_index, ub_index, timestamps,
+                                          fill_value=None, channels=channels)
+            except ValueError:
+                range = self.get_range_index(lb_index, ub_index, timestamps,
+                                             channels=channels)
             return np.array([fun(r) for r in range])
         else:
             range = self.get_range_index(lb_index, ub_index, timestamps,
@@ -617,6 +1303,23 @@ class MultiChannel(Channel):
 class ProcessedMultiChannel(MultiChannel):
     '''
     References and filters the data when requested
+
+    If cache_bytes is nonzero, the referenced and filtered data is cached in
+    blocks of cache_block_samples (all channels) so that overlapping reads
+    (e.g. panning back and forth through a plot) reuse the already processed
+    blocks.  Blocks are keyed by the block index along with the filter and
+    referencing settings, so changing the settings does not require flushing
+    the cache.  Blocks near the end of the data (where the filter padding
+    would extend past the last sample) are never cached since they will
+    change as data is acquired.  If the raw data is modified (e.g. truncated
+    or zeroed), call `clear_cache` to discard the processed blocks.
+
+    If sidecar is set to a group containing copies of the data that were
+    referenced and filtered ahead of time (see
+    `cns.analysis.preprocess_waveform`) and one of the copies was generated
+    with the current settings, the data is read from that copy rather than
+    processed.  The copies are identified by a fingerprint of the settings, so
+    the sidecar is used (or ignored) as the settings are changed.
     '''
 
     # Channels in the list should use zero-based indexing (e.g. the first
@@ -624,6 +1327,7 @@ class ProcessedMultiChannel(MultiChannel):
     bad_channels        = Array(dtype='int')
     diff_mode           = Enum('all good', None)
     diff_matrix         = Property(depends_on='bad_channels, diff_mode, channels')
+    _reference_weights  = Property(depends_on='bad_channels, channels')
 
     filter_freq_lp      = Float(6e3, filter=True)
     filter_freq_hp      = Float(300, filter=True)
@@ -633,16 +1337,91 @@ class ProcessedMultiChannel(MultiChannel):
     filter_type         = Enum('butter', 'ellip', 'cheby1', 'cheby2', 'bessel',
                                filter=True)
 
+    # Filter implementation.  'ba' applies the transfer function coefficients
+    # using filtfilt and pads each chunk by 3*filter_order samples (as it
+    # always has).  'sos' applies the filter as second-order sections
+    # initialized to the steady-state response at the chunk edges, which is
+    # numerically stable at higher orders, and pads each chunk by the length
+    # of the impulse response so the edges are stable (see
+    # `cns.sigtools.processing_padding`).
+    filter_method       = Enum('ba', 'sos', filter=True)
+
     filter_instable     = Property(depends_on='filter_coefficients')
     filter_coefficients = Property(depends_on='+filter, fs')
+    filter_sos          = Property(depends_on='+filter, fs')
 
-    _padding            = Property(depends_on='filter_order')
+    _padding            = Property(depends_on='filter_order, filter_method, '
+                                   'filter_sos')
+
+    # Maximum size (in bytes) of the cache of processed blocks.  Set to 0 to
+    # disable caching.
+    cache_bytes         = Float(0, transient=True)
+    cache_block_samples = Int(2**15, transient=True)
+    _cache              = Any(transient=True)
+    _cache_config       = Property(depends_on='_settings, cache_block_samples')
+
+    # Group containing the preprocessed copies of the data.  The copy that
+    # matches the current settings (if any) is stored in the group named
+    # _sidecar_name.
+    sidecar             = Any(transient=True)
+    _sidecar_name       = Property(depends_on='_settings')
+    _sidecar_array      = Property(depends_on='sidecar, _sidecar_name')
+
+    # Settings that determine the processed data
+    _settings           = Property(depends_on='+filter, fs, bad_channels, '
+                                   'diff_mode')
 
     @cached_property
     def _get_filter_instable(self):
         b, a = self.filter_coefficients
         return not np.all(np.abs(np.roots(a)) < 1)
 
+    @cached_property
+    def _get__settings(self):
+        settings = sorted(self.trait_get(filter=True).items())
+        return (tuple(settings), self.fs, self.diff_mode,
+                tuple(np.unique(self.bad_channels)))
+
+    @cached_property
+    def _get__cache_config(self):
+        return self._settings, self.cache_block_samples
+
+    @cached_property
+    def _get__sidecar_name(self):
+        return 'processed_' + fingerprint(self._settings)
+
+    @cached_property
+    def _get__sidecar_array(self):
+        if self.sidecar is None or self._sidecar_name not in self.sidecar:
+            return None
+        group = self.sidecar._f_get_child(self._sidecar_name)
+        if 'data' not in group:
+            return None
+        array = group.data
+        # The copy is incomplete if preprocessing was interrupted
+        if array.shape[-1] != self.n_samples:
+            return None
+        return array
+
+    def _cache_bytes_changed(self, new):
+        if self._cache is not None:
+            self._cache.max_bytes = new
+            self._cache.trim()
+
+    def _sidecar_changed(self):
+        # The preprocessed data is quantized, so blocks read from the sidecar
+        # are not identical to the blocks processed from the raw data.
+        self.clear_cache()
+
+    def clear_cache(self):
+        '''
+        Discard the cached blocks of processed data.  This must be called when
+        the raw data is modified.
+        '''
+        if self._cache is not None:
+            self._cache.clear()
+        self.changed = True
+
     @on_trait_change('filter_coefficients, diff_matrix')
     def _fire_change(self):
         # Objects that use this channel as a datasource need to know when the
@@ -655,25 +1434,67 @@ class ProcessedMultiChannel(MultiChannel):
 
     @cached_property
     def _get_diff_matrix(self):
-        if self.diff_mode is None:
-            return np.identity(self.channels)
-        else:
-            matrix = np.identity(self.channels)
+        # The differential matrix is no longer used to reference the data (see
+        # `_reference`); however, it is still saved alongside the processed
+        # data as a record of how the data was referenced.
+        matrix = np.identity(self.channels)
+        if self.diff_mode is not None:
+            good, weight = self._reference_weights
+            matrix[np.ix_(good, good)] = -weight
+            matrix[good, good] = 1
+            matrix[~good, ~good] = 0
+        return matrix
 
-            # If all but one channel is bad, this will raise a
-            # ZeroDivisionError.  I'm going to let this error "bubble up" since
-            # the user should realize that they are no longer referencing their
-            # data in that situation.
-            weight = 1.0/(self.channels-1-len(self.bad_channels))
+    @cached_property
+    def _get__reference_weights(self):
+        good = ~np.in1d(np.arange(self.channels), self.bad_channels)
 
-            for r in range(self.channels):
-                if r in self.bad_channels:
-                    matrix[r, r] = 0
-                else:
-                    for i in range(self.channels):
-                        if (not i in self.bad_channels) and (i != r):
-                            matrix[r, i] = -weight
-            return matrix
+        # If all but one channel is bad, this will raise a ZeroDivisionError.
+        # I'm going to let this error "bubble up" since the user should realize
+        # that they are no longer referencing their data in that situation.
+        weight = 1.0/(self.channels-1-len(self.bad_channels))
+        return good, weight
+
+    def _reference_channels(self, channels):
+        '''
+        Return the sorted list of channels that must be read to reference the
+        requested channels
+        '''
+        if self.diff_mode is None:
+            return np.unique(channels)
+        good, _ = self._reference_weights
+        return np.union1d(channels, np.flatnonzero(good))
+
+    def _reference(self, data, channels=None):
+        '''
+        Reference each good channel against the average of the remaining good
+        channels and zero out the bad channels
+
+        If data only contains a subset of the channels, channels must indicate
+        which channel each row corresponds to.  The subset must include all
+        good channels (see `_reference_channels`).
+
+        This is equivalent to `diff_matrix.dot(data)`; however, it requires a
+        single sum across the good channels per sample rather than a
+        (channels x channels) matrix product.  The signal on each good channel,
+        x_r, is referenced as x_r - weight*(S-x_r) where S is the sum of all
+        good channels.  This can be rewritten as (1+weight)*x_r - weight*S.
+        '''
+        data = np.array(data, dtype=np.float64)
+        if self.diff_mode is None:
+            return data
+        good, weight = self._reference_weights
+        if channels is not None:
+            good = good[channels]
+        # Operate in-place on the entire array (rather than using fancy
+        # indexing to select the good channels) to avoid creating temporary
+        # copies of the data.  The bad channels are zeroed out at the end.
+        total = good.astype(np.float64).dot(data)
+        total *= weight
+        data *= 1+weight
+        data -= total
+        data[~good] = 0
+        return data
 
     @cached_property
     def _get_filter_coefficients(self):
@@ -692,26 +1513,141 @@ class ProcessedMultiChannel(MultiChannel):
                                 btype=self.filter_btype,
                                 output='ba')
 
+    @cached_property
+    def _get_filter_sos(self):
+        return processing_filter_sos(self.fs, self.filter_btype,
+                                     self.filter_freq_hp, self.filter_freq_lp,
+                                     self.filter_order, self.filter_type)
+
     @cached_property
     def _get__padding(self):
-        return 3*self.filter_order
+        sos = self.filter_sos[0] if self.filter_method == 'sos' else None
+        return processing_padding(self.filter_order, self.filter_method, sos)
 
     def __getitem__(self, slice):
+        time_slice = slice[-1]
+        if self.cache_bytes and time_slice.step in (None, 1):
+            lb, ub, _ = time_slice.indices(self.n_samples)
+            return self._get_cached(lb, ub)[slice[:-1]]
+        return self._process(slice)
+
+    def _get_cached(self, lb, ub):
+        '''
+        Return all channels of the processed data in the range [lb, ub),
+        reusing processed blocks from the cache where possible.
+
+        With filter_method='sos', the padding (see `_padding`) is long enough
+        for the transient at the edges of each run of processed blocks to
+        decay, so the result does not depend on which blocks were already
+        cached.  With 'ba', the shorter padding leaves small differences at the
+        edges of the runs.
+
+        >>> x = np.random.RandomState(0).normal(size=(4, 10000))
+        >>> channel = ProcessedMultiChannel(channels=4, fs=25e3)
+        >>> channel.filter_method = 'sos'
+        >>> channel.cache_bytes = 1e6
+        >>> channel.cache_block_samples = 1000
+        >>> channel._buffer = x
+        >>> uncached = channel._process(np.s_[..., 1000:9000])
+        >>> cached = channel._get_cached(1500, 2500)
+        >>> cached = channel._get_cached(1000, 9000)
+        >>> np.abs(cached-uncached).max() < 0.05*uncached.std()
+        True
+        >>> channel[:, 10500:12000].shape
+        (4, 0)
+        '''
+        if lb >= ub:
+            return np.empty((self.channels, 0))
+        if self._cache is None:
+            self._cache = BlockCache(self.cache_bytes)
+        block_samples = self.cache_block_samples
+        config = self._cache_config
+
+        # Only blocks whose right padding lies entirely within the acquired
+        # data can be cached.
+        cache_ub = int((self.n_samples-self._padding)//block_samples)
+        cache_ub = min(ub, cache_ub*block_samples)
+
+        pieces = []
+        if lb < cache_ub:
+            first = lb//block_samples
+            last = -(-cache_ub//block_samples)
+            blocks = []
+            i = first
+            while i < last:
+                if (i, config) in self._cache:
+                    blocks.append(self._cache[i, config])
+                    i += 1
+                    continue
+                # Process the entire run of missing blocks at once to minimize
+                # the number of reads (and the amount of padding) required.
+                j = i+1
+                while j < last and (j, config) not in self._cache:
+                    j += 1
+                s = np.s_[..., i*block_samples:j*block_samples]
+                data = self._process(s)
+                for k in range(i, j):
+                    o = (k-i)*block_samples
+                    # Store a copy so the cache does not hold a reference to
+                    # (and undercount the size of) the entire run.
+                    block = data[..., o:o+block_samples].copy()
+                    self._cache[k, config] = block
+                    blocks.append(block)
+                i = j
+            offset = first*block_samples
+            data = np.concatenate(blocks, axis=-1)
+            pieces.append(data[..., lb-offset:cache_ub-offset])
+            lb = cache_ub
+        if lb < ub:
+            pieces.append(self._process(np.s_[..., lb:ub]))
+        return np.concatenate(pieces, axis=-1)
+
+    def _read_sidecar(self, array, slice):
+        # The preprocessed data is stored as a compact integer or float type
+        # and must be multiplied by the scaling factor for each channel.
+        scale = array._v_attrs['scale'][:, np.newaxis]
+        channels = _requested_channels(slice[:-1])
+        if channels is None or np.ndim(slice[0]) == 0:
+            data = array[slice]
+        else:
+            data = RowSubset(array, channels)[..., slice[-1]]
+        return data*scale[slice[:-1]]
+
+    def _process(self, slice):
+        array = self._sidecar_array
+        if array is not None:
+            return self._read_sidecar(array, slice)
+
         # We need to stabilize the edges of the chunk with extra data from
         # adjacent chunks.  Expand the time slice to obtain this extra data.
         padding = self._padding
-        data = slice_overlap(self._buffer, slice[-1], padding, padding)
+        channels = _requested_channels(slice[:-1])
+        if channels is None:
+            data = slice_overlap(self._buffer, slice[-1], padding, padding)
+        else:
+            # Only read the channels we need: the requested channels plus the
+            # channels the reference depends on.
+            channels = channels % self.channels
+            rows = self._reference_channels(channels)
+            buffer = RowSubset(self._buffer, rows)
+            data = slice_overlap(buffer, slice[-1], padding, padding)
 
         # It does not matter whether we compute the differential first or apply
         # the filter.  Since the differential requires data from all channels
         # while filtering does not, we compute the differential first then throw
         # away the channels we do not need.
-        data = self.diff_matrix.dot(data)
-
-        # For the filtering, we do not need all the channels, so we can throw
-        # out the extra channels by slicing along the second axis
-        data = data[slice[:-1]]
-        if self.filter_btype is not None:
+        if channels is None:
+            data = self._reference(data)
+            data = data[slice[:-1]]
+        else:
+            data = self._reference(data, rows)
+            data = data[np.searchsorted(rows, channels)]
+            if np.ndim(slice[0]) == 0:
+                data = data[0]
+        if self.filter_btype is not None and self.filter_method == 'sos':
+            sos, zi = self.filter_sos
+            data = sosfiltfilt(sos, data, zi)
+        elif self.filter_btype is not None:
             b, a = self.filter_coefficients
             # Since we have already padded the data at both ends padlen can be
             # set to 0.  The "unstable" edges of the filtered waveform will be
@@ -723,60 +1659,381 @@ class ProcessedFileMultiChannel(FileMixin, ProcessedMultiChannel):
     pass
 
 class FileMultiChannel(FileMixin, MultiChannel):
+    '''
+    Multichannel data using a HDF5 node as the datastore
+
+    If overview_levels is nonzero, a min/max overview pyramid is maintained
+    alongside the EArray as data is written.  The pyramid is stored in a group
+    named `<name>_overview` under the same node.  Level n of the pyramid
+    contains the minimum and maximum of each consecutive bin of
+    overview_factor**n samples.  Plots that only need the envelope of the
+    signal (e.g. when zoomed out) can use `get_range_extremes` so the amount of
+    data read is bounded by the requested resolution rather than the duration
+    of the requested range.
+
+    overview_factor
+        Decimation factor between successive levels of the pyramid
+    overview_levels
+        Number of levels in the pyramid (0 disables the pyramid)
+    '''
 
     name = 'FileMultiChannel'
 
+    overview_factor     = Int(16, transient=True)
+    overview_levels     = Int(0, transient=True)
+
+    # List of (min, max) EArray pairs, one for each level of the pyramid
+    _overview_arrays    = Any(transient=True)
+
+    @classmethod
+    def from_node(cls, node, **kwargs):
+        # If an overview pyramid was stored with the node, load the settings
+        # used to create it.
+        name = node._v_name + '_overview'
+        if name in node._v_parent and 'overview_levels' not in kwargs:
+            attrs = node._v_parent._f_get_child(name)._v_attrs
+            kwargs['overview_factor'] = attrs['overview_factor']
+            kwargs['overview_levels'] = attrs['overview_levels']
+        return super(FileMultiChannel, cls).from_node(node, **kwargs)
+
     def _get_shape(self):
         return (self.channels, 0)
 
-class FileSnippetChannel(FileChannel):
+    def _write(self, data):
+        super(FileMultiChannel, self)._write(data)
+        if self.overview_levels:
+            self.update_overview()
+
+    def flush(self):
+        super(FileMultiChannel, self).flush()
+        if self._overview_arrays is not None:
+            for pair in self._overview_arrays:
+                for array in pair:
+                    array.flush()
+
+    def _get_overview_arrays(self):
+        if self._overview_arrays is None:
+            fh = self.node._v_file
+            name = self.name + '_overview'
+            if name in self.node:
+                group = self.node._f_get_child(name)
+            else:
+                group = fh.create_group(self.node, name)
+                group._v_attrs['overview_factor'] = self.overview_factor
+                group._v_attrs['overview_levels'] = self.overview_levels
+
+            atom = tables.Atom.from_dtype(np.dtype(self._buffer.dtype))
+            expectedrows = int(self.fs*self.expected_duration)
+            arrays = []
+            for level in range(1, self.overview_levels+1):
+                expectedrows = max(1, expectedrows//self.overview_factor)
+                pair = []
+                for kind in ('min', 'max'):
+                    array_name = '{}_{}'.format(kind, level)
+                    if array_name in group:
+                        array = group._f_get_child(array_name)
+                    else:
+                        array = fh.create_earray(group, array_name, atom,
+                                                 (self.channels, 0),
+                                                 expectedrows=expectedrows)
+                    pair.append(self._append_buffer(array))
+                arrays.append(pair)
+            self._overview_arrays = arrays
+        return self._overview_arrays
+
+    def update_overview(self, max_samples=1e6):
+        '''
+        Bring the overview pyramid up to date with the data in the buffer
+
+        This is called automatically each time data is written.  It can also be
+        called directly to build the pyramid for a node that was acquired
+        without one (set overview_levels first).  The pyramid is brought up to
+        date in blocks of no more than max_samples to bound memory usage.
+        '''
+        factor = self.overview_factor
+        max_samples = int(max_samples//factor*factor)
+        lower_size = self.get_size()
+        for level, (min_array, max_array) in \
+                enumerate(self._get_overview_arrays()):
+            # Only complete bins are stored.  The incomplete bin at the end of
+            # each level is recomputed from the level below on the next update.
+            i = min_array.shape[-1]*factor
+            while lower_size-i >= factor:
+                ub = min(lower_size, i+max_samples)
+                if level == 0:
+                    mins = maxes = self._buffer[:, i:ub]
+                else:
+                    lower_min, lower_max = self._overview_arrays[level-1]
+                    mins = lower_min[:, i:ub]
+                    maxes = lower_max[:, i:ub]
+                n = mins.shape[-1]//factor
+                shape = self.channels, n, factor
+                mins = mins[:, :n*factor].reshape(shape).min(axis=-1)
+                maxes = maxes[:, :n*factor].reshape(shape).max(axis=-1)
+                min_array.append(mins)
+                max_array.append(maxes)
+                i += n*factor
+            lower_size = min_array.shape[-1]
+
+    def get_range_extremes(self, start, end, downsample, reference=None,
+                           channels=None):
+        '''
+        Returns the minimum and maximum of the signal in bins of (roughly)
+        downsample samples over the requested range
+
+        The coarsest level of the overview pyramid that still has at least
+        `downsample` bins per level bin is used.  If there is no such level,
+        the extremes are computed from the full-resolution data.  Samples at
+        the end of the range that are not yet summarized by the pyramid, as
+        well as samples in a partial bin at either end of the range, are read
+        from the full-resolution data and returned as extra bins.  Every bin
+        lies within the requested range.
+
+        Parameters
+        ----------
+        start : float, sec
+            Start time.
+        end : float, sec
+            End time.
+        downsample : int
+            Requested number of samples per bin
+        reference : float, optional
+            See `get_range`
+        channels : list, optional
+            Channels to return
+
+        Returns
+        -------
+        t : 1D array
+            Time of the first sample in each bin
+        mins : 2D array (channel, bin)
+            Minimum value of each bin
+        maxes : 2D array (channel, bin)
+            Maximum value of each bin
+        '''
+        lb, ub = self._to_bounds(start, end, reference)
+        ub = min(ub, self.get_size())
+        downsample = max(1, int(downsample))
+        if channels is None:
+            channels = Ellipsis
+
+        level = 0
+        if self.overview_levels:
+            while level < self.overview_levels and \
+                    self.overview_factor**(level+1) <= downsample:
+                level += 1
+
+        if level == 0 or ub <= lb:
+            data = self._buffer[:, lb:ub]
+            mins, maxes = data, data
+            bin_size = 1
+            i_lb = lb
+            i_ub = ub
+        else:
+            bin_size = self.overview_factor**level
+            min_array, max_array = self._get_overview_arrays()[level-1]
+            # Only use the bins that lie entirely within the range (and have
+            # been summarized).  The remaining samples are picked up below.
+            i_lb = -(-lb//bin_size)
+            i_ub = min(ub//bin_size, min_array.shape[-1])
+            if i_lb < i_ub:
+                mins = min_array[:, i_lb:i_ub]
+                maxes = max_array[:, i_lb:i_ub]
+            else:
+                # The entire range is read from the full-resolution data
+                i_lb = i_ub = lb//bin_size
+                mins = maxes = np.empty((self.channels, 0),
+                                        dtype=min_array.dtype)
+
+        # Now, combine adjacent bins so each output bin spans (roughly) the
+        # requested number of samples.
+        step = max(1, downsample//bin_size)
+        indices = np.arange(0, mins.shape[-1], step)
+        t = (i_lb+indices)*bin_size
+        if len(indices):
+            mins = np.minimum.reduceat(mins, indices, axis=-1)
+            maxes = np.maximum.reduceat(maxes, indices, axis=-1)
+        else:
+            mins = mins[:, :0]
+            maxes = maxes[:, :0]
+
+        # Pick up the samples in the partial bin at the start of the range
+        head_ub = i_lb*bin_size
+        if lb < head_ub and i_lb < i_ub:
+            head = self._buffer[:, lb:head_ub]
+            t = np.r_[lb, t]
+            mins = np.c_[head.min(axis=-1), mins]
+            maxes = np.c_[head.max(axis=-1), maxes]
+
+        # Pick up any samples not yet included in the pyramid
+        tail_lb = max(lb, i_ub*bin_size)
+        if tail_lb < ub:
+            tail = self._buffer[:, tail_lb:ub]
+            t = np.r_[t, tail_lb]
+            mins = np.c_[mins, tail.min(axis=-1)]
+            maxes = np.c_[maxes, tail.max(axis=-1)]
+
+        t = self.t0 + t/self.fs
+        return t, mins[channels], maxes[channels]
+
+class RAMMultiChannel(RAMMixin, MultiChannel):
+    '''
+    Multichannel data using an in-memory ring buffer as the datastore
+    '''
+
+    dtype = Any(np.float32)
+
+    def _get_shape(self):
+        return (self.channels, 0)
+
+class SnippetChannel(Channel):
+    '''
+    Base class for spike snippets along with their timestamps and classifiers.
+    Subclasses are responsible for implementing the buffers.
+
+    To ensure that requests for the most recent snippets of a given classifier
+    do not get slower as the number of snippets grows, the position of each
+    snippet is indexed by classifier and the most recent tail_size snippets of
+    each classifier are kept in memory.
+
+    tail_size
+        Number of recent snippets per classifier to keep in memory
+    '''
 
     snippet_size        = Int
     classifiers         = Any
     timestamps          = Any
     unique_classifiers  = Set
+    tail_size           = Int(100, transient=True)
+
+    # Mapping of classifier to the position of each of its snippets (counting
+    # from the first snippet acquired, including those that have been
+    # discarded by a ring buffer).
+    _positions          = Any(transient=True)
+    _n_indexed          = Int(0, transient=True)
+    # Mapping of classifier to a deque of the most recent snippets
+    _tails              = Any(transient=True)
 
     def __getitem__(self, key):
         return self._buffer[key]
 
+    def send(self, data, timestamps, classifiers):
+        if len(data):
+            data.shape = (-1, self.snippet_size)
+            self._update_index()
+            self._buffer.append(data)
+            self.classifiers.append(classifiers)
+            self.timestamps.append(timestamps)
+            self._index(classifiers, data)
+            self.unique_classifiers.update(set(classifiers))
+            self.added = data, timestamps, classifiers
+
+    def _discarded(self):
+        return getattr(self.classifiers, 'discarded', 0)
+
+    def _index(self, classifiers, data=None):
+        if self._positions is None:
+            self._positions = {}
+            self._tails = {}
+        for i, c in enumerate(classifiers):
+            c = int(c)
+            if c not in self._positions:
+                self._positions[c] = array('l')
+                self._tails[c] = deque(maxlen=self.tail_size)
+            self._positions[c].append(self._n_indexed+i)
+            if data is not None:
+                self._tails[c].append(np.array(data[i]))
+        self._n_indexed += len(classifiers)
+
+    def _update_index(self):
+        # Index any snippets that were not acquired via send (e.g. when the
+        # channel was loaded from an existing file).
+        discarded = self._discarded()
+        n = len(self.classifiers)+discarded
+        if n > self._n_indexed:
+            self._index(self.classifiers[self._n_indexed-discarded:])
+
+    def get_recent(self, history=1, classifier=None):
+        '''
+        Return the most recent snippets
+
+        If classifier is None, the last history snippets are returned.
+        Otherwise, the last history snippets with the given classifier are
+        returned.
+        '''
+        if len(self._buffer) == 0:
+            return np.array([]).reshape((-1, self.snippet_size))
+        if classifier is None:
+            return self._buffer[-history:]
+
+        self._update_index()
+        positions = self._positions.get(classifier, array('l'))
+        history = min(history, len(positions))
+        if history == 0:
+            return np.array([]).reshape((-1, self.snippet_size))
+        tail = self._tails[classifier]
+        if len(tail) >= history:
+            return np.array(list(islice(reversed(tail), history))[::-1])
+        # Not all requested snippets are in memory.  Read them from the buffer.
+        # Positions are in ascending order, as required by tables.Array for
+        # fancy selections.  Index the second dimension explicitly, otherwise
+        # tables.Array interprets the list as a point selection.
+        rows = np.array(positions[-history:])-self._discarded()
+        rows = rows[rows >= 0]
+        return self._buffer[rows.tolist(), :]
+
+    def get_recent_average(self, count=1, classifier=None):
+        return self.get_recent(count, classifier).mean(0)
+
+class FileSnippetChannel(FileMixin, SnippetChannel):
+
+    name  = 'FileChannel'
+    dtype = Any(np.float32)
+
+    def _get_shape(self):
+        return (0, self.snippet_size)
+
     def _classifiers_default(self):
         atom = tables.Atom.from_dtype(np.dtype('int32'))
         earray = self.node._v_file.createEArray(self.node._v_pathname,
                 self.name + '_classifier', atom, (0,),
                 expectedrows=int(self.fs*self.expected_duration))
-        return earray
+        return self._append_buffer(earray)
 
     def _timestamps_default(self):
         atom = tables.Atom.from_dtype(np.dtype('int32'))
         earray = self.node._v_file.createEArray(self.node._v_pathname,
                 self.name + '_ts', atom, (0,),
                 expectedrows=int(self.fs*self.expected_duration))
-        return earray
+        return self._append_buffer(earray)
+
+    def flush(self):
+        super(FileSnippetChannel, self).flush()
+        self.classifiers.flush()
+        self.timestamps.flush()
+
+class RAMSnippetChannel(RAMMixin, SnippetChannel):
+    '''
+    Spike snippets stored in an in-memory ring buffer
+
+    Since spikes do not arrive at a fixed rate, the capacity is specified as
+    the number of snippets to retain (max_snippets) rather than a duration.
+    '''
+
+    dtype           = Any(np.float32)
+    max_snippets    = Int(10000, transient=True)
 
     def _get_shape(self):
         return (0, self.snippet_size)
 
-    def send(self, data, timestamps, classifiers):
-        if len(data):
-            data.shape = (-1, self.snippet_size)
-            self._buffer.append(data)
-            self.classifiers.append(classifiers)
-            self.timestamps.append(timestamps)
-            self.unique_classifiers.update(set(classifiers))
-            self.added = data, timestamps, classifiers
+    def _get_capacity(self):
+        return self.max_snippets
 
-    def get_recent(self, history=1, classifier=None):
-        if len(self._buffer) == 0:
-            return np.array([]).reshape((-1, self.snippet_size))
-        spikes = self._buffer[-history:]
-        if classifier is not None:
-            classifiers = self.classifiers[-history:]
-            mask = classifiers[:] == classifier
-            return spikes[mask]
-        return spikes
+    def _classifiers_default(self):
+        return RingBuffer((0,), self.max_snippets, np.int32)
 
-    def get_recent_average(self, count=1, classifier=None):
-        return self.get_recent(count, classifier).mean(0)
+    def _timestamps_default(self):
+        return RingBuffer((0,), self.max_snippets, np.int32)
 
 if __name__ == '__main__':
     import doctest
@@ -0,0 +1,167 @@
+'''
+:mod:`cns.checkpoint` -- Resumable chunked analysis
+===================================================
+
+.. moduleauthor:: Brad Buran <bburan@alum.mit.edu>
+
+The analysis functions in :mod:`cns.analysis` process the raw data in chunks
+and append the results to arrays in the output file.  Processing a long
+recording can take hours.  A :class:`Checkpoint` periodically flushes the
+output file and saves a marker (an attribute of the output node) recording the
+number of chunks that have been processed, the length of each extendable
+array, the nodes that exist under the output node and any state the analysis
+needs to continue.
+
+If the analysis is interrupted, calling the same function with the same
+parameters and output node resumes from the marker.  Arrays are truncated to
+the length recorded in the marker and nodes created after the marker was saved
+are removed, so data written after the last checkpoint is discarded and the
+output is identical to an uninterrupted run.
+'''
+
+import time
+import hashlib
+import cPickle as pickle
+import numpy as np
+
+import logging
+log = logging.getLogger(__name__)
+
+# Name of the attribute of the output node the marker is saved to
+MARKER = 'checkpoint'
+
+def fingerprint(parameters):
+    '''
+    Return a digest of the parameters (a nested structure of dictionaries,
+    sequences, arrays and scalars)
+
+    >>> fingerprint({'a': np.arange(3), 'b': 1.0}) == \\
+    ...     fingerprint({'b': 1.0, 'a': np.arange(3)})
+    True
+    >>> fingerprint({'a': np.arange(3)}) == fingerprint({'a': np.arange(4)})
+    False
+    '''
+    def normalize(value):
+        if isinstance(value, dict):
+            return sorted((k, normalize(v)) for k, v in value.items())
+        if isinstance(value, (list, tuple)):
+            return [normalize(v) for v in value]
+        if isinstance(value, np.ndarray):
+            return value.dtype.str, value.shape, value.tostring()
+        if isinstance(value, np.generic):
+            return value.item()
+        return value
+    return hashlib.md5(pickle.dumps(normalize(parameters), 2)).hexdigest()
+
+def has_checkpoint(node):
+    '''
+    True if node contains the marker of an interrupted analysis
+    '''
+    return MARKER in node._v_attrs._f_list()
+
+class Checkpoint(object):
+    '''
+    Saves the progress of a chunked analysis writing to node (an instance of
+    tables.Group) so an interrupted run can be resumed
+
+    node
+        Node the output is saved under.  If it contains a marker, the analysis
+        is resumed from the marker.
+    parameters
+        Values that determine the output (e.g. the input file, filter settings
+        and chunk size).  Resuming with different parameters raises a
+        ValueError.
+    interval
+        Minimum time (in seconds) between checkpoints.  If None, no
+        checkpoints are saved (but a run interrupted with checkpoints enabled
+        is still resumed).
+
+    After a checkpoint is loaded, `chunk` is the number of chunks that have
+    been processed and `state` the dictionary saved with the marker.
+    '''
+
+    def __init__(self, node, parameters, interval=None):
+        self.node = node
+        self.fingerprint = fingerprint(parameters)
+        self.interval = interval
+        self.chunk = 0
+        self.state = {}
+        self.resuming = has_checkpoint(node)
+        self._last_save = time.time()
+        if self.resuming:
+            self._load()
+
+    @property
+    def enabled(self):
+        '''
+        True if checkpoints are saved
+        '''
+        return self.interval is not None
+
+    def _load(self):
+        marker = self.node._v_attrs[MARKER]
+        if marker['fingerprint'] != self.fingerprint:
+            mesg = 'Unable to resume {} with different parameters' \
+                .format(self.node._v_pathname)
+            raise ValueError, mesg
+        # Discard anything written after the marker was saved.  Remove the
+        # deepest nodes first so a node is never removed along with its parent
+        # before we get to it.
+        nodes = list(self.node._f_walkNodes())
+        nodes.sort(key=lambda n: n._v_depth, reverse=True)
+        for node in nodes:
+            pathname = node._v_pathname
+            if pathname not in marker['nodes']:
+                log.debug('Removing %s', pathname)
+                node._f_remove(recursive=True)
+            elif pathname in marker['lengths']:
+                node.truncate(marker['lengths'][pathname])
+        self.chunk = marker['chunk']
+        self.state = marker['state']
+        log.debug('Resuming %s from chunk %d', self.node._v_pathname,
+                  self.chunk)
+
+    def create(self, factory, where, name, *args, **kwargs):
+        '''
+        Return where/name if resuming, otherwise create it by calling
+        factory(where, name, *args, **kwargs) (e.g. File.createEArray)
+        '''
+        if self.resuming and name in where:
+            return where._f_getChild(name)
+        return factory(where, name, *args, **kwargs)
+
+    def update(self, chunk, **state):
+        '''
+        Notify the checkpoint that `chunk` chunks have been processed (and all
+        their output written).  A checkpoint is saved if `interval` has elapsed
+        since the last one.
+        '''
+        if self.enabled and \
+                time.time()-self._last_save >= self.interval:
+            self.save(chunk, **state)
+
+    def save(self, chunk, **state):
+        '''
+        Flush the output and save a marker recording that `chunk` chunks have
+        been processed.  The keyword arguments are saved as the state.
+        '''
+        lengths = {}
+        nodes = []
+        for node in self.node._f_walkNodes():
+            nodes.append(node._v_pathname)
+            if hasattr(node, 'extdim') and node.extdim >= 0:
+                lengths[node._v_pathname] = node.nrows
+        marker = dict(fingerprint=self.fingerprint, chunk=chunk, state=state,
+                      lengths=lengths, nodes=nodes)
+        self.node._v_file.flush()
+        self.node._v_attrs[MARKER] = marker
+        self.node._v_file.flush()
+        self._last_save = time.time()
+
+    def complete(self):
+        '''
+        Remove the marker once the analysis is complete
+        '''
+        if has_checkpoint(self.node):
+            del self.node._v_attrs[MARKER]
+        self.resuming = False
@@ -0,0 +1,301 @@
+'''
+:mod:`cns.hdf5_service` -- Dedicated thread for HDF5 I/O
+========================================================
+
+.. moduleauthor:: Brad Buran <bburan@alum.mit.edu>
+
+The HDF5 library (and PyTables) is not thread-safe.  During an experiment,
+acquisition callbacks append data, the controller writes the trial log and the
+plots read data for display, all from different threads.  Previously, this was
+handled by wrapping the PyTables methods in a single global lock.  However, a
+lock is first-come, first-served so a slow read by a plot could stall an
+acquisition write.
+
+Instead, `install` routes the PyTables methods through a :class:`HDF5Service`.
+A single thread owns all access to the HDF5 files.  Each call is submitted as a
+request and the calling thread waits for the result.  Pending requests are
+executed in order of priority (writes first, then reads) and, within a
+priority, in the order they were submitted.  A write therefore waits for at
+most the request that is currently executing rather than for every read that
+happens to be queued ahead of it.
+
+Calls made from the service thread itself (e.g. PyTables methods that call
+other PyTables methods) are executed immediately.  If the service is not
+running (or the calling process was forked from the one running the service),
+calls are executed in the calling thread.
+'''
+
+import os
+import sys
+import time
+import atexit
+import itertools
+import threading
+import Queue
+from collections import deque
+
+import tables as tb
+
+import logging
+log = logging.getLogger(__name__)
+
+# Request priorities (lower values are executed first)
+WRITE = 0
+READ = 1
+_STOP = 2
+
+# Methods that modify the file.  This is not an exhaustive list.  We can add to
+# it as we find more methods that we want to use.  Methods that are not
+# available in the installed version of PyTables are skipped.
+WRITE_METHODS = [
+    (tb.File, ('_settitle', '_deltitle', '_setfilters', '_delfilters',
+               'create_group', 'create_table', 'create_array', 'create_carray',
+               'create_earray', 'create_vlarray', 'create_hard_link',
+               'create_soft_link', 'create_external_link', 'rename_node',
+               'move_node', 'copy_node', 'remove_node', 'set_node_attr',
+               'del_node_attr', 'copy_node_attrs', 'copy_children',
+               'copy_file', 'mark', 'undo', 'redo', 'goto', 'flush', 'close')),
+    (tb.Table, ('append', 'modify_rows', '_g_create', '__setitem__',
+                'modify_coordinates', 'modify_column', 'modify_columns',
+                'flush_rows_to_index', 'remove_rows', 'remove_row', 'reindex',
+                'reindex_dirty', 'copy')),
+    (tb.Array, ('_g_create', '__setitem__', '_write_slice', '_write_coords',
+                '_write_selection')),
+    (tb.EArray, ('append', 'set_attr', '__setitem__')),
+    (tb.Node, ('_f_setattr', '_f_delattr', '_f_move')),
+    (tb.file.NodeManager, ('rename_node', 'drop_node', 'flush_nodes')),
+    (tb.attributeset.AttributeSet, ('_g__setattr', '_g__delattr',
+                                    '_g_update_node_location')),
+]
+
+# Methods that only read from the file
+READ_METHODS = [
+    (tb.File, ('_gettitle', '_getfilters', 'get_node_attr', 'list_nodes',
+               'iter_nodes')),
+    (tb.Table, ('read', '_g_open', '_get_column_instance',
+                '_disable_indexing_in_queries', '_enable_indexing_in_queries',
+                'will_query_use_indexing', 'where', 'read_where',
+                'append_where', 'get_where_list', 'itersequence',
+                '_check_sortby_csi', 'itersorted', 'read_sorted', 'iterrows',
+                'get_enum', 'col', '__getitem__')),
+    (tb.Array, ('iterrows', 'next', '__getitem__', '_read', '_getnrows',
+                '_getrowsize')),
+    (tb.EArray, ('read', '__getitem__', '__len__')),
+    (tb.Node, ('_f_getattr',)),
+]
+
+class Request(object):
+    '''
+    A call to be executed by the service thread.  Use `result` to wait for the
+    call to complete.
+    '''
+
+    def __init__(self, function, args, kwargs, priority):
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.submitted = time.time()
+        self.started = None
+        self.completed = None
+        self._done = threading.Event()
+        self._result = None
+        self._exc_info = None
+
+    def run(self):
+        self.started = time.time()
+        try:
+            self._result = self.function(*self.args, **self.kwargs)
+        except:
+            self._exc_info = sys.exc_info()
+        finally:
+            self.completed = time.time()
+            self._done.set()
+
+    def result(self, timeout=None):
+        '''
+        Wait for the call to complete and return the result.  If the call
+        raised an exception, it is reraised in the calling thread.
+        '''
+        if not self._done.wait(timeout):
+            raise RuntimeError, 'Timed out waiting for HDF5 request'
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    @property
+    def latency(self):
+        '''
+        Time (in seconds) from submission to completion
+        '''
+        return self.completed-self.submitted
+
+class HDF5Service(object):
+    '''
+    Executes all submitted calls in a single thread in order of priority
+
+    history
+        Number of recently executed requests to keep the (submitted, started,
+        completed) times of for each priority (see `timing`).  These can be
+        used to monitor the latency.
+    '''
+
+    def __init__(self, history=10000):
+        self._queue = Queue.PriorityQueue()
+        self._counter = itertools.count()
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self.timing = {WRITE: deque(maxlen=history),
+                       READ: deque(maxlen=history)}
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run,
+                                            name='HDF5Service')
+            self._thread.daemon = True
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def stop(self):
+        '''
+        Stop the service once all pending requests have been executed
+        '''
+        if self._thread is not None:
+            self._queue.put((_STOP, next(self._counter), None))
+            self._thread.join()
+            with self._lock:
+                self._thread = None
+            # Execute any requests that were submitted after the stop request
+            while not self._queue.empty():
+                priority, i, request = self._queue.get()
+                if request is not None:
+                    request.run()
+
+    def _run(self):
+        while True:
+            priority, i, request = self._queue.get()
+            if request is None:
+                break
+            request.run()
+            self.timing[priority].append((request.submitted,
+                                          request.started,
+                                          request.completed))
+
+    def submit(self, function, *args, **kwargs):
+        '''
+        Submit function(*args, **kwargs) for execution and return the Request.
+        Set the priority (default READ) via the priority keyword argument.
+        '''
+        priority = kwargs.pop('priority', READ)
+        request = Request(function, args, kwargs, priority)
+        with self._lock:
+            # A process forked from the one running the service (e.g. by
+            # multiprocessing) does not inherit the service thread.
+            inline = self._thread is None or os.getpid() != self._pid or \
+                threading.current_thread() is self._thread
+            if not inline:
+                self._queue.put((priority, next(self._counter), request))
+        if inline:
+            request.run()
+        return request
+
+    def call(self, function, *args, **kwargs):
+        '''
+        Submit function(*args, **kwargs) for execution and wait for the result
+        '''
+        return self.submit(function, *args, **kwargs).result()
+
+_service = None
+_originals = []
+_installs = 0
+_install_lock = threading.Lock()
+
+def get_service():
+    '''
+    Return the service installed by `install` (or None if not installed)
+    '''
+    return _service
+
+def install():
+    '''
+    Start the HDF5 service and route the PyTables methods listed in
+    WRITE_METHODS and READ_METHODS through it.  This should be called before
+    any files are opened.  Returns the service.
+
+    Installs are reference counted.  If the service is already installed, the
+    count is incremented and the running service is returned.  Each call must
+    be matched by a call to `uninstall`, so code that only needs the service
+    temporarily (e.g. an analysis reading chunks ahead) does not remove it from
+    under the experiment or another analysis.
+    '''
+    global _service, _installs
+    with _install_lock:
+        if _service is None:
+            _service = _install()
+        _installs += 1
+        return _service
+
+def _install():
+    service = HDF5Service()
+
+    def route(f, priority):
+        def wrapper(*args, **kwargs):
+            kwargs['priority'] = priority
+            return service.call(f, *args, **kwargs)
+        wrapper.__name__ = f.__name__
+        wrapper.__doc__ = f.__doc__
+        return wrapper
+
+    # Look up all the methods before patching any of them so that a method
+    # inherited from a class that is also patched is only wrapped once.
+    patches = []
+    for priority, methods in ((WRITE, WRITE_METHODS), (READ, READ_METHODS)):
+        for cls, names in methods:
+            for name in names:
+                f = getattr(cls, name, None)
+                if f is None:
+                    log.debug('%s.%s not available', cls.__name__, name)
+                else:
+                    patches.append((cls, name, route(f, priority)))
+    for cls, name, wrapper in patches:
+        # Only restore the methods the class defines itself on uninstall.
+        # Inherited methods are removed instead.
+        _originals.append((cls, name, cls.__dict__.get(name)))
+        setattr(cls, name, wrapper)
+    _originals.append((tb.Table, 'length', tb.Table.__dict__.get('length')))
+
+    def table_length(self):
+        return service.call(lambda: self.nrows)
+    setattr(tb.Table, 'length', property(table_length))
+
+    service.start()
+    # Pending writes must be executed before the interpreter exits.
+    atexit.register(service.stop)
+    return service
+
+def uninstall():
+    '''
+    Undo a call to `install`.  Once every install has been undone, restore the
+    original PyTables methods and stop the service once all pending requests
+    have been executed.
+    '''
+    global _service, _installs
+    with _install_lock:
+        if _service is None:
+            return
+        _installs -= 1
+        if _installs > 0:
+            return
+        for cls, name, original in reversed(_originals):
+            if original is None:
+                delattr(cls, name)
+            else:
+                setattr(cls, name, original)
+        del _originals[:]
+        _service.stop()
+        _service = None
@@ -12,16 +12,36 @@ from os import path
 # Maximum (safe) output voltage for DACs to speaker
 MAX_SPEAKER_DAC_VOLTAGE = 7
 
-# Recommended size (in bytes) to segment the raw physiology data into for
-# loading into memory.  You can probably get away with bigger chunks for most of
-# the data files; however, if a large number of artifacts are present (e.g. from
-# the headstage falling off), these will trigger the event detection algorithm
-# and cause memory size to balloon.
-CHUNK_SIZE      = 50e6
+# Memory (in bytes) the analysis functions may use when processing a chunk of
+# data, including the intermediate arrays (e.g. filtered and complex-valued
+# copies of the chunk) and the chunks read ahead.  The size of each chunk is
+# planned from this budget.  If None, one eighth of the physical memory is used.
+# If a large number of artifacts are present (e.g. from the headstage falling
+# off), these will trigger the event detection algorithm and cause memory size
+# to balloon, so leave some headroom.
+MEMORY_BUDGET   = None
+
+# Size (in bytes) to segment the raw physiology data into for loading into
+# memory.  If set, this overrides MEMORY_BUDGET and only accounts for the raw
+# data in each chunk.
+CHUNK_SIZE      = None
+
+# Number of chunks to read ahead on a background thread while the analysis
+# functions process the current chunk.  This can overlap HDF5 decompression with
+# processing on multi-core machines; however, HDF5 access has to be routed
+# through a single thread while reading ahead, which adds latency to each call.
+# Off (0) by default since it was up to 15% slower on a single-CPU machine (see
+# doc/optimization.tips and benchmark/prefetch.py).
+CHUNK_PREFETCH  = 0
 
 # Size of sample (in seconds) to use for computing the noise floor
 NOISE_DURATION  = 16
 
+# Maximum size (in bytes) of the cache of referenced and filtered data kept by
+# the physiology review GUI.  Panning back and forth through the data reuses
+# the cached blocks rather than refiltering them.
+PROCESSED_CACHE_SIZE = 200e6
+
 try:
     BASE_DIRECTORY  = os.environ['NEUROBEHAVIOR_BASE']
     neurobehavior_base_defined = True
@@ -71,6 +91,16 @@ else:
 # PHYSIOLOGY_SPIKE_SNIPPET_SIZE+2.
 PHYSIOLOGY_SPIKE_SNIPPET_SIZE = 26
 
+# Amount of processed data (in seconds) and number of spike snippets per channel
+# held in memory for display during an experiment.  Older data is discarded.
+PHYSIOLOGY_RETENTION = 300
+PHYSIOLOGY_SPIKE_HISTORY = 10000
+
+# Filename of the storage profile (chunkshape and compression settings) to use
+# for the raw physiology data.  Use scripts/tune_storage.py to generate the
+# profile.  If None, LZO level 1 compression with shuffling is used.
+PHYSIOLOGY_STORAGE_PROFILE = None
+
 # __file__ is a special variable that is available in all Python files (when
 # loaded by the Python interpreter) that contains the path of the current file
 # or script. We extract the directory portion of the path and use that to
@@ -195,6 +195,408 @@ def normalize_rms(waveform, out=None):
     '''
     return np.divide(waveform, rms(waveform), out)
 
+# Cache of filter designs computed by iirfilter_sos.  Filter design (especially
+# for elliptic filters) can take longer than the filtering itself, and the
+# same handful of designs are requested over and over again.
+_sos_cache = {}
+
+def iirfilter_sos(N, Wn, rp=None, rs=None, btype='band', ftype='butter'):
+    '''
+    Design an IIR filter as second-order sections
+
+    Arguments are the same as scipy.signal.iirfilter.  Second-order sections
+    are much less sensitive to coefficient quantization than the transfer
+    function (b, a) representation, so higher-order and narrow-band filters
+    remain stable.  Designs are cached, so repeated calls with the same
+    arguments are cheap.
+
+    Returns
+    -------
+    sos : ndarray (n_sections, 6)
+        Second-order sections
+    zi : ndarray (n_sections, 2)
+        Steady-state initial conditions for a unit step input (see
+        scipy.signal.sosfilt_zi).  Scale by the first sample of the signal to
+        initialize the filter.
+
+    >>> sos, zi = iirfilter_sos(8, 0.1, btype='highpass')
+    >>> sos.shape, zi.shape
+    ((4, 6), (4, 2))
+    >>> iirfilter_sos(8, 0.1, btype='highpass')[0] is sos
+    True
+    '''
+    key = int(N), tuple(np.atleast_1d(Wn)), rp, rs, btype, ftype
+    if key not in _sos_cache:
+        sos = signal.iirfilter(int(N), Wn, rp, rs, btype=btype, ftype=ftype,
+                               output='sos')
+        zi = signal.sosfilt_zi(sos)
+        _sos_cache[key] = sos, zi
+    return _sos_cache[key]
+
+def sosfiltfilt(sos, x, zi=None, padlen=0):
+    '''
+    Apply a second-order sections filter forward and backward along the last
+    axis of x (i.e. zero-phase filtering)
+
+    Parameters
+    ----------
+    sos : ndarray (n_sections, 6)
+        Second-order sections (see `iirfilter_sos`)
+    x : ndarray
+        Signal to filter.  Filtering is performed along the last axis.
+    zi : { None, ndarray (n_sections, 2) }
+        Steady-state initial conditions.  Each pass is initialized with zi
+        scaled by the value at the edge the pass starts from.  This removes the
+        startup transient caused by a DC offset; however, the transient caused
+        by the rest of the signal is not removed, so the edges of a chunk still
+        need to be padded by the length of the impulse response (see
+        `filter_padding`).  If None, these are computed from sos.
+    padlen : int
+        Number of samples to extend the signal by (using odd extension) at each
+        edge before filtering.  This is the padding strategy used by
+        scipy.signal.filtfilt.  Set to 0 if the edges have already been padded
+        with real data (e.g. using slice_overlap).
+
+    >>> sos, zi = iirfilter_sos(4, 0.2, btype='lowpass')
+    >>> x = np.ones((2, 100))*5
+    >>> np.allclose(sosfiltfilt(sos, x, zi), 5)
+    True
+    '''
+    if zi is None:
+        zi = signal.sosfilt_zi(sos)
+    x = np.asarray(x)
+    n = x.shape[-1]
+    if padlen:
+        padlen = min(padlen, n-1)
+        left = 2*x[..., :1]-x[..., padlen:0:-1]
+        right = 2*x[..., -1:]-x[..., -2:-padlen-2:-1]
+        x = np.concatenate((left, x, right), axis=-1)
+
+    # The initial conditions must have shape (n_sections, ..., 2) where ...
+    # matches the leading dimensions of x.
+    zi = zi.reshape((len(zi),) + (1,)*(x.ndim-1) + (2,))
+    y, _ = signal.sosfilt(sos, x, zi=zi*x[np.newaxis, ..., :1])
+    y = y[..., ::-1]
+    y, _ = signal.sosfilt(sos, y, zi=zi*y[np.newaxis, ..., :1])
+    y = y[..., ::-1]
+
+    if padlen:
+        y = y[..., padlen:padlen+n]
+    return y
+
+def filter_padding(sos, tolerance=1e-3, max_samples=2**20):
+    '''
+    Number of samples of padding required to stabilize the edges of a chunk
+    filtered by `sosfiltfilt` (or filtfilt)
+
+    The transient at the edge of a chunk decays at the same rate as the impulse
+    response of the filter.  This returns the number of samples after which
+    the magnitude of the impulse response stays below tolerance (relative to
+    its peak), which depends on the cutoff and sharpness of the filter rather
+    than just the order.  A lowpass or highpass filter with a cutoff that is a
+    small fraction of the sampling rate requires much more padding than its
+    order would suggest.
+
+    Parameters
+    ----------
+    sos : ndarray (n_sections, 6)
+        Second-order sections (see `iirfilter_sos`).  Use the second-order
+        sections of the same design for a filter applied as (b, a).
+    tolerance : float
+        Magnitude of the edge transient (relative to the peak of the impulse
+        response) that can be tolerated
+    max_samples : int
+        Upper limit on the padding (e.g. for filters that are barely stable)
+
+    >>> sos, zi = iirfilter_sos(4, 300/12.5e3, btype='highpass')
+    >>> n = filter_padding(sos)
+    >>> n > 100
+    True
+    >>> filter_padding(sos, 1e-6) > n
+    True
+    '''
+    key = sos.tobytes(), tolerance, max_samples
+    if key not in _padding_cache:
+        n = 1024
+        while True:
+            x = np.zeros(n)
+            x[0] = 1
+            h = np.abs(signal.sosfilt(sos, x))
+            padding = np.flatnonzero(h > tolerance*h.max())[-1]+1
+            # Ensure the tail of the impulse response was long enough to see
+            # the decay
+            if padding < n//2 or n >= max_samples:
+                break
+            n *= 2
+        _padding_cache[key] = int(min(padding, max_samples))
+    return _padding_cache[key]
+
+# Cache of padding computed by filter_padding
+_padding_cache = {}
+
+def processing_filter_sos(fs, btype, freq_hp, freq_lp, order, ftype='butter'):
+    '''
+    Design the filter used to process the physiology channels (see
+    `cns.channel.ProcessedMultiChannel`) as second-order sections.  Returns
+    the (sos, zi) pair from `iirfilter_sos` or None if btype is None.
+    '''
+    if btype is None:
+        return None
+    if btype == 'bandpass':
+        Wp = np.array([freq_hp, freq_lp])
+    elif btype == 'highpass':
+        Wp = freq_hp
+    else:
+        Wp = freq_lp
+    Wp = Wp/(0.5*fs)
+    return iirfilter_sos(order, Wp, 60, 2, ftype=ftype, btype=btype)
+
+def processing_padding(order, method='ba', sos=None):
+    '''
+    Number of samples to pad each chunk of a processed channel by
+
+    For the 'ba' method, this is 3*order so that existing results are
+    reproduced exactly.  Note that this is shorter than the impulse response of
+    most filters, so the edges of each chunk are not fully stable.  For the
+    'sos' method, the padding is the length of the impulse response (see
+    `filter_padding`) and never less than 3*order.
+
+    >>> sos, zi = processing_filter_sos(25e3, 'bandpass', 300, 6000, 8)
+    >>> processing_padding(8, 'ba', sos)
+    24
+    >>> processing_padding(8, 'sos', sos) > 24
+    True
+    '''
+    padding = int(3*order)
+    if method == 'sos' and sos is not None:
+        padding = max(padding, filter_padding(sos))
+    return padding
+
+# Cache of FIR designs computed by firfilter_decimate
+_fir_cache = {}
+
+def firfilter_decimate(q, taps_per_phase=10, window='hamming'):
+    '''
+    Design a linear-phase lowpass FIR anti-aliasing filter for decimation by q
+
+    The cutoff is the Nyquist frequency of the decimated signal.  The filter
+    has 2*taps_per_phase*q+1 taps (the same length scipy.signal.decimate uses
+    for ftype='fir' with the default taps_per_phase), so the group delay,
+    taps_per_phase*q samples, is an integer multiple of q.  Designs are cached.
+
+    >>> h = firfilter_decimate(4)
+    >>> h.shape
+    (81,)
+    >>> np.allclose(h, h[::-1])
+    True
+    >>> np.allclose(h.sum(), 1)
+    True
+    '''
+    key = int(q), int(taps_per_phase), window
+    if key not in _fir_cache:
+        n_taps = 2*taps_per_phase*q+1
+        _fir_cache[key] = signal.firwin(n_taps, 1.0/q, window=window)
+    return _fir_cache[key]
+
+def polyphase_decimate(h, x, q, start=0):
+    '''
+    Filter x with the FIR filter h along the last axis and keep every q-th
+    sample beginning with sample `start` of the full convolution.  Only the
+    retained samples are computed (using a polyphase decomposition of h, see
+    scipy.signal.upfirdn), so the cost is 1/q that of filtering at the full
+    rate and then discarding samples.
+
+    The k-th output sample is sum(h[j]*x[start+k*q-j]).  To process a long
+    signal in chunks, include len(h)-1 samples of history before the first
+    output sample of each chunk and set start so the output is referenced to
+    the first sample after the history.
+
+    >>> h = firfilter_decimate(3, 2)
+    >>> x = np.random.normal(size=(2, 100))
+    >>> expected = np.array([np.convolve(h, c) for c in x])[:, 5::3]
+    >>> y = polyphase_decimate(h, x, 3, start=5)
+    >>> y.shape == expected.shape
+    True
+    >>> np.allclose(y, expected)
+    True
+    '''
+    # upfirdn keeps the samples of the convolution that fall on multiples of
+    # q.  Prepending zeros shifts the convolution so that start does as well.
+    p = -start % q
+    if p:
+        x = np.concatenate((np.zeros(x.shape[:-1]+(p,), dtype=x.dtype), x),
+                           axis=-1)
+    y = signal.upfirdn(h, x, 1, q)
+    return y[..., (start+p)//q:]
+
+# Number of octaves either side of the typical amplitude of a channel that are
+# binned by running_median_std.  Windows whose median falls outside this range
+# (e.g. a dead channel or a long artifact) are computed exactly.
+MEDIAN_STD_OCTAVES = 5
+
+# Maximum number of histogram bins (across all channels and windows) held in
+# memory at once by running_median_std.  Each bin takes roughly 32 bytes.
+MEDIAN_STD_MAX_BINS = 2**20
+
+def running_median_std(x, window_samples, window_step, n_windows=None,
+                       tolerance=0.01):
+    '''
+    Estimate the standard deviation of the noise, median(abs(x))/0.6745, in
+    windows sliding along the last axis of x (channel, sample)
+
+    Computing the exact median of each window is expensive when the windows
+    overlap since each sample is sorted once for every window it falls in.
+    Instead, a running histogram of abs(x) is maintained as the window slides:
+    the histogram of each window is the histogram of the previous window plus
+    the histogram of the window_step samples entering the window minus the
+    histogram of the samples leaving it.  Each sample is therefore binned
+    twice regardless of how much the windows overlap, and the histograms are
+    computed for a batch of windows at a time so the memory required does not
+    depend on window_samples or window_step (see MEDIAN_STD_MAX_BINS).  The
+    median is then located within its histogram bin by linear interpolation.
+    If the windows do not overlap, the exact median is computed instead.
+
+    The bins are the float32 values that share the same exponent and leading
+    mantissa bits, so the relative width of each bin (and hence the relative
+    error of the estimate) is at most tolerance.  Windows where the median
+    falls outside the binned range (see MEDIAN_STD_OCTAVES) are computed
+    exactly.
+
+    Parameters
+    ----------
+    x : 2D array (channel, sample)
+        Signal
+    window_samples : int
+        Number of samples in each window
+    window_step : int
+        Number of samples between the start of each window
+    n_windows : { None, int }
+        Number of windows to compute.  If None, all the windows that fit
+        in the signal.
+    tolerance : float
+        Maximum error of the estimate relative to the exact value.  Smaller
+        tolerances use more bins and are slower.
+
+    Returns
+    -------
+    std : 2D array (channel, window)
+
+    >>> x = np.random.RandomState(0).normal(scale=2, size=(4, 25000))
+    >>> x[1, 10000:15000] *= 1000
+    >>> x[2] = 0
+    >>> std = running_median_std(x, 1000, 250)
+    >>> std.shape
+    (4, 97)
+    >>> windows = [x[:, i:i+1000] for i in range(0, 24001, 250)]
+    >>> exact = np.array([np.median(np.abs(w), axis=-1) for w in windows]).T
+    >>> exact /= 0.6745
+    >>> np.all(np.abs(std-exact) <= exact*0.01)
+    True
+    >>> std = running_median_std(x, 1000, 250, tolerance=0.001)
+    >>> np.all(np.abs(std-exact) <= exact*0.001)
+    True
+
+    The window and step do not need to share a large common factor (e.g. 1 s
+    windows in 0.25 s steps at 31250 Hz).
+
+    >>> x = np.random.RandomState(0).normal(size=(2, 100000))
+    >>> std = running_median_std(x, 31250, 7812)
+    >>> windows = [x[:, i:i+31250] for i in range(0, 100000-31250+1, 7812)]
+    >>> exact = np.array([np.median(np.abs(w), axis=-1) for w in windows]).T
+    >>> exact /= 0.6745
+    >>> std.shape == exact.shape
+    True
+    >>> np.all(np.abs(std-exact) <= exact*0.01)
+    True
+    '''
+    n_channels, n_samples = x.shape
+    if n_windows is None:
+        n_windows = (n_samples-window_samples)//window_step+1
+    if n_windows <= 0:
+        return np.empty((n_channels, 0))
+
+    if window_step >= window_samples:
+        # The windows do not overlap, so there is nothing to share
+        x = x[:, :n_windows*window_step]
+        x = x.reshape((n_channels, n_windows, window_step))
+        return np.median(np.abs(x[..., :window_samples]), axis=-1)/0.6745
+
+    n = (n_windows-1)*window_step+window_samples
+    x = np.ascontiguousarray(x[:, :n], dtype=np.float32)
+
+    # For positive floats, the ordering of the bit patterns (read as integers)
+    # matches the ordering of the values.  Dropping the lower bits of the
+    # mantissa gives log-spaced bins with a relative width of at most
+    # 2**-mantissa_bits.  Clearing the sign bit gives the absolute value.
+    mantissa_bits = int(np.ceil(-np.log2(tolerance)))
+    shift = 23-mantissa_bits
+    bits = x.view(np.int32) & 0x7fffffff
+
+    # Center the binned range on the typical amplitude of each channel.  The
+    # first and last bins collect the values outside the range (zero always
+    # falls in the first bin).
+    subsample = bits[:, ::max(1, bits.shape[-1]//1000)]
+    center = np.median(subsample, axis=-1).astype(np.int64)
+    span = MEDIAN_STD_OCTAVES << 23
+    lower = np.maximum(center-span, 1 << shift) >> shift
+    n_bins = (2*span >> shift)+3
+    i = bits >> shift
+    i -= (lower[:, np.newaxis]-1).astype(np.int32)
+    np.clip(i, 0, n_bins-1, out=i)
+    del bits
+
+    def histograms(start, n_segments, length):
+        # Histogram of each of n_segments consecutive segments of length
+        # samples (computed in a single pass by giving each segment of each
+        # channel its own range of bins)
+        s = i[:, start:start+n_segments*length]
+        s = s.reshape((n_channels, n_segments, length))
+        offset = np.arange(n_channels*n_segments)*n_bins
+        s = s + offset.reshape((n_channels, n_segments, 1))
+        counts = np.bincount(s.ravel(), minlength=n_channels*n_segments*n_bins)
+        return counts.reshape((n_channels, n_segments, n_bins)).astype(np.int32)
+
+    std = np.zeros((n_channels, n_windows))
+    exact = np.zeros((n_channels, n_windows), dtype=np.bool)
+    batch = max(1, MEDIAN_STD_MAX_BINS//(n_channels*n_bins))
+    hist = histograms(0, 1, window_samples)
+    for lb in range(0, n_windows, batch):
+        ub = min(lb+batch, n_windows)
+        if lb > 0:
+            hist = hist[:, -1:]
+        # Histogram of each window in the batch.  The samples entering window
+        # w start at (w-1)*window_step+window_samples and the samples leaving
+        # it start at (w-1)*window_step.
+        w = max(lb, 1)
+        if w < ub:
+            start = (w-1)*window_step
+            delta = histograms(start+window_samples, ub-w, window_step)
+            delta -= histograms(start, ub-w, window_step)
+            delta[:, 0] += hist[:, -1]
+            np.cumsum(delta, axis=1, out=delta)
+            hist = np.concatenate((hist, delta), axis=1) if lb == 0 else delta
+        hist_cumulative = np.cumsum(hist, axis=-1)
+
+        # The median is the mean of the middle two values (which are the same
+        # value if window_samples is odd)
+        for rank in ((window_samples-1)//2, window_samples//2):
+            j = (hist_cumulative <= rank).sum(axis=-1)
+            exact[:, lb:ub] |= (j == 0) | (j == n_bins-1)
+            j_index = np.clip(j, 0, n_bins-1)[..., np.newaxis]
+            count = np.take_along_axis(hist, j_index, -1)[..., 0]
+            before = np.take_along_axis(hist_cumulative, j_index, -1)[..., 0]
+            before -= count
+            fraction = (rank-before+0.5)/np.maximum(count, 1)
+            value = (lower[:, np.newaxis]+j-1) << shift
+            value += (fraction*(1 << shift)).astype(np.int64)
+            std[:, lb:ub] += value.astype(np.int32).view(np.float32)
+    std *= 0.5
+
+    for c, w in zip(*np.nonzero(exact)):
+        lb = w*window_step
+        std[c, w] = np.median(np.abs(x[c, lb:lb+window_samples]))
+    return std/0.6745
+
 def filter_response(b, a, fs, axes_magnitude=None, axes_phase=None):
     # We need to keep the import inside here because a lot of GUI applications
     # based on PyQt may want to use Neurogen, and Matplotlib currently does not
@@ -0,0 +1,283 @@
+'''
+:mod:`cns.spike_detector` -- Online spike detection
+===================================================
+
+.. moduleauthor:: Brad Buran <bburan@alum.mit.edu>
+
+Detects spikes in the raw physiology data as it is acquired so they can be
+monitored during the experiment (the final spike times are obtained offline
+using `cns.analysis.extract_spikes`).
+
+Each block of data is referenced, then bandpass filtered using a causal filter
+(second-order sections) whose state is carried over from one block to the next,
+so the result does not depend on how the data is divided into blocks.  If the
+highpass cutoff is 0, a lowpass filter is used instead.  The
+threshold crossings are found the same way as in `extract_spikes` (the sample
+at or below the threshold followed by a sample above it) and a snippet around
+each crossing is sent to the spike channel.  A crossing near the end of a block
+is held until the block containing the rest of its snippet arrives.
+
+The work done for each block is proportional to the size of the block.  The
+time taken to process each block is recorded and compared against the latency
+budget (by default, the duration of the block) so that we know if detection is
+falling behind acquisition.  If the detector is called from the acquisition
+callback, an overrun stalls acquisition.  Use `DetectionThread` to run the
+detector in the background and drop blocks instead.
+'''
+
+import time
+import threading
+import Queue
+from collections import deque
+import numpy as np
+from scipy import signal
+
+from .sigtools import iirfilter_sos
+
+import logging
+log = logging.getLogger(__name__)
+
+class SpikeDetector(object):
+    '''
+    Detects spikes in blocks of multichannel data as they are acquired
+
+    fs
+        Sampling frequency of the data
+    thresholds
+        Threshold for each channel (in the units of the data).  A negative
+        threshold detects downward crossings.
+    bipolar
+        For each channel, detect crossings of either polarity (i.e. of the
+        absolute value of the signal).  If False, the sign of the threshold
+        determines the polarity.
+    fc_highpass, fc_lowpass, filter_order
+        Butterworth bandpass filter applied before thresholding.  If
+        fc_highpass is 0, a lowpass filter is applied.
+    diff_matrix
+        Referencing matrix (channel, channel) applied to each block before
+        filtering.  If None, the data is not referenced.
+    snippet_size
+        Number of samples in each snippet
+    samples_before
+        Number of samples in the snippet before the crossing.  If None, a
+        quarter of the snippet precedes the crossing.
+    targets
+        Sequence of instances of SnippetChannel (one per channel) the snippets
+        are sent to.  The timestamp of each snippet is the index of the
+        crossing (counting from the first sample sent to the detector) and the
+        classifier is 0.
+    processed
+        If not None, the filtered data is sent to this channel (e.g. for
+        plotting)
+    latency_budget
+        Maximum time (in seconds) processing a block should take.  If None, the
+        duration of the block is used.
+    history
+        Number of recent blocks to keep the processing time of (see `latency`)
+    '''
+
+    def __init__(self, fs, thresholds, bipolar=False, fc_highpass=300,
+                 fc_lowpass=6000, filter_order=4, diff_matrix=None,
+                 snippet_size=26, samples_before=None, targets=None,
+                 processed=None, latency_budget=None, history=10000):
+        self.fs = fs
+        self.n_channels = len(thresholds)
+        self.snippet_size = snippet_size
+        if samples_before is None:
+            samples_before = snippet_size//4
+        self.samples_before = samples_before
+        self.samples_after = snippet_size-samples_before
+        self.targets = targets
+        self.processed = processed
+        self.diff_matrix = diff_matrix
+        self.latency_budget = latency_budget
+        self.latency = deque(maxlen=history)
+        self.overruns = 0
+        self._lock = threading.Lock()
+        self._offset = 0
+        self._tail = np.empty((self.n_channels, 0))
+        self.set_thresholds(thresholds, bipolar)
+        self.set_filter(fc_highpass, fc_lowpass, filter_order)
+
+    def set_thresholds(self, thresholds, bipolar=False):
+        '''
+        Update the thresholds (see the class documentation).  This takes effect
+        with the next block.
+        '''
+        thresholds = np.asarray(thresholds, dtype=np.float64)
+        bipolar = np.ones(self.n_channels, dtype=np.bool)*bipolar
+        signs = np.where(thresholds < 0, -1.0, 1.0)
+        signs[bipolar] = 0
+        with self._lock:
+            self._thresholds = np.abs(thresholds)[:, np.newaxis]
+            self._signs = signs[:, np.newaxis]
+
+    def set_filter(self, fc_highpass, fc_lowpass, filter_order=4):
+        '''
+        Update the filter.  The state of the filter and any crossings that are
+        waiting for the rest of their snippet are discarded.
+        '''
+        if fc_highpass <= 0:
+            Wn, btype = fc_lowpass/(0.5*self.fs), 'lowpass'
+        else:
+            Wn = np.array([fc_highpass, fc_lowpass])/(0.5*self.fs)
+            btype = 'bandpass'
+        sos, zi = iirfilter_sos(filter_order, Wn, btype=btype)
+        with self._lock:
+            self._sos = sos
+            self._zi_step = zi[:, np.newaxis, :]
+            self._reset()
+
+    def set_diff_matrix(self, diff_matrix):
+        '''
+        Update the referencing matrix.  The state of the filter is discarded (as
+        in `set_filter`).
+        '''
+        with self._lock:
+            self.diff_matrix = diff_matrix
+            self._reset()
+
+    def reset(self):
+        '''
+        Discard the state carried over from the previous block.  The sample
+        count (used for the timestamps) is not reset.
+        '''
+        with self._lock:
+            self._reset()
+
+    def skip(self, n_samples):
+        '''
+        Account for a gap of n_samples that will not be sent (e.g. blocks that
+        were dropped) so the timestamps of the following spikes remain correct.
+        The state carried over from the previous block is discarded.
+        '''
+        with self._lock:
+            self._reset()
+            self._offset += n_samples
+
+    def _reset(self):
+        self._zi = None
+        self._offset += self._tail.shape[-1]
+        self._tail = np.empty((self.n_channels, 0))
+        self._start = self.samples_before
+
+    def send(self, data):
+        '''
+        Process a block of data (channel, sample)
+        '''
+        t_start = time.time()
+        with self._lock:
+            self._process(np.asarray(data, dtype=np.float64))
+        elapsed = time.time()-t_start
+        self.latency.append(elapsed)
+        budget = self.latency_budget
+        if budget is None:
+            budget = data.shape[-1]/float(self.fs)
+        if elapsed > budget:
+            self.overruns += 1
+            log.warn('Spike detection took %.1f ms (budget %.1f ms)',
+                     elapsed*1e3, budget*1e3)
+
+    def _process(self, x):
+        if x.shape[-1] == 0:
+            return
+        if self.diff_matrix is not None:
+            x = np.dot(self.diff_matrix, x)
+
+        # Initialize the filter to the steady-state response to the first
+        # sample to avoid the transient caused by the DC offset
+        if self._zi is None:
+            self._zi = self._zi_step*x[np.newaxis, :, :1]
+        y, self._zi = signal.sosfilt(self._sos, x, zi=self._zi)
+        if self.processed is not None:
+            self.processed.send(y.astype(np.float32))
+
+        # Sample j of buffer is sample _offset+j of the data.  Crossings are
+        # checked at the samples from _start up to (but not including) stop,
+        # the first sample whose snippet is not yet complete.
+        buffer = np.concatenate((self._tail, y), axis=-1)
+        stop = buffer.shape[-1]-self.samples_after
+        if stop > self._start:
+            c = buffer[:, self._start:stop+1]
+            c = np.where(self._signs == 0, np.abs(c), c*self._signs)
+            crossings = (c[:, :-1] <= self._thresholds) & \
+                (c[:, 1:] > self._thresholds)
+            channel_index, sample_index = np.where(crossings)
+            sample_index += self._start
+            if len(sample_index) and self.targets is not None:
+                self._send_snippets(buffer, channel_index, sample_index)
+            # Keep the samples required for the snippets of the crossings that
+            # will be checked in the next block
+            lb = stop-self.samples_before
+            self._tail = buffer[:, lb:]
+            self._offset += lb
+            self._start = self.samples_before
+        else:
+            self._tail = buffer
+
+    def _send_snippets(self, buffer, channel_index, sample_index):
+        window = np.arange(self.snippet_size)-self.samples_before
+        snippets = buffer[channel_index[:, np.newaxis],
+                          sample_index[:, np.newaxis]+window]
+        snippets = snippets.astype(np.float32)
+        timestamps = (sample_index+self._offset).astype(np.int32)
+        for i in np.unique(channel_index):
+            mask = channel_index == i
+            n = mask.sum()
+            self.targets[i].send(snippets[mask], timestamps[mask],
+                                 np.zeros(n, dtype=np.int32))
+
+class DetectionThread(object):
+    '''
+    Runs a SpikeDetector in a background thread so acquisition never waits for
+    detection
+
+    Blocks are handed to the thread through a queue holding at most
+    max_pending blocks.  If detection falls that far behind, new blocks are
+    dropped (the spikes in them are not detected) rather than stalling
+    acquisition.  The timestamps of the spikes following a gap still count the
+    dropped samples (see `SpikeDetector.skip`).  The number of blocks dropped
+    is counted by dropped.
+    '''
+
+    def __init__(self, detector, max_pending=10):
+        self.detector = detector
+        self.dropped = 0
+        self._skipped = 0
+        self._queue = Queue.Queue(max_pending)
+        self._thread = threading.Thread(target=self._run,
+                                        name='SpikeDetector')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def send(self, data):
+        '''
+        Queue a block of data (channel, sample) for detection.  Returns
+        immediately.
+        '''
+        try:
+            self._queue.put_nowait((self._skipped, data))
+            self._skipped = 0
+        except Queue.Full:
+            self._skipped += data.shape[-1]
+            self.dropped += 1
+            log.warn('Spike detection is falling behind, dropped a block')
+
+    def stop(self):
+        '''
+        Process the blocks that are queued and stop the thread
+        '''
+        self._queue.put((self._skipped, None))
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            skipped, data = self._queue.get()
+            if skipped:
+                self.detector.skip(skipped)
+            if data is None:
+                break
+            try:
+                self.detector.send(data)
+            except Exception:
+                log.exception('Spike detection failed')
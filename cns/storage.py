@@ -0,0 +1,304 @@
+'''
+:mod:`cns.storage` -- Tune HDF5 storage settings for channel data
+=================================================================
+
+.. moduleauthor:: Brad Buran <bburan@alum.mit.edu>
+
+The best chunkshape and compression filter for a :class:`cns.channel.FileMixin`
+channel depend on the signal (noise floor, dynamic range) as well as on how the
+data is written (size of each acquisition block) and read (sequential scans by
+the analysis scripts vs. random windows when browsing the data).  Rather than
+guessing, `tune_storage` writes a representative signal (either a segment of a
+recording or the output of `synthetic_signal`) to a temporary file using each
+candidate setting and measures:
+
+    append
+        Append throughput (samples per second) when writing the signal in blocks
+        of block_size samples through the channel class.
+    read
+        Sequential read throughput (samples per second) when reading the signal
+        back in blocks of the chunk length.
+    latency
+        Median time (in seconds) to read a randomly-positioned window of
+        window_size samples.
+    size
+        Size of the file on disk (in bytes).
+
+Each timing is repeated and the fastest repeat is used, since a single timing
+is easily thrown off by other activity on the machine.  Profiles that result
+in the same storage layout (e.g. a chunk_samples of 0 that PyTables resolves
+to one of the other candidate chunk lengths) are only benchmarked once.
+
+The storage profile returned is a dictionary of keyword arguments understood by
+the channel constructors::
+
+    profile = tune_storage(signal, fs)[0]['profile']
+    raw = FileMultiChannel(node=node, name='raw', channels=16, **profile)
+
+See scripts/tune_storage.py for a command-line interface.
+'''
+
+import os
+import json
+import shutil
+import tempfile
+import itertools
+import timeit
+import numpy as np
+import tables
+
+from .channel import FileChannel, FileMultiChannel
+
+import logging
+log = logging.getLogger(__name__)
+
+# Settings in a storage profile.  These map directly onto the traits of
+# FileMixin.
+PROFILE_KEYS = ('chunk_samples', 'compression_type', 'compression_level',
+                'use_shuffle')
+
+def synthetic_signal(channels=16, duration=10, fs=25e3, spike_rate=20,
+                     seed=0):
+    '''
+    Generate a signal with roughly the statistics of an extracellular recording
+    (broadband noise, a slow LFP-like component and sparse spikes) to use when
+    no recording is available.  Returns a float32 array of shape (channels,
+    samples) in volts.
+    '''
+    state = np.random.RandomState(seed)
+    n = int(duration*fs)
+    noise = state.normal(scale=10e-6, size=(channels, n))
+    # Integrated noise has a 1/f^2 spectrum.  Remove the drift so it resembles
+    # a LFP rather than a random walk.
+    lfp = np.cumsum(state.normal(scale=1e-6, size=(channels, n)), axis=-1)
+    lfp -= np.linspace(0, 1, n)*lfp[:, -1:]
+    waveform = -np.exp(-np.arange(-16, 32)**2/40.0)*80e-6
+    for i in range(channels):
+        n_spikes = state.poisson(spike_rate*duration)
+        times = state.randint(16, n-32, n_spikes)
+        for t in times:
+            noise[i, t-16:t+32] += waveform
+    return (noise+lfp).astype(np.float32)
+
+def available_codecs():
+    '''
+    Return the compression libraries supported by this build of PyTables
+    '''
+    return [c for c in ('zlib', 'lzo', 'blosc')
+            if tables.which_lib_version(c) is not None]
+
+def candidate_profiles(chunk_samples=(0, 4096, 16384, 65536),
+                       codecs=None, levels=(1, 5, 9), shuffle=(False, True)):
+    '''
+    Generate the combinations of storage settings to benchmark.  The
+    uncompressed profile is always included.  A chunk_samples of 0 uses the
+    PyTables default.
+    '''
+    if codecs is None:
+        codecs = available_codecs()
+    profiles = []
+    for n in chunk_samples:
+        profiles.append(dict(chunk_samples=n, compression_type=None,
+                             compression_level=0, use_shuffle=False))
+        for codec, level, use_shuffle in \
+                itertools.product(codecs, levels, shuffle):
+            profiles.append(dict(chunk_samples=n, compression_type=codec,
+                                 compression_level=level,
+                                 use_shuffle=use_shuffle))
+    return profiles
+
+def _create_channel(node, signal, fs, profile):
+    # Writes are buffered as they are for the acquisition channels
+    kwargs = dict(node=node, name='signal', fs=fs, dtype=signal.dtype,
+                  expected_duration=signal.shape[-1]/fs, buffer_writes=True)
+    kwargs.update(profile)
+    if signal.ndim == 1:
+        return FileChannel(**kwargs)
+    return FileMultiChannel(channels=signal.shape[0], **kwargs)
+
+def resolve_profile(signal, fs, profile, directory=None):
+    '''
+    Return the storage layout that the profile results in, i.e. a tuple of the
+    chunkshape and the filter settings.  Two profiles with the same layout
+    store the data identically.
+    '''
+    tempdir = tempfile.mkdtemp(dir=directory)
+    try:
+        fh = tables.open_file(os.path.join(tempdir, 'storage.h5'), 'w')
+        chunkshape = _create_channel(fh.root, signal, fs, profile)._array \
+            .chunkshape
+        fh.close()
+    finally:
+        shutil.rmtree(tempdir, ignore_errors=True)
+    if not profile['compression_level']:
+        return chunkshape, None, 0, False
+    return chunkshape, profile['compression_type'], \
+        profile['compression_level'], profile['use_shuffle']
+
+def benchmark_storage(signal, fs, profile, block_size=1000, window_size=None,
+                      n_windows=50, directory=None, seed=0, repeat=3):
+    '''
+    Measure the performance of a single storage profile (see the module
+    docstring for the metrics).  Returns a dictionary containing the metrics
+    along with the profile and resulting chunkshape.
+
+    Parameters
+    ----------
+    signal : array (samples,) or (channels, samples)
+        Representative signal
+    fs : float
+        Sampling frequency of the signal
+    profile : dict
+        Storage settings (see `PROFILE_KEYS`)
+    block_size : int
+        Number of samples in each append (i.e. the acquisition block size)
+    window_size : int
+        Number of samples in each random window read.  Defaults to 1 s.
+    n_windows : int
+        Number of random windows to read
+    directory : string
+        Directory to create the temporary file in
+    repeat : int
+        Number of times each timing is repeated (the fastest is used)
+    '''
+    if window_size is None:
+        window_size = int(fs)
+    window_size = min(window_size, signal.shape[-1])
+    n = signal.shape[-1]
+    tempdir = tempfile.mkdtemp(dir=directory)
+    try:
+        # Each append is timed writing the signal to a new file
+        t_append = []
+        for r in range(repeat):
+            filename = os.path.join(tempdir, 'storage_{}.h5'.format(r))
+            fh = tables.open_file(filename, 'w')
+            channel = _create_channel(fh.root, signal, fs, profile)
+
+            def append():
+                for i in range(0, n, block_size):
+                    channel.send(signal[..., i:i+block_size])
+                channel.flush()
+                fh.flush()
+            t_append.append(timeit.timeit(append, number=1))
+            chunkshape = channel._array.chunkshape
+            fh.close()
+        size = os.path.getsize(filename)
+
+        t_read = []
+        latencies = []
+        state = np.random.RandomState(seed)
+        starts = state.randint(0, n-window_size+1, n_windows)
+        for r in range(repeat):
+            # Reopen the file so the reads are not served from the HDF5 chunk
+            # cache populated while writing (or by the previous repeat).
+            fh = tables.open_file(filename, 'r')
+            array = fh.root.signal
+            read_size = chunkshape[array.maindim]
+            def read():
+                for i in range(0, n, read_size):
+                    array[..., i:i+read_size]
+            t_read.append(timeit.timeit(read, number=1))
+            fh.close()
+
+            fh = tables.open_file(filename, 'r')
+            array = fh.root.signal
+            latencies.append([timeit.timeit(
+                lambda: array[..., lb:lb+window_size], number=1)
+                for lb in starts])
+            fh.close()
+    finally:
+        shutil.rmtree(tempdir, ignore_errors=True)
+
+    latency = np.median(np.min(latencies, axis=0))
+    return dict(profile=profile, chunkshape=chunkshape, append=n/min(t_append),
+                read=n/min(t_read), latency=latency, size=size)
+
+def score_results(results, weights=None):
+    '''
+    Assign a score to each result (lower is better) and return the results
+    sorted by score
+
+    Each metric is normalized by the best value across all results so a score
+    of 1.0 for a metric means it was the best for that metric.  The score is
+    the weighted sum of the normalized metrics.  By default, all four metrics
+    are weighted equally.  To ignore a metric, set its weight to 0.
+    '''
+    if weights is None:
+        weights = dict(append=1, read=1, latency=1, size=1)
+    best_append = max(r['append'] for r in results)
+    best_read = max(r['read'] for r in results)
+    best_latency = min(r['latency'] for r in results)
+    best_size = min(r['size'] for r in results)
+    for r in results:
+        r['score'] = weights.get('append', 0)*best_append/r['append'] + \
+                     weights.get('read', 0)*best_read/r['read'] + \
+                     weights.get('latency', 0)*r['latency']/best_latency + \
+                     weights.get('size', 0)*float(r['size'])/best_size
+    return sorted(results, key=lambda r: r['score'])
+
+def tune_storage(signal, fs, profiles=None, weights=None, min_append=2.0,
+                 progress_callback=None, **kwargs):
+    '''
+    Benchmark each candidate storage profile and return the results sorted from
+    best to worst (see `score_results`).  The best profile is
+    tune_storage(...)[0]['profile'].  Profiles that result in the same storage
+    layout as an earlier profile (see `resolve_profile`) are skipped.
+
+    Parameters
+    ----------
+    signal : array (samples,) or (channels, samples)
+        Representative signal (e.g. a few seconds of a recording or the output
+        of `synthetic_signal`).
+    fs : float
+        Sampling frequency of the signal
+    profiles : list of dict
+        Candidate profiles.  Defaults to `candidate_profiles()`.
+    weights : dict
+        Weight of each metric (see `score_results`)
+    min_append : float
+        Profiles that cannot append data at least this many times faster than
+        real-time are discarded (they could not keep up with acquisition).
+    progress_callback : callable
+        Called as progress_callback(i, n, mesg) after each profile
+    kwargs
+        Passed to `benchmark_storage`
+    '''
+    if profiles is None:
+        profiles = candidate_profiles()
+    results = []
+    layouts = set()
+    for i, profile in enumerate(profiles):
+        layout = resolve_profile(signal, fs, profile, kwargs.get('directory'))
+        if layout in layouts:
+            log.debug('%r: duplicate of layout %r', profile, layout)
+        else:
+            layouts.add(layout)
+            result = benchmark_storage(signal, fs, profile, **kwargs)
+            log.debug('%r: %r', profile, result)
+            if result['append'] >= min_append*fs:
+                results.append(result)
+        if progress_callback is not None:
+            progress_callback(i+1, len(profiles), 'Benchmarking profiles')
+    if not results:
+        raise ValueError, 'No profile could append data fast enough'
+    return score_results(results, weights)
+
+def save_profile(profile, filename):
+    '''
+    Save the storage profile to a JSON file
+    '''
+    profile = dict((k, profile[k]) for k in PROFILE_KEYS)
+    with open(filename, 'w') as fh:
+        json.dump(profile, fh, indent=4, sort_keys=True)
+
+def load_profile(filename):
+    '''
+    Load a storage profile saved by `save_profile`.  The result can be passed
+    as keyword arguments to the channel constructors.
+    '''
+    with open(filename) as fh:
+        profile = json.load(fh)
+    # JSON returns unicode strings which tables.Filters does not accept
+    if profile['compression_type'] is not None:
+        profile['compression_type'] = str(profile['compression_type'])
+    return dict((str(k), v) for k, v in profile.items() if k in PROFILE_KEYS)
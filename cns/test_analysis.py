@@ -0,0 +1,127 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import tables as tb
+
+from cns import analysis
+from cns.channel import FileMultiChannel
+
+FS = 25e3
+WAVEFORM = -8*np.exp(-np.arange(-16, 32)**2/40.0)
+
+PROCESSING = dict(filter_freq_lp=6000, filter_freq_hp=300,
+                  filter_btype='bandpass', filter_order=4, bad_channels=[],
+                  diff_mode=None)
+
+def create_recording(filename, channels=4, blocks=8, block_size=25000,
+                     seed=0):
+    '''
+    Save noise with spikes added at random times to the physiology node of a
+    new experiment file
+    '''
+    state = np.random.RandomState(seed)
+    fh = tb.open_file(filename, 'w')
+    node = fh.create_group('/', 'experiment')
+    node = fh.create_group(node, 'data')
+    node = fh.create_group(node, 'physiology')
+    raw = FileMultiChannel(node=node, name='raw', channels=channels, fs=FS,
+                           dtype=np.float32)
+    for i in range(blocks):
+        x = state.normal(size=(channels, block_size)).astype(np.float32)
+        for channel in range(channels):
+            for t in state.randint(16, block_size-32, 100):
+                x[channel, t-16:t+32] += WAVEFORM
+        raw.send(x)
+    fh.close()
+
+def read_arrays(node):
+    return dict((n._v_pathname, n.read()) for n in node._f_walknodes()
+                if isinstance(n, tb.Array))
+
+class TestExtractSpikes(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        filename = os.path.join(self.tempdir, 'raw.h5')
+        create_recording(filename)
+        self.fh_in = tb.open_file(filename, 'r')
+
+    def tearDown(self):
+        self.fh_in.close()
+        shutil.rmtree(self.tempdir)
+
+    def extract(self, n_jobs, **kwargs):
+        filename = os.path.join(self.tempdir, 'spikes_{}.h5'.format(n_jobs))
+        fh_out = tb.open_file(filename, 'w')
+        # The covariance waveforms are drawn at random
+        np.random.seed(0)
+        analysis.extract_spikes(self.fh_in.root.experiment, fh_out.root,
+                                channels=range(4), noise_std=np.ones(4),
+                                threshold_stds=-4*np.ones(4),
+                                rej_threshold_stds=20*np.ones(4),
+                                processing=PROCESSING, cov_samples=100,
+                                include_block_data=False, n_jobs=n_jobs,
+                                **kwargs)
+        result = read_arrays(fh_out.root)
+        result['chunk_samples'] = \
+            fh_out.root.event_data._v_attrs['chunk_samples']
+        fh_out.close()
+        return result
+
+    def assertResultsEqual(self, expected, actual):
+        self.assertEquals(sorted(expected), sorted(actual))
+        for name in expected:
+            np.testing.assert_array_equal(expected[name], actual[name],
+                                          err_msg=name)
+
+    def test_n_jobs(self):
+        # The output does not depend on how the work is divided
+        expected = self.extract(1, chunk_size=2e5)
+        self.assertTrue(len(expected['/event_data/timestamps_n']) > 0)
+        self.assertResultsEqual(expected, self.extract(2, chunk_size=2e5))
+
+    def test_n_jobs_budget(self):
+        # With n_jobs > 1, the memory budget is shared by the chunks held by
+        # the workers and the results waiting to be saved (six chunks for two
+        # workers, although the serial chunks are rounded down to the HDF5
+        # chunk length)
+        budget = analysis.default_memory_budget
+        try:
+            analysis.default_memory_budget = 6e6
+            serial = self.extract(1, chunk_size=None)['chunk_samples']
+            parallel = self.extract(2, chunk_size=None)['chunk_samples']
+        finally:
+            analysis.default_memory_budget = budget
+        self.assertTrue(parallel*4 < serial)
+
+class TestSpectrogram(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.fh = tb.open_file(os.path.join(self.tempdir, 'lfp.h5'), 'w')
+        data = np.random.RandomState(0).normal(size=(4, 30000))
+        self.lfp = self.fh.create_earray('/', 'lfp', tb.Float32Atom(), (4, 0))
+        self.lfp.append(data)
+        self.lfp._v_attrs['fs'] = 1000.0
+
+    def tearDown(self):
+        self.fh.close()
+        shutil.rmtree(self.tempdir)
+
+    def spectrogram(self, name, **kwargs):
+        node = self.fh.create_group('/', name)
+        analysis.compute_spectrogram(self.lfp, node, [16, 32, 64], **kwargs)
+        return node.spectrogram.read()
+
+    def test_chunk_size(self):
+        # A chunk size larger than the array is limited to the array length
+        # (the wavelet bank is sized from the chunk length)
+        self.assertEquals(analysis._plan_chunk(self.lfp, 1e9, [], 3), 30000)
+        expected = self.spectrogram('chunked', chunk_size=1e5)
+        actual = self.spectrogram('single', chunk_size=1e9)
+        np.testing.assert_allclose(actual, expected, rtol=1e-4, atol=1e-4)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import numpy as np
+import tables as tb
+
+from cns.channel import FileMultiChannel, AppendBuffer
+
+class TestOverview(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.fh = tb.open_file(os.path.join(self.tempdir, 'overview.h5'), 'w')
+        self.channel = FileMultiChannel(node=self.fh.root, name='raw',
+                                        channels=2, fs=10, dtype=np.float32,
+                                        overview_levels=2, overview_factor=4)
+        self.data = np.random.RandomState(0).normal(size=(2, 30))
+        self.data = self.data.astype(np.float32)
+        self.channel.send(self.data)
+
+    def tearDown(self):
+        self.fh.close()
+        shutil.rmtree(self.tempdir)
+
+    def check(self, lb, ub, downsample):
+        t, mins, maxes = self.channel.get_range_extremes(lb/10.0, ub/10.0,
+                                                         downsample)
+        # Every bin lies within the range and the bins cover the range
+        edges = np.r_[np.round(t*10).astype(np.int), ub]
+        self.assertEquals(edges[0], lb)
+        for i in range(len(t)):
+            x = self.data[:, edges[i]:edges[i+1]]
+            np.testing.assert_array_equal(mins[:, i], x.min(axis=-1))
+            np.testing.assert_array_equal(maxes[:, i], x.max(axis=-1))
+
+    def test_pyramid(self):
+        self.check(0, 16, 16)
+        self.check(0, 28, 4)
+
+    def test_partial_bin(self):
+        # The range starts or ends partway through a bin of the pyramid
+        self.check(0, 6, 4)
+        self.check(0, 22, 16)
+        self.check(5, 27, 4)
+        self.check(2, 7, 4)
+
+    def test_tail(self):
+        # Level 2 only summarizes the first 16 samples, so the range starts in
+        # the samples that are not yet summarized
+        self.check(20, 30, 16)
+        self.check(17, 30, 16)
+
+class TestChannelSelection(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.fh = tb.open_file(os.path.join(self.tempdir, 'raw.h5'), 'w')
+        self.channel = FileMultiChannel(node=self.fh.root, name='raw',
+                                        channels=6, fs=10, dtype=np.float32,
+                                        chunk_channels=2, chunk_samples=8)
+        self.data = np.arange(6*30, dtype=np.float32).reshape((6, 30))
+        self.channel.send(self.data)
+
+    def tearDown(self):
+        self.fh.close()
+        shutil.rmtree(self.tempdir)
+
+    def test_chunkshape(self):
+        self.assertEquals(self.channel._array.chunkshape, (2, 8))
+
+    def test_rows(self):
+        np.testing.assert_array_equal(self.channel[[4, 1], 5:20],
+                                      self.data[[4, 1], 5:20])
+        np.testing.assert_array_equal(self.channel[3, 5:20],
+                                      self.data[3, 5:20])
+
+    def test_mask(self):
+        mask = np.array([True, False, False, True, True, False])
+        np.testing.assert_array_equal(self.channel[mask, 5:20],
+                                      self.data[mask, 5:20])
+
+class TestAppendBuffer(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.fh = tb.open_file(os.path.join(self.tempdir, 'buffer.h5'), 'w')
+        array = self.fh.create_earray('/', 'raw', tb.Int64Atom(), (2, 0),
+                                      chunkshape=(2, 64))
+        self.buffer = AppendBuffer(array, max_age=60)
+
+    def tearDown(self):
+        self.fh.close()
+        shutil.rmtree(self.tempdir)
+
+    def test_concurrent_read(self):
+        # The value of each sample is its index.  Reads (including fancy
+        # indexing, which flushes the pending data) run while another thread
+        # appends, and every sample must reach the array.
+        n_blocks, block_size = 500, 7
+        errors = []
+        done = threading.Event()
+
+        def write():
+            for i in range(0, n_blocks*block_size, block_size):
+                block = np.arange(i, i+block_size)
+                self.buffer.append(np.vstack((block, block)))
+            done.set()
+
+        def read():
+            while not done.is_set():
+                n = self.buffer.shape[-1]
+                lb = max(0, n-100)
+                for data in (self.buffer[:, lb:n], self.buffer[[1, 0], lb:n],
+                             self.buffer[..., lb:n]):
+                    if not np.array_equal(data[0], np.arange(lb, n)):
+                        errors.append((lb, n, data))
+
+        threads = [threading.Thread(target=write),
+                   threading.Thread(target=read)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.buffer.flush()
+        self.assertEquals(errors, [])
+        expected = np.arange(n_blocks*block_size)
+        np.testing.assert_array_equal(self.buffer.array[:],
+                                      np.vstack((expected, expected)))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import tables as tb
+
+from cns import analysis
+from cns.checkpoint import has_checkpoint
+from cns.test_analysis import create_recording, read_arrays, PROCESSING
+
+class Abort(object):
+    '''
+    Progress callback that counts the calls and aborts the analysis after n
+    chunks
+    '''
+
+    def __init__(self, n=None):
+        self.n = n
+        self.calls = 0
+
+    def __call__(self, processed, total, mesg):
+        self.calls += 1
+        return self.calls == self.n
+
+class TestResume(unittest.TestCase):
+    '''
+    Aborts each analysis partway through (saving a checkpoint after every
+    chunk), resumes it and checks that the output is identical to an
+    uninterrupted run
+    '''
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        filename = os.path.join(self.tempdir, 'raw.h5')
+        create_recording(filename)
+        self.fh_in = tb.open_file(filename, 'r')
+        self.input_node = self.fh_in.root.experiment
+
+    def tearDown(self):
+        self.fh_in.close()
+        shutil.rmtree(self.tempdir)
+
+    def check_resume(self, name, function):
+        def run(progress_callback):
+            # Random draws (e.g. the covariance waveforms) are repeated
+            np.random.seed(0)
+            function(fh_out.root, progress_callback=progress_callback,
+                     checkpoint_interval=0)
+
+        filename = os.path.join(self.tempdir, name+'_expected.h5')
+        fh_out = tb.open_file(filename, 'w')
+        uninterrupted = Abort()
+        run(uninterrupted)
+        expected = read_arrays(fh_out.root)
+        fh_out.close()
+
+        filename = os.path.join(self.tempdir, name+'_resumed.h5')
+        fh_out = tb.open_file(filename, 'w')
+        run(Abort(3))
+        self.assertTrue(has_checkpoint(fh_out.root))
+        fh_out.close()
+        fh_out = tb.open_file(filename, 'a')
+        resumed = Abort()
+        run(resumed)
+        self.assertFalse(has_checkpoint(fh_out.root))
+        # The chunks processed before the abort are not processed again
+        self.assertEquals(resumed.calls, uninterrupted.calls-3)
+        actual = read_arrays(fh_out.root)
+        fh_out.close()
+
+        self.assertEquals(sorted(expected), sorted(actual))
+        for pathname in expected:
+            np.testing.assert_array_equal(expected[pathname],
+                                          actual[pathname],
+                                          err_msg=pathname)
+
+    def test_extract_spikes(self):
+        def function(output_node, **kwargs):
+            analysis.extract_spikes(self.input_node, output_node,
+                                    channels=range(4), noise_std=np.ones(4),
+                                    threshold_stds=-4*np.ones(4),
+                                    rej_threshold_stds=20*np.ones(4),
+                                    processing=PROCESSING, cov_samples=100,
+                                    chunk_size=2e5, include_block_data=False,
+                                    **kwargs)
+        self.check_resume('extract_spikes', function)
+
+    def test_running_rms(self):
+        def function(output_node, **kwargs):
+            analysis.running_rms(self.input_node, output_node, 0.5, 0.25,
+                                 PROCESSING, algorithm='median',
+                                 chunk_size=2e5, **kwargs)
+        self.check_resume('running_rms', function)
+
+    def test_decimate_waveform(self):
+        for filter_method in ('ba', 'sos', 'fir'):
+            def function(output_node, **kwargs):
+                analysis.decimate_waveform(self.input_node, output_node,
+                                           filter_method=filter_method,
+                                           chunk_size=2e5,
+                                           include_block_data=False,
+                                           **kwargs)
+            self.check_resume('decimate_'+filter_method, function)
+
+    def test_compute_spectrogram(self):
+        filename = os.path.join(self.tempdir, 'lfp.h5')
+        fh_lfp = tb.open_file(filename, 'w')
+        analysis.decimate_waveform(self.input_node, fh_lfp.root,
+                                   include_block_data=False)
+        try:
+            def function(output_node, **kwargs):
+                analysis.compute_spectrogram(fh_lfp.root.lfp, output_node,
+                                             [16, 32, 64], chunk_size=2e3,
+                                             include_block_data=False,
+                                             **kwargs)
+            self.check_resume('compute_spectrogram', function)
+        finally:
+            fh_lfp.close()
+
+if __name__ == '__main__':
+    unittest.main()
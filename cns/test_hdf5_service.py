@@ -0,0 +1,144 @@
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+import numpy as np
+import tables as tb
+
+from cns import hdf5_service
+from cns.channel import FileMultiChannel
+
+class TestHDF5Service(unittest.TestCase):
+
+    def setUp(self):
+        self.service = hdf5_service.HDF5Service()
+        self.service.start()
+
+    def tearDown(self):
+        self.service.stop()
+
+    def test_call(self):
+        result = self.service.call(lambda x, y: x+y, 1, y=2)
+        self.assertEquals(result, 3)
+        thread = self.service.call(threading.current_thread)
+        self.assertEquals(thread.name, 'HDF5Service')
+
+    def test_exception(self):
+        def fail():
+            raise ValueError, 'failed'
+        self.assertRaises(ValueError, self.service.call, fail)
+        # The service should continue after a failed request
+        self.assertEquals(self.service.call(lambda: 1), 1)
+
+    def test_nested(self):
+        # Calls made from the service thread must not deadlock
+        nested = lambda: self.service.call(lambda: 'nested')
+        self.assertEquals(self.service.call(nested), 'nested')
+
+    def test_priority(self):
+        # Hold the service thread so the requests below queue up
+        release = threading.Event()
+        blocked = self.service.submit(release.wait)
+        order = []
+        reads = [self.service.submit(order.append, 'read',
+                                     priority=hdf5_service.READ)
+                 for i in range(3)]
+        write = self.service.submit(order.append, 'write',
+                                    priority=hdf5_service.WRITE)
+        release.set()
+        for request in [blocked, write] + reads:
+            request.result()
+        self.assertEquals(order, ['write', 'read', 'read', 'read'])
+
+    def test_stop(self):
+        # Pending requests are executed before the service stops
+        release = threading.Event()
+        self.service.submit(release.wait)
+        order = []
+        for i in range(5):
+            self.service.submit(order.append, i)
+        release.set()
+        self.service.stop()
+        self.assertEquals(order, range(5))
+        self.assertFalse(self.service.running)
+        # Once stopped, calls are executed in the calling thread
+        thread = self.service.call(threading.current_thread)
+        self.assertEquals(thread, threading.current_thread())
+
+class TestInstall(unittest.TestCase):
+
+    def test_reference_count(self):
+        # The service stays installed until every install has been undone
+        original = tb.File.__dict__['create_group']
+        service = hdf5_service.install()
+        try:
+            self.assertTrue(hdf5_service.install() is service)
+            hdf5_service.uninstall()
+            self.assertTrue(hdf5_service.get_service() is service)
+            self.assertFalse(tb.File.__dict__['create_group'] is original)
+        finally:
+            hdf5_service.uninstall()
+        self.assertTrue(hdf5_service.get_service() is None)
+        self.assertTrue(tb.File.__dict__['create_group'] is original)
+
+class TestStress(unittest.TestCase):
+    '''
+    Simulates acquisition (a 16 channel block appended every 10 ms) while
+    several plots read 0.5 s windows of the data.  Writes should never wait
+    behind the queued reads.
+    '''
+
+    def setUp(self):
+        self.service = hdf5_service.install()
+        self.tempdir = tempfile.mkdtemp()
+        self.fh = tb.open_file(os.path.join(self.tempdir, 'stress.h5'), 'w')
+
+    def tearDown(self):
+        self.fh.close()
+        hdf5_service.uninstall()
+        shutil.rmtree(self.tempdir)
+
+    def test_write_latency(self):
+        channel = FileMultiChannel(node=self.fh.root, name='raw', channels=16,
+                                   fs=25e3, dtype=np.float32, flush_samples=1)
+        channel.get_size()
+        done = threading.Event()
+
+        def engine():
+            data = np.random.randn(16, 250).astype(np.float32)
+            for i in range(300):
+                channel.send(data)
+                time.sleep(0.01)
+            done.set()
+
+        def plot():
+            while not done.is_set():
+                ub = channel.get_size()
+                if ub > 12500:
+                    lb = np.random.randint(0, ub-12500)
+                    channel[:, lb:lb+12500]
+                else:
+                    time.sleep(0.01)
+
+        threads = [threading.Thread(target=plot) for i in range(4)]
+        threads.append(threading.Thread(target=engine))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        writes = np.array(self.service.timing[hdf5_service.WRITE])
+        reads = np.array(self.service.timing[hdf5_service.READ])
+        self.assertTrue(len(writes) >= 300)
+        self.assertTrue(len(reads) > 0)
+        # A write waits at most for the request that is executing when it is
+        # submitted (plus some slack for thread scheduling).
+        wait = writes[:, 1]-writes[:, 0]
+        longest = np.max(np.r_[reads[:, 2]-reads[:, 1],
+                               writes[:, 2]-writes[:, 1]])
+        self.assertTrue(wait.max() <= longest+0.05)
+
+if __name__ == '__main__':
+    unittest.main()
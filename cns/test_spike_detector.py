@@ -0,0 +1,187 @@
+import time
+import threading
+import unittest
+import numpy as np
+
+from cns.spike_detector import SpikeDetector, DetectionThread
+from cns.channel import RAMSnippetChannel
+
+FS = 25e3
+WAVEFORM = -3*np.exp(-np.arange(-8, 16)**2/8.0)
+
+def synthetic_recording(channels, samples, spikes_per_channel, seed=0):
+    '''
+    Return noise with spikes added at known times (a list of the spike times
+    for each channel)
+    '''
+    state = np.random.RandomState(seed)
+    x = state.normal(scale=0.1, size=(channels, samples))
+    times = []
+    for i in range(channels):
+        # Keep the spikes well separated so each one crosses the threshold once
+        t = np.sort(state.choice(np.arange(200, samples-200, 100),
+                                 spikes_per_channel, replace=False))
+        for s in t:
+            x[i, s-8:s+16] += WAVEFORM*(1+i*0.02)
+        times.append(t)
+    return x, times
+
+class Collector(object):
+
+    def __init__(self):
+        self.snippets = []
+        self.timestamps = []
+
+    def send(self, snippets, timestamps, classifiers):
+        self.snippets.extend(snippets)
+        self.timestamps.extend(timestamps)
+
+class TestSpikeDetector(unittest.TestCase):
+
+    def detect(self, x, block_sizes, **kwargs):
+        targets = [Collector() for i in range(len(x))]
+        detector = SpikeDetector(FS, -np.ones(len(x)), targets=targets,
+                                 **kwargs)
+        i = 0
+        for n in block_sizes:
+            detector.send(x[:, i:i+n])
+            i += n
+        return targets
+
+    def test_spikes(self):
+        x, times = synthetic_recording(4, 50000, 50)
+        for target, t in zip(self.detect(x, [len(x[0])]), times):
+            # Each spike is detected once, shortly before its trough
+            detected = np.array(target.timestamps)
+            self.assertEquals(len(detected), len(t))
+            self.assertTrue(np.all((detected <= t) & (detected >= t-8)))
+
+    def test_blocks(self):
+        # The result does not depend on how the data is divided into blocks
+        x, times = synthetic_recording(4, 50000, 50)
+        expected = self.detect(x, [len(x[0])])
+        sizes = np.random.RandomState(1).randint(1, 500, 500)
+        for target, e in zip(self.detect(x, sizes), expected):
+            np.testing.assert_array_equal(target.timestamps, e.timestamps)
+            np.testing.assert_allclose(target.snippets, e.snippets, atol=1e-6)
+
+    def test_polarity(self):
+        x, times = synthetic_recording(1, 50000, 50)
+        x = np.concatenate((x, -x))
+        # Bipolar detection does not depend on the polarity of the signal.  The
+        # rebound following the trough of each (filtered) spike is detected as
+        # well.
+        targets = self.detect(x, [len(x[0])], bipolar=True)
+        np.testing.assert_array_equal(targets[0].timestamps,
+                                      targets[1].timestamps)
+        self.assertTrue(len(targets[0].timestamps) > len(times[0]))
+        # A positive threshold detects the inverted spikes
+        targets = [Collector(), Collector()]
+        detector = SpikeDetector(FS, [-1.0, 1.0], targets=targets)
+        detector.send(x)
+        np.testing.assert_array_equal(targets[0].timestamps,
+                                      targets[1].timestamps)
+        np.testing.assert_allclose(targets[0].snippets,
+                                   -np.array(targets[1].snippets), atol=1e-6)
+        self.assertEquals(len(targets[0].timestamps), len(times[0]))
+
+    def test_lowpass(self):
+        # A highpass cutoff of 0 applies a lowpass filter
+        x, times = synthetic_recording(2, 50000, 50)
+        for target, t in zip(self.detect(x, [len(x[0])], fc_highpass=0), times):
+            detected = np.array(target.timestamps)
+            self.assertEquals(len(detected), len(t))
+            self.assertTrue(np.all((detected <= t) & (detected >= t-8)))
+
+class TestDetectionThread(unittest.TestCase):
+
+    def test_blocks(self):
+        x, times = synthetic_recording(4, 50000, 50)
+        targets = [Collector() for i in range(4)]
+        thread = DetectionThread(SpikeDetector(FS, -np.ones(4),
+                                               targets=targets),
+                                 max_pending=50)
+        for i in range(0, 50000, 1000):
+            thread.send(x[:, i:i+1000])
+        thread.stop()
+        self.assertEquals(thread.dropped, 0)
+        for target, t in zip(targets, times):
+            detected = np.array(target.timestamps)
+            self.assertEquals(len(detected), len(t))
+            self.assertTrue(np.all((detected <= t) & (detected >= t-8)))
+
+    def test_drop(self):
+        # Blocks are dropped while the detector is busy (simulated by holding
+        # its lock), and the timestamps of the following spikes count the
+        # dropped samples
+        x, times = synthetic_recording(1, 50000, 100)
+        target = Collector()
+        detector = SpikeDetector(FS, -np.ones(1), targets=[target])
+        thread = DetectionThread(detector, max_pending=1)
+        with detector._lock:
+            thread.send(x[:, :5000])
+            while not thread._queue.empty():
+                time.sleep(0.001)
+            for i in range(5000, 30000, 5000):
+                thread.send(x[:, i:i+5000])
+        for i in range(30000, 50000, 5000):
+            while not thread._queue.empty():
+                time.sleep(0.001)
+            thread.send(x[:, i:i+5000])
+        thread.stop()
+        self.assertEquals(thread.dropped, 4)
+        # Blocks 0, 1 and 6-9 were processed.  The spikes within a snippet of
+        # the gap may be missed.
+        detected = np.array(target.timestamps)
+        t = times[0]
+        expected = t[(t < 9950) | (t >= 30050)]
+        self.assertTrue(np.all((detected < 10000) | (detected >= 30000)))
+        for s in expected:
+            self.assertTrue(np.any((detected <= s) & (detected >= s-8)))
+
+class TestSimulatedAcquisition(unittest.TestCase):
+    '''
+    Simulates acquisition (a 16 channel block every 10 ms) with the detector
+    called directly from the acquisition callback.  Every
+    spike should reach the spike channels and detection should keep up with
+    acquisition.  An occasional block may exceed the latency budget if the
+    thread is descheduled, so only the typical latency is checked.
+    '''
+
+    def test_acquisition(self):
+        channels, poll_period, duration = 16, 0.01, 3
+        block_samples = int(FS*poll_period)
+        x, times = synthetic_recording(channels, int(FS*duration), 20)
+        spikes = [RAMSnippetChannel(snippet_size=26, fs=FS)
+                  for i in range(channels)]
+        detector = SpikeDetector(FS, -np.ones(channels), targets=spikes,
+                                 latency_budget=poll_period)
+
+        def samples_acquired(names, samples):
+            detector.send(samples)
+
+        def engine():
+            start = time.time()
+            for i in range(x.shape[-1]//block_samples):
+                samples = x[:, i*block_samples:(i+1)*block_samples]
+                samples_acquired(None, samples.astype(np.float32))
+                delay = start+(i+1)*poll_period-time.time()
+                if delay > 0:
+                    time.sleep(delay)
+
+        thread = threading.Thread(target=engine)
+        thread.start()
+        thread.join()
+
+        for channel, t in zip(spikes, times):
+            detected = channel.timestamps[:]
+            self.assertEquals(len(detected), len(t))
+            self.assertTrue(np.all((detected <= t) & (detected >= t-8)))
+            self.assertEquals(channel[:].shape, (len(t), 26))
+        n_blocks = x.shape[-1]//block_samples
+        self.assertEquals(len(detector.latency), n_blocks)
+        self.assertTrue(np.median(detector.latency) < poll_period/4)
+        self.assertTrue(detector.overruns <= n_blocks//100)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,6 @@
 from datetime import datetime
 from cns.data.h5_utils import get_or_append_node
+from cns.channel import flush_buffers
 
 # Enthought supports both the PySide and Qt4 backend.  PySide is
 # essentially a rewrite of PyQt4.  These backends are not compatible
@@ -355,6 +356,7 @@ class AbstractExperimentController(Controller):
             node._v_attrs['stop_time'] = time.strftime(DATETIME_FMT)
             node._v_attrs['duration'] = (time-self.start_time).seconds
             info.object.data.save()
+            flush_buffers()
 
     ############################################################################
     # Method stubs to be implemented
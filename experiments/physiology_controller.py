@@ -8,6 +8,7 @@ from cns import get_config
 from cns.channel import FileChannel, FileMultiChannel, MultiChannel
 from os.path import join
 from cns.pipeline import deinterleave_bits
+from cns.spike_detector import SpikeDetector, DetectionThread
 
 import numpy as np
 import threading
@@ -34,6 +35,8 @@ class PhysiologyController(Controller):
     buffer_ttl              = Any
     physiology_ttl_pipeline = Any
     buffer_spikes           = List(Any)
+    spike_detector          = Instance(SpikeDetector)
+    detection_thread        = Instance(DetectionThread)
     state                   = Enum('master', 'client')
     #process                 = Instance('tdt.DSPProject')
     timer                   = Instance(Timer)
@@ -82,6 +85,23 @@ class PhysiologyController(Controller):
         self.fs = 500e3/16
         self.model.data.raw.fs = self.fs
         self.model.data.processed.fs = self.fs
+        for channel in self.model.data.spikes:
+            channel.fs = self.fs
+
+        # Spikes are detected online (as the data is acquired) rather than by
+        # the RZ5
+        settings = self.model.settings
+        bipolar = [not sign for sign in settings.spike_signs]
+        self.spike_detector = SpikeDetector(self.fs,
+                settings.spike_thresholds, bipolar=bipolar,
+                fc_highpass=settings.monitor_fc_highpass,
+                fc_lowpass=settings.monitor_fc_lowpass,
+                diff_matrix=settings.diff_matrix,
+                snippet_size=SPIKE_SNIPPET_SIZE,
+                targets=self.model.data.spikes,
+                processed=self.model.data.processed)
+        self.detection_thread = DetectionThread(self.spike_detector)
+
         # # Load the circuit
         #
         # circuit = join(get_config('RCX_ROOT'), 'physiology')
@@ -119,10 +139,11 @@ class PhysiologyController(Controller):
         self.parent.engine.register_ai2_callback(self.samples_acquired)
 
     def samples_acquired(self, names, samples):
-        self.model.data.raw.send(samples/1000)
+        samples = samples/1000
+        self.model.data.raw.send(samples)
+        self.monitor_physiology(samples)
 
         # self.model.data.ts.send()
-        # self.model.data.processed.send(samples)
         # self.buffer_raw.send(samples)
 
     @on_trait_change('model.data')
@@ -151,9 +172,18 @@ class PhysiologyController(Controller):
     def stop(self):
         # self.timer.stop()
         # self.process.stop()
-        pass
+        if self.detection_thread is not None:
+            self.detection_thread.stop()
+
+    def monitor_physiology(self, samples):
+        # Filter the block of raw data, detect the spikes and send them to
+        # self.model.data.spikes (and the filtered data to
+        # self.model.data.processed).  This is called from the acquisition
+        # callback, so the block is handed to a background thread.  If
+        # detection falls behind, blocks are dropped (and a warning is logged)
+        # rather than stalling acquisition.
+        self.detection_thread.send(samples)
 
-    def monitor_physiology(self):
         # Acquire raw physiology data
         # waveform = self.buffer_raw.read()
         # self.model.data.raw.send(waveform)
@@ -190,29 +220,43 @@ class PhysiologyController(Controller):
         #     ts = data[:,0].view('int32')
         #     cl = data[:,-1].view('int32')
         #     self.model.data.spikes[i].send(snip, ts, cl)
-        pass
 
     @on_trait_change('model.settings.spike_signs')
     def set_spike_signs(self, value):
         for ch, sign in enumerate(value):
             name = 's_spike{}'.format(ch+1)
             # self.iface_physiology.set_tag(name, sign)
+        self.update_spike_thresholds()
 
     @on_trait_change('model.settings.spike_thresholds')
     def set_spike_thresholds(self, value):
         for ch, threshold in enumerate(value):
             name = 'a_spike{}'.format(ch+1)
             # self.iface_physiology.set_tag(name, threshold)
+        self.update_spike_thresholds()
+
+    def update_spike_thresholds(self):
+        if self.spike_detector is not None:
+            settings = self.model.settings
+            bipolar = [not sign for sign in settings.spike_signs]
+            self.spike_detector.set_thresholds(settings.spike_thresholds,
+                                               bipolar)
 
     @on_trait_change('model.settings.monitor_fc_highpass')
     def set_monitor_fc_highpass(self, value):
         # self.iface_physiology.set_tag('FiltHP', value)
-        pass
+        self.update_monitor_filter()
 
     @on_trait_change('model.settings.monitor_fc_lowpass')
     def set_monitor_fc_lowpass(self, value):
         # self.iface_physiology.set_tag('FiltLP', value)
-        pass
+        self.update_monitor_filter()
+
+    def update_monitor_filter(self):
+        if self.spike_detector is not None:
+            settings = self.model.settings
+            self.spike_detector.set_filter(settings.monitor_fc_highpass,
+                                           settings.monitor_fc_lowpass)
 
     @on_trait_change('model.settings.monitor_ch_1')
     def set_monitor_ch_1(self, value):
@@ -247,7 +291,8 @@ class PhysiologyController(Controller):
     @on_trait_change('model.settings.diff_matrix')
     def set_diff_matrix(self, value):
         # self.iface_physiology.set_coefficients('diff_map', value.ravel())
-        pass
+        if self.spike_detector is not None:
+            self.spike_detector.set_diff_matrix(value)
 
     def load_settings(self, info):
         instance = load_instance(PHYSIOLOGY_ROOT, PHYSIOLOGY_WILDCARD)
@@ -1,14 +1,15 @@
-import tables
-from tempfile import mkdtemp
-from os import path
 from cns import get_config
 from traits.api import HasTraits, Instance, List, Any
-from cns.channel import (FileMultiChannel, FileChannel, FileSnippetChannel,
-                         FileTimeseries, FileEpoch)
+from cns.channel import (FileMultiChannel, FileChannel, RAMMultiChannel,
+                         RAMSnippetChannel, FileTimeseries, FileEpoch)
+from cns.storage import load_profile
 import numpy as np
 
 CHANNELS = get_config('PHYSIOLOGY_CHANNELS')
 SNIPPET_SIZE = get_config('PHYSIOLOGY_SPIKE_SNIPPET_SIZE')
+RETENTION = get_config('PHYSIOLOGY_RETENTION')
+SPIKE_HISTORY = get_config('PHYSIOLOGY_SPIKE_HISTORY')
+STORAGE_PROFILE = get_config('PHYSIOLOGY_STORAGE_PROFILE')
 
 class PhysiologyData(HasTraits):
 
@@ -27,13 +28,18 @@ class PhysiologyData(HasTraits):
 
     def _sweep_default(self):
         return FileChannel(node=self.store_node, name='sweep', dtype=np.bool,
-                           use_checksum=True)
+                           use_checksum=True, buffer_writes=True)
 
     def _raw_default(self):
+        if STORAGE_PROFILE is not None:
+            profile = load_profile(STORAGE_PROFILE)
+        else:
+            profile = dict(compression_type='lzo', compression_level=1,
+                           use_shuffle=True)
         return FileMultiChannel(node=self.store_node, channels=CHANNELS,
                                 name='raw', dtype=np.float32,
-                                compression_type='lzo', compression_level=1,
-                                use_shuffle=True, use_checksum=True)
+                                use_checksum=True, overview_levels=3,
+                                buffer_writes=True, **profile)
 
     # def _ts_default(self):
     #     return FileTimeseries(node=self.store_node, name='ts', dtype=np.int32,
@@ -45,28 +51,19 @@ class PhysiologyData(HasTraits):
     #############################################################################
     # TEMPORARY DATA
     #############################################################################
-    # Temporary data for plotting.  Stored in a temporary file that will
-    # eventually be discarded at the end of the experiment.
-
-    # Where to store the temporary data
-    temp_node   = Any
-    processed   = Instance(FileMultiChannel)
-    spikes      = List(Instance(FileSnippetChannel))
-
-    def _temp_node_default(self):
-        filename = path.join(mkdtemp(), 'processed_physiology.h5')
-        tempfile = tables.openFile(filename, 'w')
-        return tempfile.root
+    # Temporary data for plotting.  Only the most recent data is held in memory
+    # and it is discarded at the end of the experiment.
+    processed   = Instance(RAMMultiChannel)
+    spikes      = List(Instance(RAMSnippetChannel))
 
     def _processed_default(self):
-        return FileMultiChannel(node=self.temp_node, channels=CHANNELS,
-                                name='processed', dtype=np.float32)
+        return RAMMultiChannel(channels=CHANNELS, dtype=np.float32,
+                               retention=RETENTION)
 
     def _spikes_default(self):
         channels = []
         for i in range(CHANNELS):
-            name = 'spike_{:02}'.format(i+1)
-            ch = FileSnippetChannel(node=self.temp_node, name=name,
-                    dtype=np.float32, snippet_size=SNIPPET_SIZE)
+            ch = RAMSnippetChannel(dtype=np.float32, snippet_size=SNIPPET_SIZE,
+                                   max_snippets=SPIKE_HISTORY)
             channels.append(ch)
         return channels
@@ -171,7 +171,7 @@ class PhysiologyParadigm(HasTraits):
     monitor_gain_2      = Range(0, 100, 50)
     monitor_gain_3      = Range(0, 100, 50)
 
-    # Bandpass filter settings
+    # Bandpass filter settings (a highpass of 0 applies a lowpass filter)
     monitor_fc_highpass = Range(0, 1e3, 300)
     monitor_fc_lowpass  = Range(1e3, 5e3, 5e3)
 
@@ -2,8 +2,8 @@ from traits.api import HasTraits, Any, Bool, Float
 
 # For generating the signal
 from cns import signal as wave
+from cns.sigtools import iirfilter_sos, sosfiltfilt
 import numpy as np
-from scipy import signal
 from cns import get_config
 import time
 
@@ -158,12 +158,15 @@ class PositiveAMNoiseControllerMixin(HasTraits):
             fl = np.clip(fc-0.5*bandwidth, 0, 0.5*fs)
             fh = np.clip(fc+0.5*bandwidth, 0, 0.5*fs)
             Wp = np.array([fl, fh])/(0.5*fs)
-            b, a = signal.iirfilter(order, Wp, rp, rs, ftype='elliptic')
+            sos, zi = iirfilter_sos(order, Wp, rp, rs, ftype='elliptic')
 
             noise_token = self._get_noise_token()
 
-            # Filter and cache the token
-            token = signal.filtfilt(b, a, noise_token)
+            # Filter and cache the token.  The filter is applied as
+            # second-order sections since narrow-band elliptic filters are
+            # numerically unstable in transfer function form.  Padding matches
+            # the default used by filtfilt.
+            token = sosfiltfilt(sos, noise_token, zi, padlen=3*(2*len(sos)+1))
 
             # TODO: LOOK AT THIS!  This renormalizes the noise token after being
             # filtered.  It would also make sense to scale up the waveform to
@@ -1,14 +1,18 @@
 import tables
 from cns import h5
 from cns.io import update_progress
-from cns.analysis import running_rms
+from cns.analysis import running_rms, open_sidecar
 
-def compute_rms(ext_filename, force_overwrite=False):
+def compute_rms(ext_filename, force_overwrite=False, tolerance=0.01):
     '''
     Add running measurement of RMS noise floor to the extracted spiketimes file.
     This metric is required for many of the spike processing routines; however,
-    this is such a slow (possibly inefficient) algorithm that it was broken out
-    into a separate function.
+    it requires another pass through the raw data so it was broken out into a
+    separate function.
+
+    The median in each window is estimated to within tolerance (relative) of
+    the exact value.  If tolerance is None, the exact (but much slower)
+    algorithm is used (see `cns.analysis.running_rms`).
     '''
     processing = {}
     with tables.openFile(ext_filename, 'a') as fh:
@@ -31,8 +35,12 @@ def compute_rms(ext_filename, force_overwrite=False):
         with tables.openFile(raw_filename, 'r') as fh_raw:
             input_node = h5.p_get_node(fh_raw.root, '*')
             output_node = fh.createGroup('/', 'rms')
+            sidecar = open_sidecar(input_node)
             running_rms(input_node, output_node, 1, 0.25, processing=processing,
-                        algorithm='median', progress_callback=update_progress)
+                        algorithm='median', progress_callback=update_progress,
+                        tolerance=tolerance, sidecar=sidecar)
+            if sidecar is not None:
+                sidecar._v_file.close()
 
 if __name__ == '__main__':
     import argparse
@@ -41,10 +49,12 @@ if __name__ == '__main__':
     parser.add_argument('files', nargs='+', help='Files to procss')
     parser.add_argument('--force-overwrite', action='store_true',
                         help='Overwrite existing RMS data')
+    parser.add_argument('--tolerance', type=float, default=0.01,
+                        help='Relative tolerance of the median (0 for exact)')
     args = parser.parse_args()
     for filename in args.files:
         print 'Processing file', filename
         try:
-            compute_rms(filename, args.force_overwrite)
+            compute_rms(filename, args.force_overwrite, args.tolerance or None)
         except IOError as e:
             print e
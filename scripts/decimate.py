@@ -4,24 +4,37 @@ import tables
 
 from cns.analysis import decimate_waveform
 from cns.io import update_progress
+from cns.checkpoint import has_checkpoint
 
-def main(infile, dec_fs=600, outfile_suffix='dec', force_overwrite=False):
+def main(infile, dec_fs=600, outfile_suffix='dec', force_overwrite=False,
+         filter_method='ba', taps_per_phase=10, zero_phase=True,
+         checkpoint_interval=None):
     fh_in = tables.openFile(infile, 'r')
     if fh_in.root._g_getnchildren() == 1:
         print 'Processing {}'.format(infile)
         outfile = infile.replace('raw', outfile_suffix)
+        fh_out = None
         if path.exists(outfile) and not force_overwrite:
-            raise IOError, '{} already exists'.format(outfile)
-        fh_out = tables.openFile(outfile, 'w')
+            # Resume if the previous run was interrupted
+            fh_out = tables.openFile(outfile, 'a')
+            if not has_checkpoint(fh_out.root):
+                fh_out.close()
+                raise IOError, '{} already exists'.format(outfile)
+            print 'Resuming {}'.format(outfile)
+        if fh_out is None:
+            fh_out = tables.openFile(outfile, 'w')
 
         output_node = fh_out.root
         input_node = fh_in.root._f_listNodes()[0]
 
         decimate_waveform(input_node, 
                           output_node,
-                          source_fs=input_node._v_attrs['fs'],
                           dec_fs=dec_fs,
-                          progress_callback=update_progress)
+                          progress_callback=update_progress,
+                          filter_method=filter_method,
+                          taps_per_phase=taps_per_phase,
+                          zero_phase=zero_phase,
+                          checkpoint_interval=checkpoint_interval)
 
         # Add some extra metadata to the output node to help us in tracking
         # where the data came from
@@ -43,11 +56,22 @@ if __name__ == '__main__':
     parser.add_argument('--dec-fs', type=float, default=600.0, 
                         help='Target decimation frequency')
     parser.add_argument('--outfile-suffix', type=str, default='dec')
+    parser.add_argument('--filter-method', choices=('ba', 'sos', 'fir'),
+                        default='ba',
+                        help='Lowpass filter (fir uses a polyphase decimator)')
+    parser.add_argument('--taps-per-phase', type=int, default=10,
+                        help='Length of the fir filter (per decimated sample)')
+    parser.add_argument('--causal', action='store_true',
+                        help='Do not compensate for the fir filter delay')
+    parser.add_argument('--checkpoint', type=float, default=None,
+                        help='Save a checkpoint every N seconds so an '
+                        'interrupted run can be resumed')
     args = parser.parse_args()
 
     for filename in args.files:
         try:
             main(filename, args.dec_fs, args.outfile_suffix,
-                 args.force_overwrite)
+                 args.force_overwrite, args.filter_method,
+                 args.taps_per_phase, not args.causal, args.checkpoint)
         except Exception, e:
             print e
@@ -6,12 +6,22 @@ from os import path
 from cns import io
 from cns import analysis
 from cns import h5
+from cns.checkpoint import has_checkpoint, MARKER
 
-def extract_spikes(raw_filename, template=None, force_overwrite=False):
+def extract_spikes(raw_filename, template=None, force_overwrite=False,
+                   n_jobs=1, checkpoint_interval=None, use_sweep=False):
     '''
     Extract spikes from raw data based on information stored in the channel
     metadata table.  Use the review physiology GUI to configure and save the
     settings for spike extraction.
+
+    If the extracted file contains a checkpoint (i.e. a previous extraction was
+    interrupted), the extraction is resumed.
+
+    If use_sweep is True, the filtered data saved by sweep_thresholds.py is
+    used rather than filtering the raw data again.  Otherwise, if the raw data
+    has been preprocessed with the same settings (see preprocess.py), the
+    preprocessed data is used.
     '''
     ext_filename = raw_filename.replace('raw', 'extracted')
 
@@ -20,14 +30,20 @@ def extract_spikes(raw_filename, template=None, force_overwrite=False):
     kwargs = io.create_extract_arguments(template)
 
     if path.exists(ext_filename):
-        if not force_overwrite:
+        fh_out = tables.openFile(ext_filename, 'a')
+        if has_checkpoint(fh_out.root) and not force_overwrite:
+            print 'Resuming {}'.format(ext_filename)
+        elif not force_overwrite:
+            fh_out.close()
             raise IOError, 'Extracted file already exists'
         else:
             ext_kwargs = io.create_extract_arguments(ext_filename)
 
             # Remove the extracted data information in preparation for the
-            # reprocessing of the file.
-            fh_out = tables.openFile(ext_filename, 'a')
+            # reprocessing of the file (including any checkpoint left by an
+            # interrupted extraction).
+            if has_checkpoint(fh_out.root):
+                del fh_out.root._v_attrs[MARKER]
             fh_out.root.event_data._f_remove(recursive=True)
             fh_out.root.filter._f_remove(recursive=True)
             fh_out.root.block_data._f_remove(recursive=True)
@@ -46,7 +62,18 @@ def extract_spikes(raw_filename, template=None, force_overwrite=False):
     kwargs['input_node'] = h5.p_get_node(fh_in, '*') 
     kwargs['output_node'] = fh_out.root
     kwargs['progress_callback'] = io.update_progress
+    kwargs['n_jobs'] = n_jobs
+    kwargs['checkpoint_interval'] = checkpoint_interval
+    if use_sweep:
+        fh_sweep = tables.openFile(raw_filename.replace('raw', 'sweep'), 'r')
+        kwargs['filtered_node'] = fh_sweep.root.filtered
+    else:
+        kwargs['sidecar'] = analysis.open_sidecar(kwargs['input_node'])
     analysis.extract_spikes(**kwargs)
+    if use_sweep:
+        fh_sweep.close()
+    elif kwargs['sidecar'] is not None:
+        kwargs['sidecar']._v_file.close()
     fh_in.close()
     fh_out.close()
 
@@ -63,13 +90,24 @@ if __name__ == '__main__':
     parser.add_argument('--template', help='Use settings defined in this file')
     parser.add_argument('--skip-missing', action='store_true',
                         help='Skip file if channel metadata missing')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='Number of worker processes (0 for one per CPU)')
+    parser.add_argument('--checkpoint', type=float, default=None,
+                        help='Save a checkpoint every N seconds so an '
+                        'interrupted extraction can be resumed')
+    parser.add_argument('--use-sweep', action='store_true',
+                        help='Use the filtered data saved by '
+                        'sweep_thresholds.py')
 
     args = parser.parse_args()
     for raw_filename in args.files:
         try:
             ext_filename = extract_spikes(raw_filename, 
                                           template=args.template,
-                                          force_overwrite=args.force_overwrite)
+                                          force_overwrite=args.force_overwrite,
+                                          n_jobs=args.jobs or None,
+                                          checkpoint_interval=args.checkpoint,
+                                          use_sweep=args.use_sweep)
             if args.add_rms:
                 compute_rms(ext_filename)
         except:
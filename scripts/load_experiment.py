@@ -22,10 +22,8 @@ import logging.config
 from os import path
 from time import strftime
 from datetime import datetime
-import threading
-import tables as tb
-import pandas
 from cns.widgets.file_handler import get_save_file, get_directory
+from cns import hdf5_service
 
 def configure_logging(filename, filename2):
     time_format = '[%(asctime)s] :: %(name)s - %(levelname)s - %(message)s'
@@ -109,134 +107,6 @@ class VerifyServer(argparse.Action):
         host, port = value.split(':')
         setattr(args, self.dest, (host, int(port)))
 
-def do_monkeypatch():
-    # List of class methods that need to be monkey-patched. This is not an
-    # exhaustive list. We can add to this as we find more methods that we want
-    # to use.
-    monkeypatch = [
-        tb.File._gettitle,
-        tb.File._settitle,
-        tb.File._deltitle,
-        tb.File._getfilters,
-        tb.File._setfilters,
-        tb.File._delfilters,
-        tb.File.create_group,
-        tb.File.create_table,
-        tb.File.create_array,
-        tb.File.create_carray,
-        tb.File.create_earray,
-        tb.File.create_vlarray,
-        tb.File.create_hard_link,
-        tb.File.create_soft_link,
-        tb.File.create_external_link,
-        tb.File.rename_node,
-        tb.File.move_node,
-        tb.File.copy_node,
-        tb.File.remove_node,
-        tb.File.get_node_attr,
-        tb.File.set_node_attr,
-        tb.File.del_node_attr,
-        tb.File.copy_node_attrs,
-        tb.File.copy_children,
-        tb.File.copy_file,
-        tb.File.list_nodes,
-        tb.File.iter_nodes,
-        tb.File.mark,
-        tb.File.undo,
-        tb.File.redo,
-        tb.File.goto,
-        tb.File.flush,
-        tb.File.close,
-        tb.File.set_node_attr,
-        tb.File.list_nodes,
-        tb.Table.append,
-        tb.Table.modify_rows,
-        tb.Table.read,
-        tb.Table._g_create,
-        tb.Table._g_open,
-        tb.Table._get_column_instance,
-        tb.Table._disable_indexing_in_queries,
-        tb.Table._enable_indexing_in_queries,
-        tb.Table.will_query_use_indexing,
-        tb.Table.where,
-        tb.Table.read_where,
-        tb.Table.append_where,
-        tb.Table.get_where_list,
-        tb.Table.itersequence,
-        tb.Table._check_sortby_csi,
-        tb.Table.itersorted,
-        tb.Table.read_sorted,
-        tb.Table.iterrows,
-        tb.Table.get_enum,
-        tb.Table.col,
-        tb.Table.__getitem__,
-        tb.Table.__setitem__,
-        tb.Table.modify_coordinates,
-        tb.Table.modify_column,
-        tb.Table.modify_columns,
-        tb.Table.flush_rows_to_index,
-        tb.Table.remove_rows,
-        tb.Table.remove_row,
-        tb.Table.reindex,
-        tb.Table.reindex_dirty,
-        tb.Table.copy,
-        tb.Array._g_create,
-        tb.Array.iterrows,
-        tb.Array.next,
-        tb.Array.__getitem__,
-        tb.Array.__setitem__,
-        tb.Array._read,
-        # tb.Array._read_slice,
-        # tb.Array._read_coords,
-        # tb.Array._read_selection,
-        tb.Array._write_slice,
-        tb.Array._write_coords,
-        tb.Array._write_selection,
-        tb.Array._getnrows,
-        tb.Array._getrowsize,
-        tb.EArray.append,
-        tb.EArray.set_attr,
-        tb.EArray.read,
-        tb.EArray.__setitem__,
-        tb.EArray.__getitem__,
-        tb.EArray.__len__,
-        tb.Node._f_getattr,
-        tb.Node._f_setattr,
-        tb.Node._f_delattr,
-        tb.Node._f_move,
-        # tb.Node._g_set_location,
-        # tb.Node._g_del_location,
-        tb.file.NodeManager.rename_node,
-        # tb.file.NodeManager.drop_from_cache,
-        tb.file.NodeManager.drop_node,
-        tb.file.NodeManager.flush_nodes,
-        # tb.file.NodeManager.shutdown,
-        # tb.attributeset.AttributeSet.__getattr__,
-        # tb.attributeset.AttributeSet._g__setattr,
-        tb.attributeset.AttributeSet._g__delattr,
-        tb.attributeset.AttributeSet._g_update_node_location,
-        # pandas.DataFrame.append,
-        # pandas.core.indexing._iLocIndexer.__getitem__,
-    ]
-
-    def secure_lock(f, lock):
-        def wrapper(*args, **kwargs):
-            with lock:
-                return f(*args, **kwargs)
-
-        return wrapper
-
-    lock = threading.Lock()
-    for im in monkeypatch:
-        wrapped_im = secure_lock(im, lock)
-        setattr(im.im_class, im.im_func.func_name, wrapped_im)
-
-    def table_length(self):
-        with lock:
-            return self.nrows
-    setattr(tb.Table, 'length', property(table_length))
-
-
 CALIBRATION_HELP = '''Path to file containing calibration data for {} speaker.
 If this option is not specified, the most recent calibration file available
 will be used for the experiment.'''
@@ -358,7 +228,9 @@ if __name__ == '__main__':
                     mesg = ' are invalid parameters'
                 sys.exit(', '.join(invalid) + mesg)
 
-        do_monkeypatch()
+        # Route all HDF5 access through a single thread so that acquisition
+        # writes are never queued behind reads by the plots.
+        hdf5_service.install()
 
         args.animal = None
 
@@ -3,6 +3,7 @@ import sys
 import tables
 from cns.analysis import load_trial_log
 from cns.plottools import AxesIterator
+from cns.arraytools import gather_windows
 import pylab
 from os import path
 
@@ -43,9 +44,8 @@ if __name__ == '__main__':
         for ax, (level, df) in AxesIterator(tl.groupby('level')):
             ts = df[reference]
             lb_ts = np.floor((ts+lb) * lfp_fs).astype('i')
-            ub_ts = lb_ts + int(lfp_fs * (ub-lb))
-            waves = [lfp[l:u] for l, u in zip(lb_ts, ub_ts)]
-            waves = np.vstack(waves)
+            waves = gather_windows(lfp, lb_ts, int(lfp_fs * (ub-lb)),
+                                   fill_value=None)
             wave_mean = waves.mean(0)
             wave_std = waves.std(0)
             t = np.arange(wave_mean.shape[-1], dtype='f')/lfp_fs+lb
@@ -0,0 +1,63 @@
+'''
+Save the referenced and filtered physiology data to a sidecar file (see
+`cns.analysis.preprocess_waveform`).  Once the sidecar exists,
+extract_spikes.py, add_rms_to_extracted.py, sweep_thresholds.py and the review
+physiology GUI read the data from the sidecar (when the settings match) rather
+than referencing and filtering the raw data again.
+'''
+
+from os import path
+import tables
+
+from cns import io
+from cns import h5
+from cns.analysis import preprocess_waveform, sidecar_filename
+
+def main(raw_filename, template=None, dtype='int16', force_overwrite=False,
+         checkpoint_interval=None):
+    '''
+    Preprocess the raw data using the settings defined in the channel metadata
+    (use the review physiology GUI to configure and save the settings) of the
+    template (or the raw file if no template is provided).  A sidecar may hold
+    several copies of the data preprocessed with different settings.
+    '''
+    if template is None:
+        template = raw_filename
+    processing = io.create_extract_arguments(template)['processing']
+
+    filename = sidecar_filename(raw_filename)
+    if force_overwrite or not path.exists(filename):
+        mode = 'w'
+    else:
+        mode = 'a'
+
+    with tables.openFile(raw_filename, 'r') as fh_in:
+        with tables.openFile(filename, mode) as fh_out:
+            print 'Processing {}'.format(raw_filename)
+            input_node = h5.p_get_node(fh_in, '*')
+            preprocess_waveform(input_node, fh_out.root, processing, dtype,
+                                progress_callback=io.update_progress,
+                                checkpoint_interval=checkpoint_interval)
+    return filename
+
+if __name__ == '__main__':
+    import argparse
+    description = 'Save referenced and filtered data to a sidecar file'
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('files', nargs='+', help='Raw files to process')
+    parser.add_argument('--template', help='Use settings defined in this file')
+    parser.add_argument('--dtype', choices=('int16', 'float16', 'float32'),
+                        default='int16', help='Type to store the data as')
+    parser.add_argument('--force-overwrite', action='store_true',
+                        help='Discard the existing sidecar file')
+    parser.add_argument('--checkpoint', type=float, default=None,
+                        help='Save a checkpoint every N seconds so an '
+                        'interrupted run can be resumed')
+    args = parser.parse_args()
+
+    for raw_filename in args.files:
+        try:
+            main(raw_filename, args.template, args.dtype,
+                 args.force_overwrite, args.checkpoint)
+        except Exception, e:
+            print e
@@ -43,7 +43,7 @@ from cns.chaco_exts.threshold_overlay import ThresholdOverlay
 from cns.chaco_exts.extracted_spike_overlay import ExtractedSpikeOverlay
 
 from cns.analysis import (extract_spikes, median_std, decimate_waveform,
-    truncate_waveform, zero_waveform, running_rms)
+    truncate_waveform, zero_waveform, running_rms, open_sidecar)
 
 COLORS = get_config('EXPERIMENT_COLORS')
 RAW_WILDCARD = get_config('PHYSIOLOGY_RAW_WILDCARD')
@@ -510,6 +510,8 @@ class PhysiologyReviewController(Controller):
 
         # Truncate the waveform
         truncate_waveform(info.object.data_node, info.object.index_range.high)
+        info.object.detach_sidecar()
+        info.object.channel.clear_cache()
 
         information(info.ui.control, "Truncated waveform.  Be sure to run "
                     "ptrepack or h5repack to regain the unused disk space.")
@@ -529,6 +531,8 @@ class PhysiologyReviewController(Controller):
 
         # Zero the waveform
         zero_waveform(info.object.data_node, info.object.index_range.low)
+        info.object.detach_sidecar()
+        info.object.channel.clear_cache()
 
         information(info.ui.control, "Zeroed waveform.  Be sure to run "
                     "ptrepack or h5repack to recompress the file.")
@@ -602,7 +606,8 @@ class PhysiologyReviewController(Controller):
                 return not cont
 
             running_rms(input_node, output_node, 1, 1, processing=processing,
-                        progress_callback=callback, algorithm='median')
+                        progress_callback=callback, algorithm='median',
+                        sidecar=info.object.channel.sidecar)
 
 
     def extract_spikes(self, info):
@@ -621,6 +626,7 @@ class PhysiologyReviewController(Controller):
         with tables.openFile(filename, 'w') as fh_out:
             kwargs['input_node'] = info.object.data_node
             kwargs['output_node'] = fh_out.root
+            kwargs['sidecar'] = info.object.channel.sidecar
 
             # Create a progress dialog that keeps the user up-to-date on what's
             # going on since this is a fairly lengthy process.
@@ -953,9 +959,25 @@ class PhysiologyReview(HasTraits):
             self.visible_channels = [setting.index]
             self.channel_dclick_toggle = True
 
+    def detach_sidecar(self):
+        # Stop reading the preprocessed data (e.g. once the raw data has been
+        # modified and the preprocessed data no longer matches)
+        sidecar = self.channel.sidecar
+        if sidecar is not None:
+            self.channel.sidecar = None
+            sidecar._v_file.close()
+
     def _data_node_changed(self, node):
+        self.detach_sidecar()
         raw = node.data.physiology.raw
-        self.channel = ProcessedFileMultiChannel.from_node(raw) 
+        cache_bytes = get_config('PROCESSED_CACHE_SIZE')
+        # If the data has been preprocessed (see scripts/preprocess.py), the
+        # data is read from the sidecar file whenever the filter and reference
+        # settings match the ones it was preprocessed with.
+        sidecar = open_sidecar(node)
+        self.channel = ProcessedFileMultiChannel.from_node(raw,
+                                                           cache_bytes=cache_bytes,
+                                                           sidecar=sidecar)
 
         # If this is not a modified trial log, let's back it up (call it
         # "original_trial_log", add a "valid" column and save it back as the
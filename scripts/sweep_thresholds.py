@@ -0,0 +1,67 @@
+import tables
+import numpy as np
+from os import path
+
+from cns import io
+from cns import analysis
+from cns import h5
+
+def sweep_thresholds(raw_filename, threshold_stds, template=None,
+                     force_overwrite=False, save_filtered=True):
+    '''
+    Count the threshold crossings on each channel for several thresholds in a
+    single pass through the raw data.  The filtered data is saved to the sweep
+    file so that the spikes can then be extracted for the chosen threshold
+    without filtering the data again (see extract_spikes.py --use-sweep).
+    '''
+    sweep_filename = raw_filename.replace('raw', 'sweep')
+    if path.exists(sweep_filename) and not force_overwrite:
+        raise IOError, 'Sweep file already exists'
+
+    if template is None:
+        template = raw_filename
+    kwargs = io.create_extract_arguments(template)
+    del kwargs['threshold_stds']
+    del kwargs['rej_threshold_stds']
+    kwargs.pop('cov_samples', None)
+
+    with tables.openFile(raw_filename, 'r') as fh_in:
+        with tables.openFile(sweep_filename, 'w') as fh_out:
+            kwargs['input_node'] = h5.p_get_node(fh_in, '*')
+            kwargs['output_node'] = fh_out.root
+            kwargs['progress_callback'] = io.update_progress
+            kwargs['threshold_stds'] = threshold_stds
+            kwargs['save_filtered'] = save_filtered
+            kwargs['sidecar'] = analysis.open_sidecar(kwargs['input_node'])
+            analysis.sweep_thresholds(**kwargs)
+            counts = fh_out.root.counts[:]
+            if kwargs['sidecar'] is not None:
+                kwargs['sidecar']._v_file.close()
+
+    # Print the number of crossings on each channel for each threshold
+    print 'Crossings for each threshold (rows) on each channel (columns)'
+    print ' '.join(['{:>8}'.format('std')] + \
+                   ['{:>8}'.format(c+1) for c in kwargs['channels']])
+    for threshold, row in zip(threshold_stds, counts):
+        print ' '.join(['{:>8}'.format(threshold)] + \
+                       ['{:>8}'.format(c) for c in row])
+    return sweep_filename
+
+if __name__ == '__main__':
+    import argparse
+    description = 'Count threshold crossings for several thresholds'
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('files', nargs='+', help='Raw files to process')
+    parser.add_argument('--stds', type=float, nargs='+',
+                        default=[-3, -3.5, -4, -4.5, -5, -6],
+                        help='Thresholds (in standard deviations of the noise)')
+    parser.add_argument('--template', help='Use settings defined in this file')
+    parser.add_argument('--force-overwrite', action='store_true',
+                        help='Overwrite existing file')
+    parser.add_argument('--no-filtered', action='store_true',
+                        help='Do not save the filtered data')
+    args = parser.parse_args()
+    for raw_filename in args.files:
+        print 'Processing file', raw_filename
+        sweep_thresholds(raw_filename, args.stds, args.template,
+                         args.force_overwrite, not args.no_filtered)
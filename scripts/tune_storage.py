@@ -0,0 +1,68 @@
+'''
+Benchmark HDF5 storage settings (chunkshape, compression library, compression
+level and shuffle) for channel data and save the best as a storage profile.
+
+If an input file is provided, a segment of the named node is used as the test
+signal.  Otherwise, a synthetic signal is generated.  To use the profile for
+the raw physiology data, set PHYSIOLOGY_STORAGE_PROFILE to the filename of the
+profile.
+'''
+
+import tables
+import numpy as np
+
+from cns.storage import (synthetic_signal, candidate_profiles, tune_storage,
+                         save_profile)
+from cns.io import update_progress
+
+def main(outfile, infile=None, node='raw', duration=10, fs=25e3, channels=16,
+         block_size=1000, weights=None, repeat=3):
+    if infile is not None:
+        fh = tables.openFile(infile, 'r')
+        array = fh.getNode(fh.root, node)
+        fs = array._v_attrs['fs']
+        signal = array[..., :int(duration*fs)]
+        fh.close()
+    else:
+        signal = synthetic_signal(channels, duration, fs)
+
+    results = tune_storage(signal, fs, candidate_profiles(), weights=weights,
+                           block_size=block_size, repeat=repeat,
+                           progress_callback=update_progress)
+    print
+    print '{:>8} {:>6} {:>5} {:>7} {:>10} {:>10} {:>9} {:>8} {:>6}'.format(
+        'chunk', 'codec', 'level', 'shuffle', 'append/s', 'read/s',
+        'latency', 'MB', 'score')
+    for r in results:
+        p = r['profile']
+        print '{:>8} {:>6} {:>5} {:>7} {:>10.3g} {:>10.3g} {:>9.2g} {:>8.1f} '\
+              '{:>6.2f}'.format(r['chunkshape'][-1], p['compression_type'],
+                                p['compression_level'], p['use_shuffle'],
+                                r['append'], r['read'], r['latency'],
+                                r['size']/1e6, r['score'])
+    best = results[0]
+    save_profile(dict(best['profile'], chunk_samples=best['chunkshape'][-1]),
+                 outfile)
+    print 'Saved best profile to {}'.format(outfile)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Tune storage settings')
+    parser.add_argument('outfile', help='Filename to save the profile to')
+    parser.add_argument('--infile', help='Recording to use as the test signal')
+    parser.add_argument('--node', default='raw',
+                        help='Path of the array in infile')
+    parser.add_argument('--duration', type=float, default=10,
+                        help='Duration of the test signal (s)')
+    parser.add_argument('--block-size', type=int, default=1000,
+                        help='Samples per append')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Number of times to repeat each timing')
+    for metric in ('append', 'read', 'latency', 'size'):
+        parser.add_argument('--{}-weight'.format(metric), type=float, default=1,
+                            help='Weight given to {}'.format(metric))
+    args = parser.parse_args()
+    weights = dict(append=args.append_weight, read=args.read_weight,
+                   latency=args.latency_weight, size=args.size_weight)
+    main(args.outfile, args.infile, args.node, args.duration,
+         block_size=args.block_size, weights=weights, repeat=args.repeat)